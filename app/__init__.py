@@ -37,6 +37,14 @@ def create_app(config_object=None):
     # API init
     from app.api import api_blueprint  # let logger init first
     app.register_blueprint(api_blueprint)
+
+    # compile the JSON schema validators once instead of per request
+    from app.validators import compile_request_schemas
+    compile_request_schemas()
+
+    # choose the JSON encoder of the responses once instead of per response
+    from app.jsonencoders import init_json_encoder
+    init_json_encoder(app)
     logger.info("{0} started".format(app.name))
 
     # Allow CORS for same IP on a different port so you can run a demo API on the same
@@ -4,10 +4,13 @@ import logging
 from flask import Blueprint
 from flask import current_app
 from flask import make_response
+from flask import request
 from flask_restful import Api
 from flask_restful_swagger import swagger
 
+from app.compression import compress_response
 from app.configs import URL_PREFIX
+from app.jsonencoders import get_json_encoder
 from app.loggers import CustomLogger
 
 logger = CustomLogger(__name__)
@@ -91,25 +94,16 @@ api.init_app(api_blueprint)
 @api.representation('application/json')
 def output_json(data, code, headers=None):
     """Override the method in Flask-restful to enable Decimal encode support,
-    makes a Flask response with a JSON encoded body"""
-    settings = current_app.config.get('RESTFUL_JSON', {})
-
-    # If we're in debug mode, and the indent is not set, we set it to a
-    # reasonable value here.  Note that this won't override any existing value
-    # that was set.  We also set the "sort_keys" value.
-    # TODO this is moved into configs.py, can be removed I think
-    if current_app.debug:
-        settings.setdefault('indent', 4)
-        settings.setdefault('sort_keys', True)
-
-    import simplejson  # difference is only this line
+    makes a Flask response with a JSON encoded body by the encoder chosen at startup, see app.jsonencoders,
+    compressed if the client accepts it, see app.compression"""
+    encode = get_json_encoder(current_app)
     # always end the json dumps with a new line
     # see https://github.com/mitsuhiko/flask/pull/1262
-    dumped = simplejson.dumps(data, **settings) + "\n"
+    dumped = encode(data) + "\n"
 
     resp = make_response(dumped, code)
     resp.headers.extend(headers or {})
-    return resp
+    return compress_response(resp, request.accept_encodings)
 
 
 def output_javascript(data, code, headers=None):
@@ -1,39 +1,128 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Kpi interface implementation"""
+import copy
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
 from flask import g
 from flask import request
-from flask_restful import Resource, marshal_with
+from flask_restful import Resource
 from jsonschema import ValidationError
 
 from app import validators
 from app.api import api
 from app.customerrors import ForbiddenError, DataNotFoundError, UnsupportedFormatError
 from app.extensions import db, auth
+from app.auth import system_admin_restricted
+from app.jobs import get_job_queue, get_shared_job_queue, register_job, report_job_progress
 from app.models.experiment import Experiment, ExperimentModel
+from app.models.project import Project
 from app.models.variation import Variation
 from app.models.condition import Condition
 from app.models.kpi import Kpi
 from app.api.experimentsV2 import ExperimentV2OutputJsonResource
-from app.requestschema.kpi import kpi_create_request_schema, kpi_update_request_schema
-from app.responseschema.kpi import kpi_collection_get_response, kpi_v2_get_response
-from app.util import build_pagination_response, generate_reaction_query, generate_report_query, find_json_values_by_key
+from app.requestschema.kpi import kpi_create_request_schema, kpi_update_request_schema, kpi_bulk_request_schema
+from app.responseschema import get_request_schema, marshal_with_fields
+from app.responseschema.kpi import kpi_collection_get_response, kpi_get_response, kpi_v2_get_response
+from app.util import build_pagination_response, generate_reaction_query, generate_kpi_queries, \
+    find_json_values_by_key, schema_load_options
+from app.configs import CONFIG
 from app.loggers import CustomLogger
+from app.rerender import rerender_kpi_queries
 
 logger = CustomLogger(__name__)
 
 
+def is_async_requested():
+    """
+    queries are generated by a background job if `async=true` is given, or by default if ASYNC_QUERY_GENERATION.
+    Without a job backend shared by the workers `async=true` is refused and the default is ignored.
+    """
+    value = request.args.get('async')
+    if value is None:
+        if getattr(CONFIG, 'ASYNC_QUERY_GENERATION', False) and not get_job_queue().backend.shared:
+            logger.warning("ASYNC_QUERY_GENERATION is ignored, the JOB_BACKEND is not shared by the workers.")
+            return False
+        return getattr(CONFIG, 'ASYNC_QUERY_GENERATION', False)
+    if value.lower() not in ('1', 'true', 'yes'):
+        return False
+    # refused before anything is written
+    get_shared_job_queue()
+    return True
+
+
+def submit_query_job(name, experiment_id, **res):
+    """enqueue a query regeneration job of the experiment, return the 202 response pointing to its status"""
+    job = get_shared_job_queue().submit(name, experiment_id=experiment_id)
+    res.update({
+        'jobId': job['id'],
+        'status': job['status']
+    })
+    return res, 202, {'Location': api.url_for(QueryJobResource, experiment_id=experiment_id, job_id=job['id'])}
+
+
+@register_job('reaction_query')
+def regenerate_reaction_query(experiment_id):
+    kpi = Kpi.query.filter(Kpi.experiment_id == experiment_id).one_or_none()
+    if kpi:
+        kpi.reaction_query = generate_reaction_query(experiment_id, kpi.kpi_settings)
+        db.session.commit()
+        return {'kpiId': kpi.kpi_id}
+    return None
+
+
+@register_job('kpi_queries')
+def regenerate_kpi_queries(experiment_id):
+    """generate both queries from the kpi settings stored when the job runs, so the latest update wins"""
+    kpi = Kpi.query.filter(Kpi.experiment_id == experiment_id, Kpi.delete_flg == False).one_or_none()
+    if not kpi:
+        raise DataNotFoundError("KPI for the experiment ID {} does not exist".format(experiment_id))
+    reaction_query, report_query = generate_kpi_queries(experiment_id, kpi.kpi_settings)
+    # a query customized after the job was enqueued is kept
+    if not kpi.if_custom_reaction_query:
+        kpi.reaction_query = reaction_query
+    if not kpi.if_custom_report_query:
+        kpi.report_query = report_query
+    db.session.commit()
+    return {'kpiId': kpi.kpi_id}
+
+
+@register_job('rerender_kpi_queries')
+def rerender_kpi_queries_job(organisation_id=None, project_id=None):
+    """renders in the job thread, forking a process pool from a thread of a web worker isn't safe,
+    use `python manage.py rerender_kpi_queries` for a parallel run"""
+    return rerender_kpi_queries(organisation_id=organisation_id, project_id=project_id, processes=0,
+                                batch_size=getattr(CONFIG, 'KPI_RERENDER_BATCH_SIZE', 100),
+                                progress=report_job_progress)
+
+
+def format_job(job):
+    return {
+        'jobId': job['id'],
+        'type': job['name'],
+        'status': job['status'],
+        'progress': job.get('progress'),
+        'result': job['result'],
+        'error': job['error'],
+        'createdAt': job['created_at'],
+        'startedAt': job['started_at'],
+        'finishedAt': job['finished_at']
+    }
+
+
 class KpiCollectionFetchResource(Resource):
     """mapping to /v1/projects/<projectId>/kpis"""
     """ fetch kpi info for kpis mapped to a project """
 
     @auth.login_required
-    @marshal_with(kpi_collection_get_response)
+    @marshal_with_fields(kpi_collection_get_response, records='records')
     def get(self, project_id):
-        """fetch all kpis belonging to the project"""
+        """fetch all kpis belonging to the project, only the `fields` requested if given"""
         validators.check_id_format(project_id)
         validators.check_project_id_integrity(project_id)
-        q = Kpi.query.filter(Kpi.project_id == project_id, Kpi.delete_flg == False)
+        q = Kpi.query.options(*schema_load_options(Kpi, get_request_schema(kpi_get_response))) \
+            .filter(Kpi.project_id == project_id, Kpi.delete_flg == False)
         return build_pagination_response(request, q, project_id=project_id), 200
 
 
@@ -52,10 +141,9 @@ class KpiCollectionResource(Resource):
     @auth.login_required
     def post(self, experiment_id):
         validators.check_id_format(experiment_id)
-        validators.check_experiment_id_integrity(experiment_id)
+        experiment = validators.check_experiment_id_integrity(experiment_id)
         req_json = request.get_json()
         validators.check_json(req_json, kpi_create_request_schema)
-        experiment = Experiment.query.filter_by(experiment_id=experiment_id).one_or_none()
         kpi_name = experiment.project.name + '_' + experiment_id + '_' + 'kpi'
         # check one to one mapping
         kpi = Kpi.query.filter(Kpi.experiment_id == experiment_id).one_or_none()
@@ -65,8 +153,11 @@ class KpiCollectionResource(Resource):
                 logger.error(msg)
                 raise ValidationError(msg)
             else:
-                reaction_query = generate_reaction_query(experiment_id, req_json)
-                report_query = generate_report_query(experiment_id, req_json)
+                run_async = is_async_requested()
+                if run_async:
+                    reaction_query, report_query = None, None
+                else:
+                    reaction_query, report_query = generate_kpi_queries(experiment_id, req_json)
                 try:
                     new_kpi = Kpi(name=kpi_name,
                                   experiment_id=experiment_id,
@@ -82,23 +173,22 @@ class KpiCollectionResource(Resource):
                                                        ExperimentModel.delete_flg == 0).all()
                     models = [model for (model,) in experimentModels]            
                     if any(model in models for model in self.EXPERIMENT_MODELS_FOR_KPI):                     
-                        for kpi_definition in new_kpi.kpi_settings.get('kpi_definitions'):
-                            if 'pattern_name' in kpi_definition:
-                                pattern_name = find_json_values_by_key(kpi_definition, 'pattern_name')[0]
-                                kpi_definition['pattern_id'] = self.retrieve_kpi_pattern_id(experiment_id, pattern_name)
+                        self.set_kpi_pattern_ids(experiment_id, new_kpi.kpi_settings.get('kpi_definitions'))
                                 
                     db.session.add(new_kpi)
                     db.session.commit()
                     experiment.kpi_id = new_kpi.kpi_id
                     db.session.commit()
-                    # Prepare response
-                    res = {
-                        'kpiId': new_kpi.kpi_id
-                    }
-                    return res, 201                                     
                 except Exception as e:
                     logger.error(str(e))
                     raise ValidationError("Unable to add new kpi due to : {}".format(str(e)))
+                if run_async:
+                    return submit_query_job('kpi_queries', experiment_id, kpiId=new_kpi.kpi_id)
+                # Prepare response
+                res = {
+                    'kpiId': new_kpi.kpi_id
+                }
+                return res, 201
         else:
             msg = "The kpi for experiment with experiment ID {} already exists".format(experiment_id)
             logger.error(msg)
@@ -107,8 +197,7 @@ class KpiCollectionResource(Resource):
     @auth.login_required
     def put(self, experiment_id):
         validators.check_id_format(experiment_id)
-        validators.check_experiment_id_integrity(experiment_id)
-        experiment = Experiment.query.filter_by(experiment_id=experiment_id).one()
+        experiment = validators.check_experiment_id_integrity(experiment_id)
         validators.check_permission(project_id=experiment.project_id, user_id=g.user.user_id, module='kpi',
                                     function='edit')
         req_json = request.get_json()
@@ -127,18 +216,19 @@ class KpiCollectionResource(Resource):
                 models = [model for (model,) in experimentModels]     
 
                 if any(model in models for model in self.EXPERIMENT_MODELS_FOR_KPI):
-                    for kpi_definition in req_json.get('kpi_definitions'):
-                        if 'pattern_name' in kpi_definition:
-                            pattern_name = find_json_values_by_key(kpi_definition, 'pattern_name')[0]
-                            kpi_definition['pattern_id'] = self.retrieve_kpi_pattern_id(experiment_id, pattern_name)
+                    self.set_kpi_pattern_ids(experiment_id, req_json.get('kpi_definitions'))
 
                 kpi.kpi_settings = req_json
                 kpi.updated_by = g.user.user_id
-                kpi.reaction_query = generate_reaction_query(experiment_id, req_json)
-                kpi.report_query = generate_report_query(experiment_id, req_json)
+                run_async = is_async_requested()
+                if not run_async:
+                    kpi.reaction_query, kpi.report_query = generate_kpi_queries(experiment_id, req_json)
                 kpi.if_custom_reaction_query = False
                 kpi.if_custom_report_query = False
                 db.session.commit()
+                if run_async:
+                    return submit_query_job('kpi_queries', experiment_id, experimentId=kpi.experiment_id,
+                                            kpiId=kpi.kpi_id)
                 return {
                            'experimentId': kpi.experiment_id,
                            'kpiId': kpi.kpi_id
@@ -158,34 +248,93 @@ class KpiCollectionResource(Resource):
 
     @classmethod
     def retrieve_kpi_pattern_id(self, experiment_id, pattern_name):
-        variations = Variation.query.filter(Variation.experiment_id == experiment_id).all()
-        if variations:
-            variation_ids = [variation.variation_id for variation in variations]
-            condition = Condition.query.filter(Condition.name == str(pattern_name), Condition.variation_id.in_(variation_ids)).one_or_none()
-            variation_type = None
-            if condition:
-                for variation in variations:
-                    if variation.variation_id == condition.variation_id:
-                        variation_type = variation.type_
-            return ExperimentV2OutputJsonResource.format_pattern_id(variation_type, condition.variation_id, condition.condition_id)
-
-    @marshal_with(kpi_v2_get_response)
+        return self.retrieve_kpi_pattern_ids(experiment_id, [pattern_name])[str(pattern_name)]
+
+    @classmethod
+    def find_kpi_patterns(self, pattern_names_by_experiment):
+        """
+        look up the patterns named in several experiments by one joined query
+        :param pattern_names_by_experiment: {experiment_id: pattern names}
+        :return: {experiment_id: {name: [pattern_id, ...]}}
+        """
+        pattern_names = set(str(pattern_name) for pattern_names in pattern_names_by_experiment.values()
+                            for pattern_name in pattern_names)
+        patterns = dict((int(experiment_id), dict()) for experiment_id in pattern_names_by_experiment)
+        if not pattern_names:
+            return patterns
+        rows = db.session.query(Variation.experiment_id, Condition.name, Condition.condition_id,
+                                Variation.variation_id, Variation.type_). \
+            join(Variation, Variation.variation_id == Condition.variation_id). \
+            filter(Variation.experiment_id.in_(patterns.keys()), Condition.name.in_(pattern_names)).all()
+        for experiment_id, name, condition_id, variation_id, variation_type in rows:
+            patterns[experiment_id].setdefault(name, []).append(
+                ExperimentV2OutputJsonResource.format_pattern_id(variation_type, variation_id, condition_id))
+        return patterns
+
+    @classmethod
+    def retrieve_kpi_pattern_ids(self, experiment_id, pattern_names, patterns=None):
+        """
+        resolve the pattern names of the experiment, return a name => pattern_id dict
+        :param patterns: patterns of the experiment found by find_kpi_patterns(), looked up if not given
+        """
+        pattern_names = set(str(pattern_name) for pattern_name in pattern_names)
+        if not pattern_names:
+            return {}
+        if patterns is None:
+            patterns = self.find_kpi_patterns({experiment_id: pattern_names})[int(experiment_id)]
+        pattern_ids = dict()
+        for name in pattern_names.intersection(patterns):
+            if len(patterns[name]) > 1:
+                msg = "More than one pattern named {} was found in experiment {}.".format(name, experiment_id)
+                logger.error(msg)
+                raise ValidationError(msg)
+            pattern_ids[name] = patterns[name][0]
+        missing = pattern_names.difference(pattern_ids)
+        if missing:
+            msg = "The pattern(name={}) does not exist in experiment {}.".format(sorted(missing), experiment_id)
+            logger.error(msg)
+            raise ValidationError(msg)
+        return pattern_ids
+
+    @classmethod
+    def get_kpi_pattern_names(self, kpi_definitions):
+        """pattern names of the kpi definitions which have one, by id() of the definition"""
+        pattern_names = dict()
+        for kpi_definition in kpi_definitions:
+            if 'pattern_name' in kpi_definition:
+                pattern_names[id(kpi_definition)] = str(find_json_values_by_key(kpi_definition, 'pattern_name')[0])
+        return pattern_names
+
+    @classmethod
+    def set_kpi_pattern_ids(self, experiment_id, kpi_definitions, patterns=None):
+        """set pattern_id into every kpi definition which has a pattern_name"""
+        pattern_names = self.get_kpi_pattern_names(kpi_definitions)
+        pattern_ids = self.retrieve_kpi_pattern_ids(experiment_id, pattern_names.values(), patterns=patterns)
+        for kpi_definition in kpi_definitions:
+            if 'pattern_name' in kpi_definition:
+                kpi_definition['pattern_id'] = pattern_ids[pattern_names[id(kpi_definition)]]
+
+    @marshal_with_fields(kpi_v2_get_response)
     @auth.login_required
     def get(self, experiment_id):
         validators.check_id_format(experiment_id)
-        validators.check_experiment_id_integrity(experiment_id)
-        experiment = Experiment.query.filter_by(experiment_id=experiment_id).one()
+        experiment = validators.check_experiment_id_integrity(experiment_id)
+        # only the columns of the requested `fields`, the kpi definitions and based_on come from the settings
+        attributes = set(field.attribute or key for key, field in get_request_schema(kpi_v2_get_response).items())
+        if attributes.intersection((self.KEY, self.BASED_ON)):
+            attributes.add(self.SETTINGS)
+        columns = [Kpi.kpi_id] + [getattr(Kpi, attribute) for attribute in sorted(attributes)
+                                  if attribute != 'kpi_id' and attribute in Kpi.__table__.columns]
         kpi = Kpi.query.filter(Kpi.kpi_id == experiment.kpi_id, Kpi.delete_flg == False). \
-            with_entities(Kpi.kpi_id, Kpi.experiment_id, Kpi.reaction_query, Kpi.report_query,
-                          Kpi.if_custom_reaction_query, Kpi.if_custom_report_query,
-                          Kpi.kpi_settings, Kpi.kpi_id).one_or_none()
+            with_entities(*columns).one_or_none()
         if not kpi:
             msg = "No KPI is set for this experiment."
             logger.error(msg)
             return DataNotFoundError(msg)
         kpi = kpi._asdict()
-        settings = kpi[self.SETTINGS]
-        kpi[self.KEY], kpi[self.BASED_ON] = settings[self.KEY], settings[self.BASED_ON]
+        settings = kpi.get(self.SETTINGS)
+        if settings is not None:
+            kpi[self.KEY], kpi[self.BASED_ON] = settings[self.KEY], settings[self.BASED_ON]
         return kpi
 
     @auth.login_required
@@ -203,6 +352,161 @@ class KpiCollectionResource(Resource):
                }, 200
 
 
+def _generate_kpi_queries_in_app_context(app, experiment_id, kpi_settings):
+    """generate_kpi_queries() for a thread of the bulk pool, return (queries, error message)"""
+    with app.app_context():
+        try:
+            return generate_kpi_queries(experiment_id, kpi_settings), None
+        except Exception as e:
+            return None, str(e) or e.__class__.__name__
+        finally:
+            db.session.remove()
+
+
+class KpiBulkResource(Resource):
+    """mapping to /v2/kpis/bulk"""
+
+    @auth.login_required
+    def post(self):
+        """
+        create the kpi of every experiment which has none yet, update the others. Every item is validated like
+        POST/PUT /v2/experiments/<experimentId>/kpis, experiments, kpis, models and patterns are looked up by one
+        query each, the queries are generated by a thread pool and the valid items are written by one commit.
+        A failed item doesn't stop the others, its error is returned in its result.
+        """
+        req_json = request.get_json()
+        validators.check_json(req_json, kpi_bulk_request_schema)
+        items = req_json['items']
+        results = [{'index': index, 'experimentId': item['experiment_id']} for index, item in enumerate(items)]
+
+        def fail(index, error):
+            results[index]['status'] = 'failed'
+            results[index]['error'] = str(error) or error.__class__.__name__
+
+        def pending():
+            return [index for index, result in enumerate(results) if 'status' not in result]
+
+        experiment_ids = set(item['experiment_id'] for item in items)
+        batch = validators.get_integrity_batch().require(Experiment, experiment_ids).load()
+        experiments = dict((experiment_id, batch.get(Experiment, experiment_id)) for experiment_id in experiment_ids)
+        project_ids = set(experiment.project_id for experiment in experiments.values() if experiment)
+        # kept referenced in the identity map so that experiment.project doesn't query again
+        _identity_map_anchor = Project.query.filter(Project.project_id.in_(project_ids)).all() if project_ids else []
+        kpis = dict((kpi.experiment_id, kpi) for kpi in
+                    Kpi.query.filter(Kpi.experiment_id.in_(experiment_ids)).all())
+        models = dict()
+        for experiment_id, model_name in ExperimentModel.query \
+                .with_entities(ExperimentModel.experiment_id, ExperimentModel.model_name) \
+                .filter(ExperimentModel.experiment_id.in_(experiment_ids), ExperimentModel.delete_flg == 0).all():
+            models.setdefault(experiment_id, set()).add(model_name)
+
+        seen = set()
+        for index in pending():
+            experiment_id, kpi_settings = items[index]['experiment_id'], items[index]['kpi_settings']
+            try:
+                if experiment_id in seen:
+                    raise ValidationError("The experiment {} is given more than once.".format(experiment_id))
+                seen.add(experiment_id)
+                experiment = experiments[experiment_id]
+                if not experiment:
+                    raise DataNotFoundError("The experiment with given ID {} does not exist.".format(experiment_id))
+                kpi = kpis.get(experiment_id)
+                if kpi:
+                    validators.check_permission(project_id=experiment.project_id, user_id=g.user.user_id,
+                                                module='kpi', function='edit')
+                validators.check_json(kpi_settings, kpi_update_request_schema if kpi else kpi_create_request_schema)
+                definitions = kpi_settings[KpiCollectionResource.KEY]
+                if not KpiCollectionResource._check_uniqueness(definitions) or \
+                        not KpiCollectionResource._check_main_kpi(definitions):
+                    raise ValidationError("Wrong KPI Setting Format sent.")
+            except Exception as e:
+                fail(index, e)
+
+        # patterns of every experiment using a model which needs them, by one query
+        pattern_names = dict()
+        for index in pending():
+            experiment_id = items[index]['experiment_id']
+            if any(model in models.get(experiment_id, ()) for model in KpiCollectionResource.EXPERIMENT_MODELS_FOR_KPI):
+                pattern_names[experiment_id] = KpiCollectionResource.get_kpi_pattern_names(
+                    items[index]['kpi_settings'][KpiCollectionResource.KEY]).values()
+        patterns = KpiCollectionResource.find_kpi_patterns(pattern_names)
+
+        # as the single kpi POST does, a new kpi gets its queries generated before the pattern ids are set
+        generation_settings = dict()
+        for index in pending():
+            experiment_id, kpi_settings = items[index]['experiment_id'], items[index]['kpi_settings']
+            generation_settings[index] = kpi_settings if kpis.get(experiment_id) else copy.deepcopy(kpi_settings)
+            try:
+                if experiment_id in patterns:
+                    KpiCollectionResource.set_kpi_pattern_ids(experiment_id,
+                                                              kpi_settings[KpiCollectionResource.KEY],
+                                                              patterns=patterns[experiment_id])
+            except Exception as e:
+                fail(index, e)
+
+        indexes = pending()
+        app = current_app._get_current_object()
+        pool = ThreadPool(max(1, min(getattr(CONFIG, 'KPI_BULK_WORKERS', 4), len(indexes))))
+        try:
+            generated = pool.map(lambda i: _generate_kpi_queries_in_app_context(app, items[i]['experiment_id'],
+                                                                                generation_settings[i]), indexes)
+        finally:
+            pool.close()
+            pool.join()
+
+        new_kpis = dict()
+        for index, (queries, error) in zip(indexes, generated):
+            if error is not None:
+                fail(index, error)
+                continue
+            experiment_id, kpi_settings = items[index]['experiment_id'], items[index]['kpi_settings']
+            reaction_query, report_query = queries
+            kpi = kpis.get(experiment_id)
+            if kpi:
+                kpi.kpi_settings = kpi_settings
+                kpi.updated_by = g.user.user_id
+                kpi.reaction_query, kpi.report_query = reaction_query, report_query
+                kpi.if_custom_reaction_query = False
+                kpi.if_custom_report_query = False
+                results[index]['status'] = 'updated'
+            else:
+                experiment = experiments[experiment_id]
+                kpi = Kpi(name=experiment.project.name + '_' + str(experiment_id) + '_' + 'kpi',
+                          experiment_id=experiment_id,
+                          created_by=g.user.user_id,
+                          updated_by=g.user.user_id,
+                          reaction_query=reaction_query,
+                          report_query=report_query,
+                          kpi_settings=kpi_settings,
+                          project_id=experiment.project_id)
+                db.session.add(kpi)
+                new_kpis[index] = kpi
+                results[index]['status'] = 'created'
+            results[index]['kpi'] = kpi
+
+        try:
+            db.session.flush()
+            for index, kpi in new_kpis.items():
+                experiments[items[index]['experiment_id']].kpi_id = kpi.kpi_id
+            # read before the commit expires the kpis, afterwards every kpi_id would refresh its kpi by a SELECT
+            for result in results:
+                kpi = result.pop('kpi', None)
+                if kpi is not None:
+                    result['kpiId'] = kpi.kpi_id
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(str(e))
+            raise ValidationError("Unable to save kpis due to : {}".format(str(e)))
+
+        return {
+            'created': sum(1 for result in results if result['status'] == 'created'),
+            'updated': sum(1 for result in results if result['status'] == 'updated'),
+            'failed': sum(1 for result in results if result['status'] == 'failed'),
+            'results': results
+        }, 200
+
+
 class KpiQueryCollectionResource(Resource):
     """ mapping to /v2/experiments/:experimentId/kpis/{type}_query """
 
@@ -211,8 +515,7 @@ class KpiQueryCollectionResource(Resource):
     @auth.login_required
     def put(self, experiment_id, type):
         validators.check_id_format(experiment_id)
-        validators.check_experiment_id_integrity(experiment_id)
-        experiment = Experiment.query.filter_by(experiment_id=experiment_id).one()
+        experiment = validators.check_experiment_id_integrity(experiment_id)
         validators.check_permission(project_id=experiment.project_id, user_id=g.user.user_id, module='kpi',
                                     function='editQuery')
         kpi = Kpi.query.filter(Kpi.experiment_id == experiment_id).one_or_none()
@@ -238,13 +541,77 @@ class KpiReactionQueryResource(Resource):
 
     @auth.login_required
     def post(self, experiment_id):
+        if is_async_requested():
+            return submit_query_job('reaction_query', experiment_id)
         kpi = Kpi.query.filter(Kpi.experiment_id == experiment_id).one_or_none()
         if kpi:
             setattr(kpi, 'reaction_query', generate_reaction_query(experiment_id, kpi.kpi_settings))
             db.session.commit()
         return None, 200
 
+
+class QueryJobResource(Resource):
+    """ mapping to /v2/experiments/:experimentId/query_jobs/:jobId """
+
+    @auth.login_required
+    def get(self, experiment_id, job_id):
+        validators.check_id_format(experiment_id)
+        experiment = validators.check_experiment_id_integrity(experiment_id)
+        # the same permission as the requests starting the jobs
+        validators.check_permission(project_id=experiment.project_id, user_id=g.user.user_id, module='kpi',
+                                    function='edit')
+        job = get_job_queue().get(job_id)
+        if not job or str(job['kwargs'].get('experiment_id')) != str(experiment_id):
+            msg = "The query job with given ID {} does not exist.".format(job_id)
+            logger.error(msg)
+            raise DataNotFoundError(msg)
+        res = format_job(job)
+        res['experimentId'] = experiment_id
+        return res, 200
+
+
+class KpiQueryRerenderResource(Resource):
+    """ mapping to /v2/organizations/:organizationId/kpi_queries/rerender
+    and /v2/projects/:projectId/kpi_queries/rerender """
+
+    @auth.login_required
+    @system_admin_restricted
+    def post(self, organization_id=None, project_id=None):
+        """regenerate the queries of every kpi of the organization or project which are not customized"""
+        if organization_id is not None:
+            validators.check_id_format(organization_id)
+            validators.check_organization_id_integrity(organization_id)
+        if project_id is not None:
+            validators.check_id_format(project_id)
+            validators.check_project_id_integrity(project_id)
+        job = get_shared_job_queue().submit('rerender_kpi_queries', organisation_id=organization_id,
+                                            project_id=project_id)
+        return {
+            'jobId': job['id'],
+            'status': job['status']
+        }, 202, {'Location': api.url_for(KpiQueryRerenderJobResource, job_id=job['id'])}
+
+
+class KpiQueryRerenderJobResource(Resource):
+    """ mapping to /v2/kpi_queries/rerender/:jobId """
+
+    @auth.login_required
+    @system_admin_restricted
+    def get(self, job_id):
+        job = get_job_queue().get(job_id)
+        if not job or job['name'] != 'rerender_kpi_queries':
+            msg = "The rerender job with given ID {} does not exist.".format(job_id)
+            logger.error(msg)
+            raise DataNotFoundError(msg)
+        return format_job(job), 200
+
+
 api.add_resource(KpiCollectionFetchResource, '/v1/projects/<project_id>/kpis')
 api.add_resource(KpiCollectionResource, '/v2/experiments/<experiment_id>/kpis')
+api.add_resource(KpiBulkResource, '/v2/kpis/bulk')
 api.add_resource(KpiQueryCollectionResource, '/v2/experiments/<experiment_id>/kpis/<type>_query')
 api.add_resource(KpiReactionQueryResource, '/v2/experiments/<experiment_id>/reaction_query')
+api.add_resource(QueryJobResource, '/v2/experiments/<experiment_id>/query_jobs/<job_id>')
+api.add_resource(KpiQueryRerenderResource, '/v2/organizations/<organization_id>/kpi_queries/rerender',
+                 '/v2/projects/<project_id>/kpi_queries/rerender')
+api.add_resource(KpiQueryRerenderJobResource, '/v2/kpi_queries/rerender/<job_id>')
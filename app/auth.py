@@ -1,21 +1,38 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Token generation and verification by lib itsdangerous (https://pythonhosted.org/itsdangerous)."""
+import hashlib
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from functools import wraps
 
 import ldap
+import six
 from flask import g
 from itsdangerous import JSONWebSignatureSerializer as JWSSerializer, SignatureExpired, BadSignature
+from sqlalchemy import and_, event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from app.configs import CONFIG
 from app.customerrors import AuthenticationFailedError, DataNotFoundError
+from app.helpers import TTLCache
+from app.models.organization import Organization, UserRoleOrganization
+from app.models.role import Role
 from app.models.user import User
-from extensions import auth
+from extensions import auth, cache, db
 
 from loggers import CustomLogger
 
 logger = CustomLogger(__name__)
 tokenizer = JWSSerializer(CONFIG.SECRET_KEY)
+# verified token digest => (column values of the resolved user, permission claims of the token, version stamp
+# of the user when it was read), saves the signature check and the user query
+token_cache = TTLCache(maxsize=getattr(CONFIG, 'AUTH_TOKEN_CACHE_SIZE', 1024),
+                       ttl=getattr(CONFIG, 'AUTH_TOKEN_CACHE_TTL', 300))
 
 
 def generate_auth_token(payload):
@@ -27,6 +44,156 @@ def generate_auth_token(payload):
     return tokenizer.dumps(obj=payload, header_fields={'typ': 'JWT'})
 
 
+def issue_auth_token(payload, user):
+    """the auth token the login issues to the user, with permission claims if AUTH_TOKEN_PERMISSION_CLAIMS is set.
+    The claims need a Flask-Cache backend shared by the workers (e.g. redis) which keeps the version stamps.
+    :param payload: dict
+    :param user: User model the token is issued to
+    :return: string
+    """
+    if getattr(CONFIG, 'AUTH_TOKEN_PERMISSION_CLAIMS', False):
+        return generate_auth_token_with_claims(payload, user)
+    return generate_auth_token(payload)
+
+
+def generate_auth_token_with_claims(payload, user):
+    """generate auth token which also carries the permissions of the user as signed claims,
+    so check_permission() and system_admin_restricted() can decide without querying the DB.
+    :param payload: dict
+    :param user: User model the token is issued to
+    :return: string, a token without claims if the cache backend doesn't keep the version stamps
+    """
+    claims = build_permission_claims(user)
+    if None in claims['ver'].values():
+        logger.warning("The cache does not keep permission version stamps, the token is issued without claims.")
+        return generate_auth_token(payload)
+    return generate_auth_token(dict(payload, claims=claims))
+
+
+def build_permission_claims(user):
+    """
+    permission claims of the user:
+        sa: system_admin flag
+        orgs: organisation ID (as string, it's a JSON key) => permissions of the user's role in the organisation
+        ver: version stamps of the user, roles and organisations the claims were built from
+    """
+    rows = db.session.query(UserRoleOrganization.organisation_id, Role.role_id, Role.permissions) \
+        .join(Role, and_(Role.role_id == UserRoleOrganization.role_id, Role.delete_flag == False)) \
+        .join(Organization, and_(Organization.organisation_id == UserRoleOrganization.organisation_id,
+                                 Organization.delete_flag == False)) \
+        .filter(UserRoleOrganization.user_id == user.user_id, UserRoleOrganization.delete_flag == 0).all()
+    version_keys = [_version_key('user', user.user_id)]
+    version_keys += [_version_key('role', role_id) for _, role_id, _ in rows]
+    version_keys += [_version_key('org', organisation_id) for organisation_id, _, _ in rows]
+    return {
+        'sa': bool(user.system_admin),
+        'orgs': {str(organisation_id): permissions for organisation_id, _, permissions in rows},
+        'ver': dict((key, _ensure_version(key)) for key in set(version_keys))
+    }
+
+
+def _version_key(kind, id_):
+    return 'auth:permissions_version:{0}:{1}'.format(kind, id_)
+
+
+def _current_versions(keys):
+    """version stamps stored in the shared cache, None for a missing one"""
+    keys = sorted(set(keys))
+    return dict(zip(keys, cache.get_many(*keys)))
+
+
+def get_permissions_version(kind, id_):
+    """the version stamp of the user/role/org/project, None if the cache doesn't keep it"""
+    return _ensure_version(_version_key(kind, id_))
+
+
+def _ensure_version(key):
+    """the version stamp stored under the key, created by cache.add() if there is none yet, None if the cache
+    doesn't keep it"""
+    cache.add(key, uuid.uuid4().hex, timeout=0)
+    return cache.get(key)
+
+
+def bump_permissions_version(kind, id_):
+    """Mark the claims built from the given user/role/org/project as stale, tokens carrying them get rejected.
+    Bumping a user also drops its cached tokens in every worker, see verify_auth_token().
+    The stamps live in the Flask-Cache backend, which has to be shared by the workers (e.g. redis)
+    for a bump to reach all of them."""
+    cache.set(_version_key(kind, id_), uuid.uuid4().hex, timeout=0)
+
+
+def bump_permissions_version_after_commit(target, kind, id_):
+    """
+    bump the version stamp once the change of the target is committed, bumped earlier another request could still
+    read the old row and cache it, or build claims from it, under the new stamp
+    """
+    session = object_session(target)
+    if session is None:
+        bump_permissions_version(kind, id_)
+    else:
+        session.info.setdefault('_permissions_version_bumps', set()).add((kind, id_))
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_committed_versions(session):
+    for kind, id_ in session.info.pop('_permissions_version_bumps', ()):
+        if kind == 'user':
+            invalidate_cached_user(id_)
+        else:
+            bump_permissions_version(kind, id_)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_version_bumps(session):
+    session.info.pop('_permissions_version_bumps', None)
+
+
+@event.listens_for(Role.permissions, 'set')
+@event.listens_for(Role.delete_flag, 'set')
+def _bump_role_version(target, value, oldvalue, initiator):
+    if value != oldvalue and target.role_id is not None:
+        bump_permissions_version_after_commit(target, 'role', target.role_id)
+
+
+@event.listens_for(UserRoleOrganization.role_id, 'set')
+@event.listens_for(UserRoleOrganization.delete_flag, 'set')
+def _bump_user_version(target, value, oldvalue, initiator):
+    if value != oldvalue and target.user_id is not None:
+        bump_permissions_version_after_commit(target, 'user', target.user_id)
+
+
+@event.listens_for(Organization.delete_flag, 'set')
+def _bump_organization_version(target, value, oldvalue, initiator):
+    if value != oldvalue and target.organisation_id is not None:
+        bump_permissions_version_after_commit(target, 'org', target.organisation_id)
+
+
+# rows removed by session.delete() don't go through the attribute events
+@event.listens_for(Role, 'after_delete')
+def _bump_deleted_role_version(mapper, connection, target):
+    bump_permissions_version_after_commit(target, 'role', target.role_id)
+
+
+@event.listens_for(UserRoleOrganization, 'after_delete')
+@event.listens_for(User, 'after_delete')
+def _bump_deleted_user_version(mapper, connection, target):
+    bump_permissions_version_after_commit(target, 'user', target.user_id)
+
+
+@event.listens_for(Organization, 'after_delete')
+def _bump_deleted_organization_version(mapper, connection, target):
+    bump_permissions_version_after_commit(target, 'org', target.organisation_id)
+
+
+def _check_claims_version(token, claims):
+    versions = claims.get('ver') or {}
+    # a stamp evicted or flushed from the cache may have been bumped, so a missing one is stale as well
+    current = _current_versions(versions.keys()) if versions else {}
+    if not current or None in current.values() or current != versions:
+        token_cache.pop(_token_digest(token))
+        raise AuthenticationFailedError("The permissions in your token are outdated, please login again.")
+
+
 @auth.verify_token
 def verify_auth_token(token):
     """Decode the authentication token and get user_id from it"""
@@ -38,20 +205,79 @@ def verify_auth_token(token):
 
         return True  # for unit test
 
+    digest = _token_digest(token)
+    cached = token_cache.get(digest)
+    if cached is not None:
+        snapshot, claims, version = cached
+        # the user may have been deleted or changed by another worker since it was cached
+        if cache.get(_version_key('user', snapshot['user_id'])) == version:
+            if claims:
+                _check_claims_version(token, claims)
+            g.user = _user_from_snapshot(snapshot)
+            g.permission_claims = claims
+            return True
+        token_cache.pop(digest)
+
     try:
         data = tokenizer.loads(token)
     except (SignatureExpired, BadSignature):
         raise AuthenticationFailedError("The token {} is invalid.".format(token))
 
+    claims = data.get('claims')
+    if claims:
+        _check_claims_version(token, claims)
+
+    # read before the user, so a change committed in between leaves the cached user stale
+    version = _ensure_version(_version_key('user', data.get('user_id')))
     user = User.query.filter(User.user_id == data.get('user_id'), User.delete_flg == False).one_or_none()
     if user:
         g.user = user
+        g.permission_claims = claims
+        if version is not None:
+            token_cache.set(digest, (_user_snapshot(user), claims, version))
     else:
         raise AuthenticationFailedError("The user {} does not exist.".format(data['user_id']))
 
     return True
 
 
+def invalidate_cached_user(user_id):
+    """Drop every cached token of the user in all workers, must be called when the user is deleted or loses/gains
+    admin rights by a way which bypasses the ORM events, e.g. Query.update() or Query.delete()."""
+    bump_permissions_version('user', user_id)
+    removed = token_cache.discard_if(lambda digest, cached: cached[0]['user_id'] == user_id)
+    if removed:
+        logger.debug("Invalidated {0} cached token(s) of user {1}".format(removed, user_id))
+    return removed
+
+
+@event.listens_for(User.delete_flg, 'set')
+@event.listens_for(User.system_admin, 'set')
+def _invalidate_cached_user_on_change(target, value, oldvalue, initiator):
+    if value != oldvalue and target.user_id is not None:
+        bump_permissions_version_after_commit(target, 'user', target.user_id)
+
+
+def _token_digest(token):
+    if isinstance(token, six.text_type):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+def _user_snapshot(user):
+    """plain column values of the user, which are safe to share between requests and sessions"""
+    return {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+
+
+def _user_from_snapshot(snapshot):
+    """rebuild the user from its cached column values and attach it to the current session without any query"""
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in snapshot.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
 def system_admin_restricted(func):
     """Decelerator for authenticate if the user try to get info which his/her role does not allow to do."""
 
@@ -59,13 +285,174 @@ def system_admin_restricted(func):
     def wrapper(*args, **kwargs):
         if not g.user:
             raise AuthenticationFailedError("You have to authenticate by your token first.")
-        if not g.user.system_admin:
+        claims = getattr(g, 'permission_claims', None)
+        system_admin = claims['sa'] if claims else g.user.system_admin
+        if not system_admin:
             raise AuthenticationFailedError("This function only allowed system administrator to use.")
         return func(*args, **kwargs)
 
     return wrapper
 
 
+class LDAPConnectionPool(object):
+    """Bounded pool of LDAP connections to one directory server.
+    Connections used for binds are handed out by connection() and re-bound by the next login, so the TCP/TLS
+    handshake is paid once per connection instead of once per login. Idle connections are evicted after
+    idle_timeout seconds and connections idle for more than check_interval seconds are health checked
+    by a whoami request before being reused. Searches go through a separate anonymous service connection,
+    so they never run with the identity of the last user who logged in."""
+
+    BROKEN_CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT)
+
+    def __init__(self, url, max_size=10, idle_timeout=300, check_interval=30, wait_timeout=10):
+        self.url = url
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self.pid = os.getpid()
+        self._idle = []  # (connection, last used time), most recently used at the end
+        self._size = 0  # number of bind connections currently open, idle or in use
+        self._cond = threading.Condition()
+        self._service = None
+        self._service_last_used = 0
+        self._service_lock = threading.Lock()
+
+    def _connect(self):
+        conn = ldap.initialize(self.url)
+        conn.protocol_version = ldap.VERSION3
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _is_healthy(self, conn, last_used):
+        if time.time() - last_used < self.check_interval:
+            return True
+        try:
+            conn.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def _evict_idle(self):
+        """close the connections idle for too long, must be called with self._cond held"""
+        expire_before = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < expire_before:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self._close(conn)
+
+    def acquire(self):
+        deadline = time.time() + self.wait_timeout
+        with self._cond:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AuthenticationFailedError("No LDAP connection available, please retry later.")
+                self._cond.wait(remaining)
+        if conn is not None and not self._is_healthy(conn, last_used):
+            logger.debug("Dropped unhealthy LDAP connection to {}".format(self.url))
+            self._close(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._discard()
+                raise
+        return conn
+
+    def release(self, conn, broken=False):
+        if broken:
+            self._close(conn)
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._evict_idle()
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except self.BROKEN_CONNECTION_ERRORS:
+            self.release(conn, broken=True)
+            raise
+        except Exception:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        """search through the shared anonymous service connection, reconnect once if it has gone away"""
+        with self._service_lock:
+            for retry in (False, True):
+                if self._service is None or retry or not self._is_healthy(self._service, self._service_last_used):
+                    if self._service is not None:
+                        self._close(self._service)
+                    self._service = self._connect()
+                try:
+                    result = self._service.search_s(base, scope, filterstr, attrlist)
+                    self._service_last_used = time.time()
+                    return result
+                except self.BROKEN_CONNECTION_ERRORS:
+                    if retry:
+                        self._service = None
+                        raise
+                    logger.warning("LDAP service connection to {} lost, reconnecting".format(self.url))
+
+    def close(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+        with self._service_lock:
+            if self._service is not None:
+                self._close(self._service)
+                self._service = None
+
+
+_ldap_pools = {}
+_ldap_pools_lock = threading.Lock()
+
+
+def get_ldap_pool(url):
+    """Return the connection pool of the given server shared by this worker process.
+    A pool inherited through fork is never reused, as its sockets belong to the parent process."""
+    with _ldap_pools_lock:
+        pool = _ldap_pools.get(url)
+        if pool is None or pool.pid != os.getpid():
+            pool = LDAPConnectionPool(url,
+                                      max_size=getattr(CONFIG, 'LDAP_POOL_SIZE', 10),
+                                      idle_timeout=getattr(CONFIG, 'LDAP_POOL_IDLE_TIMEOUT', 300),
+                                      check_interval=getattr(CONFIG, 'LDAP_POOL_CHECK_INTERVAL', 30),
+                                      wait_timeout=getattr(CONFIG, 'LDAP_POOL_WAIT_TIMEOUT', 10))
+            _ldap_pools[url] = pool
+        return pool
+
+
 class LDAPClient(object):
     """LDAP Client
     Attention: UID here is a short account.
@@ -75,13 +462,12 @@ class LDAPClient(object):
     def __init__(self, url, base_dn):
         self.url = url
         self.base_dn = base_dn
-        self.client = ldap.initialize(url)
-        self.client.protocol_version = ldap.VERSION3
+        self.pool = get_ldap_pool(url)
         logger.debug("Initialized LDAP client, url=({0}), base_dn=({1})".format(url, base_dn))
 
     def _search(self, search_dn, search_cn):
         logger.debug("LDAP search {0}, for {1}".format(search_dn, search_cn))
-        raw_list = self.client.search_s(search_dn, ldap.SCOPE_SUBTREE, search_cn, None)
+        raw_list = self.pool.search_s(search_dn, ldap.SCOPE_SUBTREE, search_cn, None)
         return raw_list
 
     def search_one_person(self, account):
@@ -98,7 +484,8 @@ class LDAPClient(object):
     def authenticate(self, dn, password):
         try:
             logger.debug("calling LDAP to authenticate for {}".format(dn))
-            self.client.simple_bind_s(dn, password)
+            with self.pool.connection() as conn:
+                conn.simple_bind_s(dn, password)
         except Exception as e:
             logger.warning(e.message)
             raise AuthenticationFailedError("LDAP authentication failed.")
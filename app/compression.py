@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Accept-Encoding negotiated compression of the API responses, which are mostly JSON with big hive queries.
+brotli is used if the client accepts it and the brotli package is installed, else gzip.
+
+    COMPRESSION_ENABLED        - compress at all, True by default
+    COMPRESSION_MIN_SIZE       - smaller bodies are sent as they are, 1024 bytes by default
+    COMPRESSION_LEVEL          - gzip level 1-9, 6 by default
+    COMPRESSION_BROTLI_QUALITY - brotli quality 0-11, 4 by default
+"""
+
+import zlib
+
+import six
+
+from app.configs import CONFIG
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# gzip header and trailer instead of the zlib ones
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def choose_encoding(accept_encodings):
+    """
+    :param accept_encodings: werkzeug Accept of the Accept-Encoding header, e.g. request.accept_encodings
+    :return: 'br', 'gzip' or None
+    """
+    candidates = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = max(candidates, key=lambda encoding: accept_encodings.quality(encoding))
+    return best if accept_encodings.quality(best) > 0 else None
+
+
+def compress(data, encoding, level=None):
+    """compress the bytes by the encoding, at the configured level unless given"""
+    if encoding == 'br':
+        quality = getattr(CONFIG, 'COMPRESSION_BROTLI_QUALITY', 4) if level is None else level
+        return brotli.compress(data, quality=quality)
+    compressor = zlib.compressobj(getattr(CONFIG, 'COMPRESSION_LEVEL', 6) if level is None else level,
+                                  zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_compressed(chunks, encoding, level=None):
+    """compress a streamed body chunk by chunk, every chunk is flushed so the client can decode it right away"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=getattr(CONFIG, 'COMPRESSION_BROTLI_QUALITY', 4)
+                                       if level is None else level)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(getattr(CONFIG, 'COMPRESSION_LEVEL', 6) if level is None else level,
+                                      zlib.DEFLATED, _GZIP_WBITS)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode('utf-8')
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # e.g. ends the request context kept by stream_with_context()
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(resp, accept_encodings):
+    """
+    compress the body of a successful response by the encoding the client prefers, unless it's smaller than
+    COMPRESSION_MIN_SIZE. Error responses are small and left as they are.
+    :param resp: Flask response
+    :param accept_encodings: werkzeug Accept of the Accept-Encoding header
+    :return: the response
+    """
+    if not getattr(CONFIG, 'COMPRESSION_ENABLED', True) or not 200 <= resp.status_code < 300 \
+            or resp.status_code == 204 or 'Content-Encoding' in resp.headers:
+        return resp
+    if not resp.is_streamed and resp.content_length < getattr(CONFIG, 'COMPRESSION_MIN_SIZE', 1024):
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return resp
+    if resp.is_streamed:
+        resp.response = iter_compressed(resp.response, encoding)
+        resp.headers.pop('Content-Length', None)
+    else:
+        resp.set_data(compress(resp.get_data(), encoding))
+    resp.headers['Content-Encoding'] = encoding
+    return resp
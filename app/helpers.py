@@ -4,6 +4,11 @@
 
 import base64
 import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
 import requests
 
 from Crypto.Cipher import AES
@@ -52,3 +57,94 @@ class AesEbc(object):
             return re.compile('[\\x00-\\x08\\x0b-\\x0c\\x0e-\\x1f\n\r\t]').sub('', decrypted.decode())
         except Exception:
             raise ValueError("inputted value: {} can not be decrypted.".format(text))
+
+
+class TTLCache(object):
+    """Bounded, thread-safe LRU cache whose entries expire after `ttl` seconds.
+    It lives in the worker process, so each gunicorn worker keeps its own copy.
+    A cache built with ttl <= 0 or maxsize <= 0 is disabled and never stores anything.
+    With maxbytes > 0 the least recently used entries are also evicted while the sizes of the values, measured by
+    `sizeof` (sys.getsizeof by default, which is the size of a string but not of what a container refers to), add up
+    to more than maxbytes, and a value bigger than maxbytes alone is not stored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, maxbytes=0, sizeof=sys.getsizeof):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def _pop(self, key):
+        """remove the entry of the key and return it, or None, the lock must be held"""
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+        return item
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._pop(key)
+            if item is None or item[1] < time.time():
+                self.misses += 1
+                return default
+            # re-insert to mark the entry as the most recently used one
+            self._data[key] = item
+            self._bytes += item[2]
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return
+        size = self.sizeof(value) if self.maxbytes > 0 else 0
+        with self._lock:
+            self._pop(key)
+            if self.maxbytes > 0 and size > self.maxbytes:
+                return
+            self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl), size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes > 0 and self._bytes > self.maxbytes):
+                self._bytes -= self._data.popitem(last=False)[1][2]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._pop(key)
+        return default if item is None else item[0]
+
+    def discard_if(self, predicate):
+        """remove every entry for which predicate(key, value) is true, return the number of removed entries."""
+        with self._lock:
+            keys = [k for k, item in self._data.items() if predicate(k, item[0])]
+            for k in keys:
+                self._pop(k)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'bytes': self._bytes,
+            'maxbytes': self.maxbytes,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': float(self.hits) / lookups if lookups else 0.0
+        }
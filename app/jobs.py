@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Background jobs for work too slow to be done inside a request, e.g. the regeneration of hive queries.
+A job is a registered handler name plus JSON serializable keyword arguments. The request enqueues it and
+returns its id, a pool of worker threads runs it in an app context and records the result or the error.
+
+Two queue backends are available, chosen by CONFIG.JOB_BACKEND:
+    'inprocess' - queue and job states live in the worker process, the default. A status request may reach
+                  another gunicorn worker, so the API refuses to start jobs on it, see get_shared_job_queue()
+    'redis'     - queue and job states live in redis (CONFIG.JOB_REDIS_URL), shared by every process,
+                  jobs can also be run by separate processes through `python manage.py job_worker`,
+                  with JOB_WORKERS = 0 the web processes leave all of them to those
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from Queue import Queue, Empty
+
+from app.configs import CONFIG
+from app.helpers import TTLCache
+from app.loggers import CustomLogger
+
+logger = CustomLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+_handlers = {}
+
+
+def register_job(name):
+    """
+    decorator registering a function as the handler of the jobs with the given name
+    :param name: job name
+    """
+
+    def wrapper(func):
+        _handlers[name] = func
+        return func
+
+    return wrapper
+
+
+def report_job_progress(progress):
+    """
+    record the progress of the job running in the current app context, does nothing outside of a job
+    :param progress: JSON serializable progress, returned as `progress` by the job state
+    """
+    from flask import g
+
+    job = getattr(g, 'job', None)
+    if job is not None:
+        backend, job_id = job
+        backend.update(job_id, progress=progress)
+
+
+class InProcessJobBackend(object):
+    """job queue and job states kept in the memory of the process"""
+
+    # seen by this process only
+    shared = False
+
+    def __init__(self, result_ttl=24 * 60 * 60, max_jobs=10000):
+        self._queue = Queue()
+        self._jobs = TTLCache(maxsize=max_jobs, ttl=result_ttl)
+
+    def push(self, job):
+        self._jobs.set(job['id'], dict(job))
+        self._queue.put(job['id'])
+
+    def pop(self, timeout):
+        try:
+            job_id = self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+        return self.get(job_id)
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def update(self, job_id, **fields):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+            self._jobs.set(job_id, job)
+
+
+class RedisJobBackend(object):
+    """job queue and job states kept in redis, a job state is a JSON string expiring `result_ttl` seconds after
+    its last update"""
+
+    shared = True
+
+    def __init__(self, url, prefix='ghp:jobs', result_ttl=24 * 60 * 60):
+        import redis
+
+        self.client = redis.StrictRedis.from_url(url)
+        self.queue_key = '{}:queue'.format(prefix)
+        self.prefix = prefix
+        self.result_ttl = result_ttl
+
+    def _job_key(self, job_id):
+        return '{}:job:{}'.format(self.prefix, job_id)
+
+    def push(self, job):
+        pipeline = self.client.pipeline()
+        pipeline.set(self._job_key(job['id']), json.dumps(job), ex=self.result_ttl)
+        pipeline.lpush(self.queue_key, job['id'])
+        pipeline.execute()
+
+    def pop(self, timeout):
+        item = self.client.brpop(self.queue_key, timeout=max(int(timeout), 1))
+        if item is None:
+            return None
+        return self.get(item[1])
+
+    def get(self, job_id):
+        value = self.client.get(self._job_key(job_id))
+        return json.loads(value) if value else None
+
+    def update(self, job_id, **fields):
+        # a job is only updated by the worker which popped it, no need for a transaction
+        job = self.get(job_id)
+        if job is not None:
+            job.update(fields)
+            self.client.set(self._job_key(job_id), json.dumps(job), ex=self.result_ttl)
+
+
+class JobQueue(object):
+    """
+    Enqueues jobs to a backend and runs them by a pool of daemon threads. The threads are started lazily
+    by the first submit() of a process, so a pool is never inherited through fork.
+    """
+
+    def __init__(self, backend, workers=2, poll_timeout=1):
+        self.backend = backend
+        self.workers = workers
+        self.poll_timeout = poll_timeout
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, name, **kwargs):
+        """
+        enqueue a job, the handler registered with the name is called with the keyword arguments
+        :param name: job name
+        :return: job state
+        """
+        from flask import current_app
+
+        if name not in _handlers:
+            raise ValueError("No job handler is registered as {}.".format(name))
+        job = {
+            'id': uuid.uuid4().hex,
+            'name': name,
+            'kwargs': kwargs,
+            'status': PENDING,
+            'result': None,
+            'error': None,
+            'progress': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None
+        }
+        self.backend.push(job)
+        if self.workers > 0:
+            self.start(current_app._get_current_object())
+        return job
+
+    def get(self, job_id):
+        return self.backend.get(job_id)
+
+    def start(self, app):
+        """start the worker threads of this process unless they are running already"""
+        with self._lock:
+            if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+                return
+            self._pid = os.getpid()
+            self._threads = [threading.Thread(target=self.work, args=(app,), name='job-worker-{}'.format(i))
+                             for i in range(self.workers)]
+            for thread in self._threads:
+                thread.daemon = True
+                thread.start()
+
+    def work(self, app, burst=False):
+        """
+        run jobs until the process ends
+        :param app: flask app the jobs run in the context of
+        :param burst: return as soon as the queue is empty
+        """
+        while True:
+            job = self.backend.pop(self.poll_timeout)
+            if job is None:
+                if burst:
+                    return
+                continue
+            self.run(app, job)
+
+    def run(self, app, job):
+        from flask import g
+        from app.extensions import db
+
+        self.backend.update(job['id'], status=RUNNING, started_at=time.time())
+        with app.app_context():
+            g.job = (self.backend, job['id'])
+            try:
+                result = _handlers[job['name']](**job['kwargs'])
+                self.backend.update(job['id'], status=SUCCEEDED, result=result, finished_at=time.time())
+            except Exception as e:
+                db.session.rollback()
+                logger.error("job {} ({}) failed: {}".format(job['id'], job['name'], e))
+                self.backend.update(job['id'], status=FAILED, error=str(e), finished_at=time.time())
+            finally:
+                db.session.remove()
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Return the job queue configured by CONFIG.JOB_BACKEND, JOB_WORKERS, JOB_REDIS_URL and JOB_RESULT_TTL."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            result_ttl = getattr(CONFIG, 'JOB_RESULT_TTL', 24 * 60 * 60)
+            if getattr(CONFIG, 'JOB_BACKEND', 'inprocess') == 'redis':
+                backend = RedisJobBackend(CONFIG.JOB_REDIS_URL, result_ttl=result_ttl)
+            else:
+                backend = InProcessJobBackend(result_ttl=result_ttl)
+            _job_queue = JobQueue(backend, workers=getattr(CONFIG, 'JOB_WORKERS', 2))
+        return _job_queue
+
+
+def get_shared_job_queue():
+    """
+    the job queue for a job started by a request, whose status is polled by later requests which may reach any
+    worker process. Raise if the backend keeps the job states in one process only.
+    """
+    from jsonschema import ValidationError
+
+    queue = get_job_queue()
+    if not queue.backend.shared:
+        msg = "Background jobs are not available, they need the shared JOB_BACKEND 'redis'."
+        logger.error(msg)
+        raise ValidationError(msg)
+    return queue
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""JSON encoder backends of the API responses. The backend is chosen once per app by CONFIG.JSON_ENCODER:
+    'auto'       - the first available of 'rapidjson', 'simplejson' and 'json'
+    'rapidjson'  - python-rapidjson, Decimals are written as exact numbers
+    'simplejson' - simplejson with its C speedups, Decimals are written as exact numbers (use_decimal)
+    'json'       - the standard library, Decimals are written as exact numbers too
+The RESTFUL_JSON app config gives the options of the encoder (indent, sort_keys, default, ...). A backend not
+supporting one of them is skipped by 'auto'.
+python-rapidjson supports Python 3 only and is not in requirements.txt, so on Python 2.7 'auto' resolves to
+simplejson, the encoder the API used before.
+
+A collection response can also be streamed record by record, see stream_json_response().
+"""
+
+import re
+import uuid
+from decimal import Decimal
+
+from app.loggers import CustomLogger
+
+logger = CustomLogger(__name__)
+
+_RAPIDJSON_OPTIONS = ('indent', 'sort_keys', 'ensure_ascii', 'default')
+_STDLIB_OPTIONS = ('skipkeys', 'ensure_ascii', 'check_circular', 'allow_nan', 'indent', 'separators', 'encoding',
+                   'default', 'sort_keys')
+
+
+def _unsupported(settings, options):
+    return sorted(key for key in settings if key not in options)
+
+
+def _rapidjson_encoder(settings):
+    import rapidjson
+
+    unsupported = _unsupported(settings, _RAPIDJSON_OPTIONS)
+    if unsupported:
+        raise ValueError("rapidjson does not support the options {}.".format(', '.join(unsupported)))
+    return rapidjson.Encoder(number_mode=rapidjson.NM_DECIMAL | rapidjson.NM_NAN, **settings)
+
+
+def _simplejson_encoder(settings):
+    import simplejson
+
+    return simplejson.JSONEncoder(**settings).encode
+
+
+def _stdlib_encoder(settings):
+    import json
+
+    unsupported = _unsupported(settings, _STDLIB_OPTIONS)
+    if unsupported:
+        raise ValueError("json does not support the options {}.".format(', '.join(unsupported)))
+    settings = dict(settings)
+    default = settings.pop('default', None)
+    # json can't write a raw number, a Decimal is written as a marked string whose quotes are removed afterwards
+    marker = 'decimal-{}:'.format(uuid.uuid4().hex)
+    marked = re.compile('"{}([^"]*)"'.format(re.escape(marker)))
+
+    def encode_decimal(obj):
+        if isinstance(obj, Decimal):
+            # NaN and Infinity are written like floats, depending on allow_nan
+            return marker + str(obj) if obj.is_finite() else float(obj)
+        if default is not None:
+            return default(obj)
+        raise TypeError(repr(obj) + " is not JSON serializable")
+
+    encode = json.JSONEncoder(default=encode_decimal, **settings).encode
+
+    def encode_exact(obj):
+        text = encode(obj)
+        return marked.sub(r'\1', text) if marker in text else text
+
+    return encode_exact
+
+
+# in the order 'auto' tries them
+JSON_ENCODERS = (
+    ('rapidjson', _rapidjson_encoder),
+    ('simplejson', _simplejson_encoder),
+    ('json', _stdlib_encoder),
+)
+
+
+def build_json_encoder(backend='auto', settings=None):
+    """
+    :param backend: backend name or 'auto', see the module doc
+    :param settings: encoder options, e.g. the RESTFUL_JSON app config
+    :return: (backend name, function encoding an object to a JSON string)
+    """
+    settings = dict(settings or {})
+    names = [name for name, _ in JSON_ENCODERS]
+    if backend != 'auto' and backend not in names:
+        raise ValueError("Unknown JSON encoder {}, choose from auto, {}.".format(backend, ', '.join(names)))
+    for name, factory in JSON_ENCODERS:
+        if backend not in ('auto', name):
+            continue
+        try:
+            return name, factory(settings)
+        except (ImportError, ValueError) as e:
+            if backend != 'auto':
+                raise
+            logger.info("JSON encoder {} is not used: {}".format(name, e))
+    raise ValueError("No JSON encoder is available.")
+
+
+def init_json_encoder(app):
+    """
+    choose the JSON encoder of the app by its JSON_ENCODER and RESTFUL_JSON config, in debug mode the output is
+    indented and sorted unless configured otherwise
+    :return: function encoding an object to a JSON string
+    """
+    settings = dict(app.config.get('RESTFUL_JSON', {}))
+    if app.debug:
+        settings.setdefault('indent', 4)
+        settings.setdefault('sort_keys', True)
+    name, encode = build_json_encoder(app.config.get('JSON_ENCODER', 'auto'), settings)
+    logger.info("JSON encoder: {}".format(name))
+    app.extensions['json_encoder'] = (app.debug, encode)
+    return encode
+
+
+def get_json_encoder(app):
+    """the JSON encoder of the app, rebuilt if the debug mode changed since it was chosen, e.g. it's turned on by
+    `manage.py runserver -d` after the app was created"""
+    debug, encode = app.extensions.get('json_encoder', (None, None))
+    if debug is not app.debug:
+        encode = init_json_encoder(app)
+    return encode
+
+
+def iter_json_records(head, key, records, serialize, encode, chunk_size=64 * 1024):
+    """
+    yield the JSON of the dict head with the serialized records listed under the key, in chunks of about
+    chunk_size characters, so only one chunk of the records is in memory at a time
+    :param head: dict of the other keys of the response
+    :param key: key of the records
+    :param records: iterable of the records, e.g. a query with yield_per()
+    :param serialize: function converting a record to a JSON serializable object
+    :param encode: function encoding an object to a JSON string
+    :param chunk_size: number of characters
+    """
+    opening = encode(head).rstrip()
+    yield opening[:-1] + (', ' if head else '') + encode(key) + ': ['
+    chunk, size, separator = [], 0, ''
+    try:
+        for record in records:
+            part = separator + encode(serialize(record))
+            separator = ', '
+            chunk.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk, size = [], 0
+    except Exception as e:
+        # the status line is sent already, the client gets a truncated body
+        logger.error("streaming the {} of a response failed: {}".format(key, e))
+        raise
+    chunk.append(']}\n')
+    yield ''.join(chunk)
+
+
+def stream_json_response(head, key, records, serialize, code=200, headers=None):
+    """
+    a Flask response streaming a JSON collection, see iter_json_records(), compressed if the client accepts it.
+    The request context is kept until the records are consumed, so they can be read from a server side cursor of
+    the request's DB session.
+    """
+    from flask import Response, current_app, request, stream_with_context
+    from app.compression import compress_response
+
+    encode = get_json_encoder(current_app)
+    chunk_size = current_app.config.get('JSON_STREAM_CHUNK_SIZE', 64 * 1024)
+    resp = Response(stream_with_context(iter_json_records(head, key, records, serialize, encode, chunk_size)),
+                    status=code, mimetype='application/json')
+    resp.headers.extend(headers or {})
+    return compress_response(resp, request.accept_encodings)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Search values in a parsed JSON document (dicts, lists and scalars), either by key anywhere in the document
+or by a key path expression like `kpi_definitions[*].pattern_name`.
+
+Key path syntax:
+    name        value of the key in an object, `a.b` goes one level deeper
+    *           every value of an object or every item of an array
+    [n]         n-th item of an array, negative n counts from the end
+    [*]         every item of an array
+"""
+import re
+
+import six
+
+from app.configs import CONFIG
+from app.helpers import TTLCache
+
+_TOKEN_RE = re.compile(r'\[(\*|-?\d+)\]|\.?([^.\[\]]+)')
+
+
+def iter_values_by_key(document, keys):
+    """
+    yield the value of every member whose key is one of keys, depth first in document order.
+    The document is walked with an explicit stack, so deep documents never hit the recursion limit.
+    :param document: parsed JSON
+    :param keys: a key or a collection of keys
+    """
+    if isinstance(keys, six.string_types):
+        keys = (keys,)
+    keys = frozenset(keys)
+    stack = [iter([(None, document)])]
+    while stack:
+        try:
+            key, value = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if key is not None and key in keys:
+            yield value
+        if isinstance(value, dict):
+            stack.append(six.iteritems(value))
+        elif isinstance(value, (list, tuple)):
+            stack.append((None, item) for item in value)
+
+
+class KeyPath(object):
+    """compiled key path expression, see the module docstring for the syntax"""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.steps = self._parse(expression)
+
+    @staticmethod
+    def _parse(expression):
+        steps = []
+        position = 0
+        while position < len(expression):
+            match = _TOKEN_RE.match(expression, position)
+            if not match or (position == 0 and expression.startswith('.')):
+                raise ValueError("Invalid key path {} at position {}.".format(expression, position))
+            index, name = match.groups()
+            if index == '*' or name == '*':
+                steps.append(_wildcard)
+            elif index is not None:
+                steps.append(_item(int(index)))
+            else:
+                steps.append(_member(name))
+            position = match.end()
+        if not steps:
+            raise ValueError("Key path may not be empty.")
+        return steps
+
+    def find(self, document):
+        """generator of the values matching the path, in document order"""
+        nodes = iter([document])
+        for step in self.steps:
+            nodes = step(nodes)
+        return nodes
+
+    def first(self, document, default=None):
+        return next(self.find(document), default)
+
+    def __repr__(self):
+        return '<KeyPath {}>'.format(self.expression)
+
+
+def _member(name):
+    def step(nodes):
+        for node in nodes:
+            if isinstance(node, dict) and name in node:
+                yield node[name]
+
+    return step
+
+
+def _item(index):
+    def step(nodes):
+        for node in nodes:
+            if isinstance(node, (list, tuple)) and -len(node) <= index < len(node):
+                yield node[index]
+
+    return step
+
+
+def _wildcard(nodes):
+    for node in nodes:
+        if isinstance(node, dict):
+            for value in six.itervalues(node):
+                yield value
+        elif isinstance(node, (list, tuple)):
+            for item in node:
+                yield item
+
+
+# expression => KeyPath
+compiled_key_path_cache = TTLCache(maxsize=getattr(CONFIG, 'KEY_PATH_CACHE_SIZE', 256), ttl=24 * 60 * 60)
+
+
+def compile_key_path(expression):
+    """compiled KeyPath of the expression, kept in compiled_key_path_cache"""
+    key_path = compiled_key_path_cache.get(expression)
+    if key_path is None:
+        key_path = KeyPath(expression)
+        compiled_key_path_cache.set(expression, key_path)
+    return key_path
+
+
+def find_by_key_path(document, expression):
+    """generator of the values of the document matching the key path expression"""
+    return compile_key_path(expression).find(document)
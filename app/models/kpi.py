@@ -27,11 +27,17 @@ class Kpi(db.Model):
     if_custom_reaction_query = db.Column(db.Boolean, default=False)
     report_query = db.Column(db.Text)
     if_custom_report_query = db.Column(db.Boolean, default=False)
+    # incremented by every ORM update, lets a bulk write skip a kpi changed since it was read, see app.rerender
+    row_version = db.Column(db.Integer, nullable=False, server_default='1')
     # relationship
     experiment = db.relationship('Experiment', foreign_keys=experiment_id, uselist=False)
     editor = db.relationship('User', foreign_keys=updated_by, uselist=False)
     project = db.relationship('Project', foreign_keys=project_id, uselist=False)
 
+    __mapper_args__ = {
+        'version_id_col': row_version
+    }
+
     def __init__(self, **kwargs):
         """
         Using Flask SQLAlchemy's base model class to initialize the fields of the model
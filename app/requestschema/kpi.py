@@ -7,3 +7,22 @@ kpi_create_request_schema = {}
 kpi_update_request_schema = {}
 
 kpi_setting_schema = {}
+
+kpi_bulk_request_schema = {
+    "type": "object",
+    "properties": {
+        "items": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "experiment_id": {"type": "integer"},
+                    "kpi_settings": {"type": "object"}
+                },
+                "required": ["experiment_id", "kpi_settings"]
+            }
+        }
+    },
+    "required": ["items"]
+}
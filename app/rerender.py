@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Bulk re-render of the hive queries stored in the kpi table, e.g. after a template of the organisation settings
+has changed. Queries are rendered by a process pool, the results are written back by the calling process in
+batches, so the workers never write to the DB. A query is only written if its kpi is unchanged since it was read,
+a kpi customized or updated by a user meanwhile is kept as it is."""
+
+import multiprocessing
+import time
+
+from flask import current_app
+from sqlalchemy import and_, or_
+
+from app.extensions import db
+from app.loggers import CustomLogger
+from app.util import generate_kpi_queries
+
+logger = CustomLogger(__name__)
+
+_worker_app = None
+
+
+def _init_worker(app, forked=True):
+    global _worker_app
+    _worker_app = app
+    if forked:
+        # the connections inherited through fork belong to the parent process
+        with app.app_context():
+            db.engine.dispose()
+
+
+def _render_kpi(item):
+    """
+    render the queries of one kpi in a pool worker
+    :param item: (kpi_id, experiment_id, kpi_settings)
+    :return: (kpi_id, experiment_id, reaction_query, report_query, error message)
+    """
+    kpi_id, experiment_id, kpi_settings = item
+    with _worker_app.app_context():
+        try:
+            reaction_query, report_query = generate_kpi_queries(experiment_id, kpi_settings)
+            return kpi_id, experiment_id, reaction_query, report_query, None
+        except Exception as e:
+            return kpi_id, experiment_id, None, None, str(e) or e.__class__.__name__
+        finally:
+            db.session.remove()
+
+
+def find_rerender_targets(organisation_id=None, project_id=None):
+    """
+    :param organisation_id:
+    :param project_id:
+    :return: rows of the kpis which have at least one query not customized
+    """
+    from app.models.kpi import Kpi
+    from app.models.project import Project
+
+    query = db.session.query(Kpi.kpi_id, Kpi.experiment_id, Kpi.kpi_settings, Kpi.row_version,
+                             Kpi.if_custom_reaction_query, Kpi.if_custom_report_query) \
+        .filter(Kpi.delete_flg == False,
+                or_(Kpi.if_custom_reaction_query.isnot(True), Kpi.if_custom_report_query.isnot(True)))
+    if project_id is not None:
+        query = query.filter(Kpi.project_id == project_id)
+    if organisation_id is not None:
+        query = query.join(Project, Project.project_id == Kpi.project_id) \
+            .filter(Project.organisation_id == organisation_id)
+    return query.order_by(Kpi.kpi_id).all()
+
+
+def _write_query(kpi_id, seen_version, column, custom_flag, query):
+    """
+    write a rendered query unless the kpi was customized, updated or deleted since it was read.
+    The row_version is left as it is, so the other query of the kpi is still written under the version read.
+    :return: True if the query was written
+    """
+    from app.models.kpi import Kpi
+
+    statement = Kpi.__table__.update() \
+        .where(and_(Kpi.kpi_id == kpi_id, custom_flag.isnot(True), Kpi.delete_flg.isnot(True),
+                    Kpi.row_version == seen_version)) \
+        .values({column: query})
+    return db.session.execute(statement).rowcount > 0
+
+
+def rerender_kpi_queries(organisation_id=None, project_id=None, processes=None, batch_size=100, progress=None,
+                         max_errors=100):
+    """
+    regenerate the stored reaction/report queries of every kpi of an organisation or a project,
+    a query customized by the user (if_custom_*_query) is left as it is, as is a kpi changed during the run.
+    Don't use a process pool from a thread of a web worker, forking there isn't safe.
+    :param organisation_id:
+    :param project_id:
+    :param processes: size of the process pool, 0 renders in this process, the number of CPUs if None
+    :param batch_size: number of kpis updated per commit
+    :param progress: called as progress(summary) after every commit
+    :param max_errors: number of failed kpis listed in the summary
+    :return: summary dict with the counts, the errors and the throughput,
+        `skipped` counts the kpis with a query not written as the kpi changed during the run
+    """
+    from app.models.kpi import Kpi
+
+    started = time.time()
+    targets = find_rerender_targets(organisation_id=organisation_id, project_id=project_id)
+    seen = dict((row.kpi_id, (row.row_version, row.if_custom_reaction_query, row.if_custom_report_query))
+                for row in targets)
+    items = [(row.kpi_id, row.experiment_id, row.kpi_settings) for row in targets]
+    db.session.remove()
+
+    summary = {
+        'total': len(items),
+        'done': 0,
+        'updated': 0,
+        'skipped': 0,
+        'failed': 0,
+        'errors': [],
+        'elapsed': 0.0,
+        'throughput': 0.0
+    }
+
+    def flush(rendered):
+        for kpi_id, reaction_query, report_query in rendered:
+            version, custom_reaction, custom_report = seen[kpi_id]
+            written = []
+            if not custom_reaction:
+                written.append(_write_query(kpi_id, version, Kpi.reaction_query, Kpi.if_custom_reaction_query,
+                                            reaction_query))
+            if not custom_report:
+                written.append(_write_query(kpi_id, version, Kpi.report_query, Kpi.if_custom_report_query,
+                                            report_query))
+            if all(written):
+                summary['updated'] += 1
+            else:
+                summary['skipped'] += 1
+        if rendered:
+            db.session.commit()
+            del rendered[:]
+        summary['elapsed'] = time.time() - started
+        summary['throughput'] = summary['done'] / summary['elapsed'] if summary['elapsed'] else 0.0
+        if progress:
+            progress(summary)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes > 0 and len(items) > 1:
+        app = current_app._get_current_object()
+        db.engine.dispose()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(app,))
+        results = pool.imap_unordered(_render_kpi, items, chunksize=max(1, min(batch_size, len(items) // processes)))
+    else:
+        _init_worker(current_app._get_current_object(), forked=False)
+        results = (_render_kpi(item) for item in items)
+
+    rendered = []
+    try:
+        for kpi_id, experiment_id, reaction_query, report_query, error in results:
+            summary['done'] += 1
+            if error is not None:
+                summary['failed'] += 1
+                logger.error("queries of kpi {} (experiment {}) could not be rendered: {}".format(kpi_id,
+                                                                                                 experiment_id, error))
+                if len(summary['errors']) < max_errors:
+                    summary['errors'].append({'kpiId': kpi_id, 'experimentId': experiment_id, 'error': error})
+            else:
+                rendered.append((kpi_id, reaction_query, report_query))
+            if summary['done'] % batch_size == 0:
+                flush(rendered)
+        if summary['done'] % batch_size or not items:
+            flush(rendered)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return summary
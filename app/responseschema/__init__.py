@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Common meta data response model schema."""
+import copy
+from functools import wraps
+
 import six
-from flask_restful import fields, marshal
+from flask import request
+from flask_restful import fields, marshal, marshal_with, unpack
+from flask_restful.utils import OrderedDict
+from jsonschema import ValidationError
+
+from app.configs import CONFIG
+from app.helpers import TTLCache
+from app.jsonencoders import stream_json_response
+from app.util import datetime2str, get_request_memo
 
-from app.util import datetime2str
+# id of a schema => (schema, serializer function), see compile_schema()
+compiled_schema_cache = TTLCache(maxsize=getattr(CONFIG, 'COMPILED_SCHEMA_CACHE_SIZE', 512), ttl=24 * 60 * 60)
+
+# (id of a schema, records key, requested fields) => (schema, trimmed schema)
+sparse_schema_cache = TTLCache(maxsize=getattr(CONFIG, 'SPARSE_SCHEMA_CACHE_SIZE', 256), ttl=24 * 60 * 60)
 
 pagination_link_meta_data = {
     'prev': fields.String,
@@ -18,6 +33,16 @@ pagination_meta_data = {
     "perPage": fields.Integer,
     "pages": fields.Integer,
     "total": fields.Integer,
+    "totalApproximate": fields.Boolean(default=False),
+    "links": fields.Nested(pagination_link_meta_data)
+}
+
+cursor_pagination_meta_data = {
+    "perPage": fields.Integer,
+    "total": fields.Integer,
+    "totalApproximate": fields.Boolean(default=False),
+    "cursor": fields.String,
+    "nextCursor": fields.String,
     "links": fields.Nested(pagination_link_meta_data)
 }
 
@@ -41,6 +66,24 @@ class NestedWithEmpty(fields.Nested):
         return marshal(value, self.nested)
 
 
+class FieldsPagination(fields.Nested):
+    """
+    pagination of build_pagination_response(), marshaled by pagination_meta_data in the page mode and by
+    cursor_pagination_meta_data in the cursor mode, told apart by the `cursor` key of the data
+    """
+
+    def __init__(self, nested=pagination_meta_data, cursor_nested=cursor_pagination_meta_data, **kwargs):
+        super(FieldsPagination, self).__init__(nested, **kwargs)
+        self.cursor_nested = cursor_nested
+
+    def output(self, key, obj):
+        value = fields.get_value(key if self.attribute is None else self.attribute, obj)
+        if value is None and self.allow_null:
+            return None
+        schema = self.cursor_nested if isinstance(value, dict) and 'cursor' in value else self.nested
+        return compile_schema(schema)(value)
+
+
 class FieldsStringToUpperCase(fields.Raw):
     def format(self, value):
         """enum value should be upper case, in case they got stored as lower case in DB."""
@@ -69,3 +112,233 @@ class FieldsISODateTime(fields.DateTime):
 
     def format(self, value):
         return datetime2str(value)
+
+
+def _get_item(obj, key, default=None):
+    """fields.get_value() of a single key for an indexable object"""
+    try:
+        return obj[key]
+    except (IndexError, TypeError, KeyError):
+        return getattr(obj, key, default)
+
+
+def _is_inherited(field, name, base):
+    return six.get_unbound_function(getattr(type(field), name)) is six.get_unbound_function(getattr(base, name))
+
+
+def _compile_field(key, field, index, namespace, lines):
+    """append the source lines assigning the output of one field to r<index>"""
+    value, result = 'v{}'.format(index), 'r{}'.format(index)
+    if isinstance(field, dict):
+        namespace['s{}'.format(index)] = compile_schema(field)
+        lines.append('    {} = s{}(obj)'.format(result, index))
+        return
+    if isinstance(field, type):
+        field = field()
+    namespace['f{}'.format(index)] = field
+    if not (_is_inherited(field, 'output', fields.Raw) or type(field) in (fields.Nested, NestedWithEmpty)):
+        # e.g. List or a field overriding output(), left to the field itself
+        lines.append('    {} = f{}.output({!r}, obj)'.format(result, index, key))
+        return
+
+    attribute = key if field.attribute is None else field.attribute
+    if isinstance(attribute, six.string_types) and '.' not in attribute:
+        lines.append('    {} = get(obj, {!r}, None)'.format(value, attribute))
+    else:
+        namespace['a{}'.format(index)] = attribute
+        lines.append('    {} = get_value(a{}, obj)'.format(value, index))
+
+    if isinstance(field, fields.Nested):
+        namespace['s{}'.format(index)] = compile_schema(field.nested)
+        if field.allow_null:
+            missing = 'None'
+        elif type(field) is NestedWithEmpty and field.allow_empty:
+            missing = '{}'
+        elif type(field) is fields.Nested and field.default is not None:
+            missing = 'f{}.default'.format(index)
+        else:
+            missing = 's{}(None)'.format(index)
+        lines.append('    {} = {} if {} is None else s{}({})'.format(result, missing, value, index, value))
+        return
+
+    namespace['d{}'.format(index)] = field.default
+    if _is_inherited(field, 'format', fields.Raw):
+        formatted = value
+    elif _is_inherited(field, 'format', fields.Boolean):
+        formatted = 'bool({})'.format(value)
+    elif _is_inherited(field, 'format', fields.String):
+        # six.text_type() returns a text value itself
+        formatted = '{0} if type({0}) is text_type else f{1}.format({0})'.format(value, index)
+    elif _is_inherited(field, 'format', fields.Integer):
+        formatted = '{0} if type({0}) is int else f{1}.format({0})'.format(value, index)
+    else:
+        formatted = 'f{}.format({})'.format(index, value)
+    lines.append('    {0} = d{1} if {2} is None else {3}'.format(result, index, value, formatted))
+
+
+def compile_schema(schema):
+    """
+    compile a flask-restful fields dict to a serializer function, whose output is identical to
+    marshal(data, schema) but does without the per value dispatch through the field objects.
+    The fields of the Raw family, Nested and NestedWithEmpty are inlined, any other field calls its output().
+    The function is cached by the schema object, so compile it once, e.g. at import, and don't mutate it afterwards.
+    :param schema: flask-restful fields dict
+    :return: function(data) returning an OrderedDict, or a list of them for a list or tuple
+    """
+    cached = compiled_schema_cache.get(id(schema))
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+
+    namespace = {
+        'OrderedDict': OrderedDict,
+        'get_value': fields.get_value,
+        '_get_item': _get_item,
+        'text_type': six.text_type
+    }
+    lines = [
+        'def serialize(obj):',
+        '    if isinstance(obj, (list, tuple)):',
+        '        return [serialize(item) for item in obj]',
+        "    get = _get_item if not hasattr(obj, 'strip') and hasattr(obj, '__iter__') else getattr"
+    ]
+    keys = list(schema.keys())
+    for index, key in enumerate(keys):
+        _compile_field(key, schema[key], index, namespace, lines)
+    lines.append('    return OrderedDict([{}])'.format(
+        ', '.join('({!r}, r{})'.format(key, index) for index, key in enumerate(keys))))
+    six.exec_(compile('\n'.join(lines) + '\n', '<schema {}>'.format(id(schema)), 'exec'), namespace)
+    serialize = namespace['serialize']
+    compiled_schema_cache.set(id(schema), (schema, serialize))
+    return serialize
+
+
+def marshal_compiled(data, schema, envelope=None):
+    """marshal() through the serializer compiled from the schema, see compile_schema()"""
+    result = compile_schema(schema)(data)
+    return OrderedDict([(envelope, result)]) if envelope else result
+
+
+def get_requested_fields():
+    """sorted output keys of the `fields` request argument, e.g. `?fields=kpiId,name,updatedBy.name`, None if absent"""
+    value = request.args.get('fields')
+    if not value:
+        return None
+    return tuple(sorted(set(name.strip() for name in value.split(',') if name.strip()))) or None
+
+
+def _trim_field(field, names):
+    """copy of a Nested field, also inside a List, whose nested schema keeps only the names"""
+    if isinstance(field, type):
+        field = field()
+    field = copy.copy(field)
+    if isinstance(field, fields.List):
+        field.container = _trim_field(field.container, names)
+    elif isinstance(field, FieldsPagination):
+        # a name of either mode may be requested
+        modes = (field.nested, field.cursor_nested)
+        unknown = [name for name in names if not any(name.partition('.')[0] in schema for schema in modes)]
+        if unknown:
+            trim_schema(field.nested, unknown)
+        field.nested, field.cursor_nested = [
+            trim_schema(schema, [name for name in names if name.partition('.')[0] in schema]) for schema in modes]
+    elif isinstance(getattr(field, 'nested', None), dict):
+        field.nested = trim_schema(field.nested, names)
+    else:
+        msg = "The fields {} are not available, the field has no nested fields.".format(', '.join(names))
+        raise ValidationError(msg)
+    return field
+
+
+def trim_schema(schema, names):
+    """
+    the schema restricted to the output keys given
+    :param schema: flask-restful fields dict
+    :param names: output keys, `a.b` keeps only the key b of the nested schema a
+    :return: new fields dict, the fields are shared with the schema unless their nested schema is trimmed
+    """
+    nested_names = dict()
+    for name in names:
+        head, _, rest = name.partition('.')
+        if head not in schema:
+            msg = "The field {} is not available, choose from {}.".format(head, ', '.join(sorted(schema)))
+            raise ValidationError(msg)
+        if not rest:
+            nested_names[head] = None
+        elif nested_names.get(head, ()) is not None:
+            nested_names.setdefault(head, []).append(rest)
+    return dict((key, field if nested_names[key] is None else _trim_field(field, nested_names[key]))
+                for key, field in schema.items() if key in nested_names)
+
+
+def get_request_schema(schema, records=None):
+    """
+    the schema trimmed to the `fields` request argument (sparse fieldset), the schema itself if it's not given.
+    The same trimmed schema object is returned for the same fields, so it can key the schema_load_options() cache.
+    :param schema: flask-restful fields dict
+    :param records: key of the Nested records field of a collection schema, which is trimmed instead
+    :return: fields dict
+    """
+    names = get_requested_fields()
+    if names is None:
+        return schema
+    key = (id(schema), records, names)
+    memo = get_request_memo('_sparse_schemas')
+    trimmed = memo.get(key)
+    if trimmed is None:
+        cached = sparse_schema_cache.get(key)
+        if cached is not None and cached[0] is schema:
+            trimmed = cached[1]
+        else:
+            if records is None:
+                trimmed = trim_schema(schema, names)
+            else:
+                field = copy.copy(schema[records])
+                field.nested = get_request_schema(schema[records].nested)
+                trimmed = dict(schema)
+                trimmed[records] = field
+            sparse_schema_cache.set(key, (schema, trimmed))
+        memo[key] = trimmed
+    return trimmed
+
+
+class marshal_with_fields(marshal_with):
+    """marshal_with() applying the `fields` request argument, see get_request_schema().
+    If the records of a collection are not a list but e.g. a query with yield_per(), they are streamed."""
+
+    def __init__(self, fields, envelope=None, records=None):
+        super(marshal_with_fields, self).__init__(fields, envelope=envelope)
+        self.records = records
+
+    def _is_streamed(self, data):
+        return self.records is not None and self.envelope is None and isinstance(data, dict) \
+            and not isinstance(data.get(self.records), (list, tuple, type(None)))
+
+    def _stream(self, data, schema, code=200, headers=None):
+        field = schema[self.records]
+        if type(field) not in (fields.Nested, NestedWithEmpty):
+            return marshal_compiled(dict(data, **{self.records: list(data[self.records])}), schema), code, headers
+        head = marshal_compiled(dict(data, **{self.records: []}), schema)
+        del head[self.records]
+        return stream_json_response(head, self.records, data[self.records], compile_schema(field.nested),
+                                    code=code, headers=headers)
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            resp = f(*args, **kwargs)
+            schema = get_request_schema(self.fields, records=self.records)
+            if isinstance(resp, tuple):
+                data, code, headers = unpack(resp)
+                if self._is_streamed(data):
+                    return self._stream(data, schema, code, headers)
+                return marshal_compiled(data, schema, self.envelope), code, headers
+            else:
+                if self._is_streamed(resp):
+                    return self._stream(resp, schema)
+                return marshal_compiled(resp, schema, self.envelope)
+
+        return wrapper
+
+
+compile_schema(pagination_meta_data)
+compile_schema(cursor_pagination_meta_data)
@@ -3,7 +3,7 @@
 """Kpi object response schema."""
 from flask_restful import fields
 
-from app.responseschema import pagination_meta_data, FieldsISODateTime
+from app.responseschema import compile_schema, FieldsISODateTime, FieldsPagination
 from app.responseschema.user import user_get_simple_response
 
 kpi_get_response = {
@@ -22,7 +22,7 @@ kpi_get_response = {
 }
 
 kpi_collection_get_response = {
-    'pagination': fields.Nested(pagination_meta_data),
+    'pagination': FieldsPagination,
     'records': fields.Nested(kpi_get_response)
 }
 
@@ -36,3 +36,6 @@ kpi_v2_get_response = {
     "reactionQuery": fields.String(attribute='reaction_query'),
     "reportQuery": fields.String(attribute='report_query')
 }
+
+for schema in (kpi_get_response, kpi_collection_get_response, kpi_v2_get_response):
+    compile_schema(schema)
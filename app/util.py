@@ -1,26 +1,38 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
 import functools
+import hashlib
+import json
 import re
 import string
 import time
 import urllib
-import xmlrpclib
+from collections import defaultdict
 from datetime import datetime, timedelta
-from xml.dom.minidom import parseString
 
 import paramiko
 import pytz
-from flask import url_for, request, render_template_string
+from flask import abort, current_app, g, has_app_context, url_for, request
+from flask_restful import fields
+from flask_sqlalchemy import Pagination
+from jsonschema import ValidationError
 from pytz.tzinfo import StaticTzInfo
-from sqlalchemy import and_
+from sqlalchemy import and_, event, inspect
 from sqlalchemy import asc
 from sqlalchemy import desc
 from sqlalchemy import or_
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Session, defaultload, joinedload, load_only, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql.util import find_tables
 from unidecode import unidecode
 
 from app.configs import CONFIG
 from app.customerrors import DataNotFoundError, ForbiddenError
+from app.helpers import TTLCache
+from app.jsonsearch import iter_values_by_key
 from app.loggers import CustomLogger
 from app.requestschema.kpi import kpi_setting_schema
 
@@ -28,12 +40,29 @@ NA_PARAMS = ['', None]
 
 logger = CustomLogger(__name__)
 
+# owner of a query template, else the sha1 of its source => (sha1 of the source, compiled jinja template)
+query_template_cache = TTLCache(maxsize=getattr(CONFIG, 'QUERY_TEMPLATE_CACHE_SIZE', 128),
+                                ttl=getattr(CONFIG, 'QUERY_TEMPLATE_CACHE_TTL', 24 * 60 * 60))
+# fingerprint of the inputs of a generated hive query => the query, see QueryGenerationContext.fingerprint().
+# A query is up to a few MB, so these two caches are also bounded by bytes, per worker process
+generated_query_cache = TTLCache(maxsize=getattr(CONFIG, 'GENERATED_QUERY_CACHE_SIZE', 256),
+                                 ttl=getattr(CONFIG, 'GENERATED_QUERY_CACHE_TTL', 60 * 60),
+                                 maxbytes=getattr(CONFIG, 'GENERATED_QUERY_CACHE_BYTES', 32 * 1024 * 1024))
+reaction_fragment_cache = TTLCache(maxsize=getattr(CONFIG, 'REACTION_FRAGMENT_CACHE_SIZE', 1024),
+                                   ttl=getattr(CONFIG, 'REACTION_FRAGMENT_CACHE_TTL', 60 * 60),
+                                   maxbytes=getattr(CONFIG, 'REACTION_FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+# (tables of a count query, hash of its SQL and parameters) => total, dropped when one of the tables is written
+pagination_count_cache = TTLCache(maxsize=getattr(CONFIG, 'PAGINATION_COUNT_CACHE_SIZE', 1024),
+                                  ttl=getattr(CONFIG, 'PAGINATION_COUNT_CACHE_TTL', 60))
+REACTION_QUERY_TEMPLATES = ('reaction_query_template', 'reaction_ctc_query_template', 'reaction_r2d2_query_template')
+REPORT_QUERY_TEMPLATES = ('report_query_template',)
+
 
 def is_integer(s):
     """Check if a string is an integer or not"""
     try:
         int(s)
-    except ValueError:
+    except (TypeError, ValueError):
         return False
     return True
 
@@ -81,21 +110,244 @@ def datetime2str(dt):
     return pytz.timezone(CONFIG.TIMEZONE).localize(dt).replace(microsecond=0).isoformat()
 
 
+# (model, id of a marshal schema) => (schema, loader options), see schema_load_options()
+_schema_load_options = TTLCache(maxsize=getattr(CONFIG, 'SCHEMA_LOAD_OPTIONS_CACHE_SIZE', 512), ttl=24 * 60 * 60)
+
+
+def _nested_schema(field):
+    """the schema of a Nested field, also inside a List, None for the other fields"""
+    if isinstance(field, fields.List):
+        field = field.container
+    nested = getattr(field, 'nested', None)
+    return nested if isinstance(nested, dict) else None
+
+
+def _loader(path, strategy):
+    """loader option of the relationship at the end of the path, e.g. defaultload('a').joinedload('b')"""
+    option = None
+    for i, key in enumerate(path):
+        load = strategy if i == len(path) - 1 else defaultload
+        option = load(key) if option is None else getattr(option, load.__name__)(key)
+    return option
+
+
+def _column_keys(mapper, columns):
+    keys = []
+    for column in columns:
+        try:
+            keys.append(mapper.get_property_by_column(column).key)
+        except UnmappedColumnError:
+            pass
+    return keys
+
+
+def _schema_loader_options(mapper, schema, path):
+    columns = set()
+    options = []
+    complete = True
+    for key, field in schema.items():
+        if isinstance(field, type):
+            field = field()
+        attribute = field.attribute or key
+        if not isinstance(attribute, basestring) or '.' in attribute:
+            # callable or dotted attributes may read anything
+            complete = False
+            continue
+        if attribute in mapper.column_attrs:
+            columns.add(attribute)
+        elif attribute in mapper.relationships:
+            relationship = mapper.relationships[attribute]
+            # the columns the relationship is loaded by, e.g. the foreign key of a many-to-one
+            columns.update(_column_keys(mapper, relationship.local_columns))
+            relationship_path = path + (attribute,)
+            options.append(_loader(relationship_path, subqueryload if relationship.uselist else joinedload))
+            nested = _nested_schema(field)
+            if nested is not None:
+                options.extend(_schema_loader_options(relationship.mapper, nested, relationship_path))
+        elif hasattr(mapper.class_, attribute):
+            # a property of the model may read any of its columns
+            complete = False
+    if complete:
+        options.append(_loader(path, defaultload).load_only(*columns) if path else load_only(*columns))
+    return options
+
+
+def schema_load_options(model, schema):
+    """
+    loader options which load only the columns a marshal schema outputs and eager load the relationships it nests,
+    e.g. Kpi.query.options(*schema_load_options(Kpi, kpi_get_response)). Many-to-one relationships are joined,
+    collections loaded by a subquery. The options of a (model, schema) pair are cached.
+    :param model: model class the schema is marshalled from
+    :param schema: flask-restful fields dict
+    :return: list of loader options
+    """
+    key = (model, id(schema))
+    cached = _schema_load_options.get(key)
+    # the schema is kept with its options, as the id of a schema built per request may be reused later
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+    options = _schema_loader_options(inspect(model), schema, ())
+    _schema_load_options.set(key, (schema, options))
+    return options
+
+
+COUNT_STRATEGIES = ('exact', 'cached', 'estimate')
+
+
+def _count_cache_key(count_query):
+    statement = count_query.statement
+    compiled = statement.compile(dialect=count_query.session.get_bind().dialect)
+    # every table of the statement, the joined ones and the ones of the subqueries included
+    tables = frozenset(table.name for table in find_tables(statement))
+    digest = hashlib.sha1(json.dumps([str(compiled), compiled.params], sort_keys=True, default=str)).hexdigest()
+    return tables, digest
+
+
+def _estimate_count(count_query):
+    """row count estimated by the query planner of PostgreSQL or MySQL, None on other databases"""
+    bind = count_query.session.get_bind()
+    if bind.dialect.name not in ('postgresql', 'mysql'):
+        return None
+    compiled = count_query.statement.compile(dialect=bind.dialect)
+    connection = count_query.session.connection()
+    if bind.dialect.name == 'mysql':
+        # the MySQL drivers take the parameters by position
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        plan = connection.execute('EXPLAIN ' + str(compiled), params)
+        return _estimate_mysql_rows([dict(row.items()) for row in plan])
+    plan = connection.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def _estimate_mysql_rows(plan):
+    """
+    rows of the outer select estimated from a MySQL EXPLAIN, the product of the rows examined per table in the join
+    order times the percentage of them left by the conditions (`filtered`, 100 before MySQL 5.7)
+    :param plan: rows of the EXPLAIN as dicts
+    :return: estimate, None if the plan of the outer select has no estimate, e.g. `Impossible WHERE`
+    """
+    outer = [row for row in plan if str(row.get('id')) == '1']
+    if not outer or any(row.get('rows') is None for row in outer):
+        return None
+    estimate = 1.0
+    for row in outer:
+        estimate *= int(row['rows']) * float(row.get('filtered') or 100) / 100
+    return int(estimate)
+
+
+def count_total(query, strategy='exact'):
+    """
+    total number of rows of a query
+    :param query: Flask-sqlalchemy BaseQuery instance
+    :param strategy: 'exact' counts every time,
+        'cached' reuses an exact count for PAGINATION_COUNT_CACHE_TTL seconds unless one of its tables is written
+        by this process meanwhile,
+        'estimate' takes the planner estimate of PostgreSQL or MySQL, if it is below PAGINATION_ESTIMATE_THRESHOLD
+        the exact count is cheap enough and made instead
+    :return: (total, True if the total is approximate)
+    """
+    count_query = query.order_by(None)
+    if strategy == 'cached':
+        key = _count_cache_key(count_query)
+        total = pagination_count_cache.get(key)
+        if total is None:
+            total = count_query.count()
+            pagination_count_cache.set(key, total)
+        return total, False
+    if strategy == 'estimate':
+        estimate = _estimate_count(count_query)
+        if estimate is not None and estimate >= getattr(CONFIG, 'PAGINATION_ESTIMATE_THRESHOLD', 10000):
+            return estimate, True
+    return count_query.count(), False
+
+
+def _get_count_strategy(request, count_strategy):
+    """the strategy of the request (`count` argument), else the one of the endpoint, else the configured one"""
+    strategy = request.args.get('count') or count_strategy or getattr(CONFIG, 'PAGINATION_COUNT_STRATEGY', 'exact')
+    if strategy not in COUNT_STRATEGIES:
+        msg = "The count strategy {} is not supported, use one of {}.".format(strategy, ', '.join(COUNT_STRATEGIES))
+        logger.error(msg)
+        raise ValidationError(msg)
+    return strategy
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_written_tables(session, flush_context):
+    tables = session.info.setdefault('_written_tables', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__table__', None)
+        if table is not None:
+            tables.add(table.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_pagination_counts(session):
+    tables = session.info.pop('_written_tables', None)
+    if tables:
+        pagination_count_cache.discard_if(lambda key, total: not key[0].isdisjoint(tables))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_written_tables(session):
+    session.info.pop('_written_tables', None)
+
+
+def _is_stream_requested(request, stream):
+    """the records are streamed if `stream=true` is given, else if the endpoint or PAGINATION_STREAM says so"""
+    value = request.args.get('stream')
+    if value is not None:
+        return value.lower() in ('1', 'true', 'yes')
+    return stream if stream is not None else getattr(CONFIG, 'PAGINATION_STREAM', False)
+
+
 # TODO reduce the limit per page after UI supported pagination
-def build_pagination_response(request, query, max_per_page=200, **kwargs):
+def build_pagination_response(request, query, max_per_page=200, count_strategy=None, stream=None, **kwargs):
     """
     generate pagination supported response.
+    With streaming the records are a query read by yield_per() from a server side cursor when the response is sent,
+    see marshal_with_fields(), so the page is never in memory at once. The total is then always counted, before
+    the cursor is opened, and the query must not load collections eagerly. Cursor pages are not streamed.
 
     :param request: Flask request instance
     :param query: Flask-sqlalchemy BaseQuery instance
     :param max_per_page: any integer
+    :param count_strategy: how the total is counted by default, see count_total()
+    :param stream: whether the records are streamed by default, see _is_stream_requested()
     :param kwargs: other S params to be used for generate paging URL
     :return:
     """
-    page = request.args.get('page', 1, type=int)
+    strategy = _get_count_strategy(request, count_strategy)
+    if 'count' in request.args:
+        kwargs['count'] = strategy
+    if 'fields' in request.args:
+        kwargs['fields'] = request.args['fields']
+    if 'stream' in request.args:
+        kwargs['stream'] = request.args['stream']
     per_page = min(request.args.get('perPage', max_per_page, type=int), max_per_page)
-    # build-in pagination support, db_query should be BaseQuery object from flask-sqlalchemy
-    r = query.paginate(page, per_page)
+    if 'cursor' in request.args:
+        return build_cursor_pagination_response(request, query, per_page, strategy, **kwargs)
+    page = request.args.get('page', 1, type=int)
+    # same as query.paginate(page, per_page), but the total is counted by the strategy
+    if page < 1 or per_page < 0:
+        abort(404)
+    page_query = query.limit(per_page).offset((page - 1) * per_page)
+    approximate = False
+    if _is_stream_requested(request, stream):
+        total, approximate = count_total(query, strategy)
+        if page != 1 and not approximate and total <= (page - 1) * per_page:
+            abort(404)
+        items = page_query.yield_per(getattr(CONFIG, 'PAGINATION_STREAM_BATCH_SIZE', 100))
+    else:
+        items = page_query.all()
+        if not items and page != 1:
+            abort(404)
+        if page == 1 and len(items) < per_page:
+            total = len(items)
+        else:
+            total, approximate = count_total(query, strategy)
+    r = Pagination(query, page, per_page, total, items)
     # r => sql query result
     links = {}
     if r.has_prev:
@@ -112,37 +364,98 @@ def build_pagination_response(request, query, max_per_page=200, **kwargs):
             'perPage': per_page,
             'pages': r.pages,
             'total': r.total,
+            'totalApproximate': approximate,
             'links': links
         },
         'records': r.items
     }
 
 
-def find_json_values_by_key(somejson, key):
-    """fetch all values with the same key in a JSON."""
-
-    def val(node):
-        # Searches for the next Element Node containing Value
-        e = node.nextSibling
-        while e and e.nodeType != e.ELEMENT_NODE:
-            e = e.nextSibling
-        if e:
-            if e.getElementsByTagName('string'):
-                v = e.getElementsByTagName('string')[0].firstChild.nodeValue
-            elif e.getElementsByTagName('int'):
-                v = int(e.getElementsByTagName('int')[0].firstChild.nodeValue)
-            else:
-                v = None
-            return v
-        else:
-            return None
+def _keyset_columns(query):
+    """(update_time, primary key) of the queried model, or only its primary key if it has no update_time"""
+    model = query.column_descriptions[0]['entity']
+    primary_key = inspect(model).primary_key[0]
+    update_time = getattr(model, 'update_time', None)
+    return (update_time, primary_key) if update_time is not None else (primary_key,)
+
+
+def encode_cursor(values):
+    """opaque cursor token of the keyset values of a row"""
+    values = [{'dt': value.strftime('%Y-%m-%dT%H:%M:%S.%f')} if isinstance(value, datetime) else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':'))).rstrip('=')
 
-    # parse the JSON as XML
-    foo_dom = parseString(xmlrpclib.dumps((somejson,)))
-    # and then search all the name tags which are P1's
-    # and use the val user function to get the value
-    return [val(node) for node in foo_dom.getElementsByTagName('name')
-            if node.firstChild.nodeValue in key]
+
+def decode_cursor(token, size):
+    """keyset values of a cursor token made by encode_cursor()"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4)))
+        if not isinstance(values, list) or len(values) != size:
+            raise ValueError(values)
+        return [datetime.strptime(value['dt'], '%Y-%m-%dT%H:%M:%S.%f') if isinstance(value, dict) else value
+                for value in values]
+    except (TypeError, ValueError, KeyError):
+        msg = "The cursor {} is invalid.".format(token)
+        logger.error(msg)
+        raise ValidationError(msg)
+
+
+def build_cursor_pagination_response(request, query, per_page, count_strategy='exact', **kwargs):
+    """
+    keyset pagination of the records newest first by (update_time, primary key), selected by `cursor`
+    (empty for the first page). Unlike the page mode there is no OFFSET scan, a page costs the same at any depth,
+    and the total is only counted if `total=true` is requested. Rows without an update_time are not listed.
+
+    :param request: Flask request instance
+    :param query: Flask-sqlalchemy BaseQuery instance
+    :param per_page: records per page
+    :param count_strategy: how the total is counted if requested, see count_total()
+    :param kwargs: other S params to be used for generate paging URL
+    :return:
+    """
+    if per_page < 1:
+        msg = "perPage must be at least 1 in the cursor mode."
+        logger.error(msg)
+        raise ValidationError(msg)
+    columns = _keyset_columns(query)
+    if len(columns) > 1:
+        # a row without update_time doesn't fit in the keyset order, NULL sorts first descending on PostgreSQL
+        query = query.filter(columns[0].isnot(None))
+    cursor = request.args.get('cursor')
+    total, approximate = None, False
+    if request.args.get('total', '').lower() in ('1', 'true'):
+        kwargs['total'] = 'true'
+        total, approximate = count_total(query, count_strategy)
+
+    page_query = query.order_by(None).order_by(*[desc(column) for column in columns])
+    if cursor:
+        values = decode_cursor(cursor, len(columns))
+        page_query = page_query.filter(tuple_(*columns) < tuple_(*values))
+    records = page_query.limit(per_page + 1).all()
+
+    links = {'first': url_for(request.endpoint, perPage=per_page, cursor='', **kwargs)}
+    next_cursor = None
+    if len(records) > per_page:
+        records = records[:per_page]
+        next_cursor = encode_cursor([getattr(records[-1], column.key) for column in columns])
+        links['next'] = url_for(request.endpoint, perPage=per_page, cursor=next_cursor, **kwargs)
+
+    return {
+        'pagination': {
+            'perPage': per_page,
+            'total': total,
+            'totalApproximate': approximate,
+            'cursor': cursor or None,
+            'nextCursor': next_cursor,
+            'links': links
+        },
+        'records': records
+    }
+
+
+def find_json_values_by_key(somejson, key):
+    """fetch all values with the same key in a JSON, key may also be a collection of keys."""
+    return list(iter_values_by_key(somejson, key))
 
 
 def build_experiment_searching_query(query, organization_id=None, project_id=None, search_word=None, start_after=None,
@@ -237,34 +550,162 @@ def unescape_character(s):
     return s
 
 
-def generate_reaction_query(experiment_id, kpi_settings):
+# what unescape_character() rewrites: quoted parts, and the semicolon hack which applies outside of them too
+_QUOTED_OR_RCFILE_RE = re.compile(r"'[^]]*'|RCFILE\n\\;")
+
+
+def _escape_quoted(match):
+    quoted = match.group(0)
+    if quoted[0] != "'":
+        return "RCFILE\n;"
+    if ';' in quoted:
+        quoted = quoted.replace(';', '\\;').replace("RCFILE\n\\;", "RCFILE\n;")
+    if '--' in quoted:
+        quoted = quoted.replace('--', '\\--')
+    return quoted
+
+
+def postprocess_hive_query(fragments):
+    """
+    equivalent of unescape_character(unescape_webcode(unescape_webcode(query))) with the quoted parts rewritten in
+    one compiled pass instead of two, and the rendered fragments joined once instead of concatenated one by one.
+    Quoted parts may span fragments, so the post-processing itself needs the whole query.
+    :param fragments: rendered query or an iterable of its fragments
+    :return: query
+    """
+    query = fragments if isinstance(fragments, basestring) else ''.join(fragments)
+    if '&' in query:
+        query = unescape_webcode(unescape_webcode(query))
+    return _QUOTED_OR_RCFILE_RE.sub(_escape_quoted, query)
+
+
+def render_cached_template(source, owner=None, **context):
+    """
+    same as flask.render_template_string(), but the compiled template is cached by the hash of its source.
+    :param source: template source
+    :param owner: hashable identity of where the source comes from, the template is then cached by its owner,
+        so when the source of an owner changes the template compiled from its former source is replaced
+    :param context: template context
+    :return: rendered string
+    """
+    digest = hashlib.sha1(_utf8(source)).hexdigest()
+    key = digest if owner is None else owner
+    cached = query_template_cache.get(key)
+    if cached is not None and cached[0] == digest:
+        template = cached[1]
+    else:
+        template = current_app.jinja_env.from_string(source)
+        query_template_cache.set(key, (digest, template))
+    current_app.update_template_context(context)
+    return template.render(context)
+
+
+def render_organisation_template(organisation_settings, template_name, **context):
+    """render one of the *_query_template of the organisation settings through the compiled template cache"""
+    owner = (inspect(organisation_settings).identity, template_name)
+    return render_cached_template(getattr(organisation_settings, template_name), owner=owner, **context)
+
+
+class QueryGenerationContext(object):
+    """
+    Everything the reaction and report query generation of an experiment share, loaded once:
+    the experiment (eager loaded with its project, organisation and organisation settings),
+    the organisation settings and the phxbanditpatterns of the variation/condition tree.
+    """
+
+    def __init__(self, experiment_id):
+        from app.models.experiment import Experiment
+
+        self.experiment_id = experiment_id
+        self.experiment = Experiment.query \
+            .options(joinedload('project').joinedload('organisation').joinedload('organisation_settings'),
+                     subqueryload('variations').subqueryload('conditions').joinedload('nested_variation')) \
+            .filter(Experiment.experiment_id == experiment_id).one_or_none()
+        if not self.experiment:
+            raise DataNotFoundError("The experiment with given ID {} does not exist.".format(experiment_id))
+        self.organisation_settings = get_org_settings_by_experiment(self.experiment)
+        self._template_versions = {}
+
+        # create a list of phxbanditpatterns
+        root_variations = [variation for variation in self.experiment.variations if variation.is_root]
+        load_variation_tree(root_variations)
+        variation_condition_combinations = list()
+        for variation in root_variations:
+            variation_condition_combinations += get_all_variation_condition_combinations(variation)
+        self.phxbanditpatterns = ['__'.join(combination) for combination in variation_condition_combinations]
+
+        self.hive_dbname = CONFIG.HIVE_DB_NAME if self.organisation_settings.template_type == 'REGULAR' \
+            else CONFIG.SEC_HIVE_DB_NAME
+
+    @property
+    def start_datetime(self):
+        return datetime.strftime(self.experiment.schedule_start_time, "%Y-%m-%d %H:%M:%S")
+
+    @property
+    def end_datetime(self):
+        return datetime.strftime(self.experiment.schedule_end_time, "%Y-%m-%d %H:%M:%S")
+
+    def template_version(self, template_name):
+        """
+        :param template_name: organisation settings attribute of a template
+        :return: hash of the template source, computed once per context
+        """
+        version = self._template_versions.get(template_name)
+        if version is None:
+            source = getattr(self.organisation_settings, template_name) or ''
+            version = self._template_versions[template_name] = hashlib.sha1(_utf8(source)).hexdigest()
+        return version
+
+    def fingerprint(self, kind, kpi_settings, template_names):
+        """
+        hash of everything a generated hive query depends on: the experiment schedule, the variation/condition tree
+        (as its phxbanditpatterns), the normalized kpi settings and the versions of the organisation templates used.
+        :param kind: 'reaction' or 'report'
+        :param template_names: organisation settings attributes of the templates the query is rendered from
+        :return: string
+        """
+        template_versions = [self.template_version(name) for name in template_names]
+        parts = [kind, str(self.experiment_id), self.experiment.schedule_start_time, self.experiment.schedule_end_time,
+                 self.phxbanditpatterns, kpi_settings, self.organisation_settings.template_type, template_versions]
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str)).hexdigest()
+
+
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+
+def generate_kpi_queries(experiment_id, kpi_settings):
+    """
+    generates both reaction and report hive queries from one QueryGenerationContext
+    :param experiment_id:
+    :param kpi_settings: kpi setting json
+    :return: (reaction_query, report_query)
+    """
+    context = QueryGenerationContext(experiment_id)
+    return (generate_reaction_query(experiment_id, kpi_settings, context=context),
+            generate_report_query(experiment_id, kpi_settings, context=context))
+
+
+def generate_reaction_query(experiment_id, kpi_settings, context=None):
     """
     generates reaction hive query to be used by batch
     :param experiment_id:
     :param kpi_settings: kpi setting json
+    :param context: QueryGenerationContext of the experiment, loaded if not given
     :return:
     """
     from app.validators import check_json
-    from app.models.experiment import Experiment
 
-    check_json(kpi_settings, kpi_setting_schema)
-    reaction_query = str()
+    check_json(kpi_settings, kpi_setting_schema, fail_fast=True)
+    reaction_fragments = list()
 
-    experiment = Experiment.query.filter(Experiment.experiment_id == experiment_id).one_or_none()
-    if not experiment:
-        raise DataNotFoundError("The experiment with given ID {} does not exist.".format(experiment_id))
+    context = context or QueryGenerationContext(experiment_id)
 
-    organization_settings = get_org_settings_by_experiment(experiment)
+    fingerprint = context.fingerprint('reaction', kpi_settings, REACTION_QUERY_TEMPLATES)
+    cached_query = generated_query_cache.get(fingerprint)
+    if cached_query is not None:
+        return cached_query
 
-    # create a list of phxbanditpatterns
-    variation_condition_combinations = list()
-    for variation in experiment.variations:
-        if not variation.is_root:
-            continue
-        variation_condition_combinations += get_all_variation_condition_combinations(variation)
-    phxbanditpatterns = list()
-    for combination in variation_condition_combinations:
-        phxbanditpatterns.append('__'.join(combination))
     settings = True
     for kpi_definition in kpi_settings["kpi_definitions"]:
 
@@ -273,94 +714,109 @@ def generate_reaction_query(experiment_id, kpi_settings):
             if kpi_condition["condition_type"] == "r2d2":
                 if_r2d2 = True
 
-        start_time = datetime.strftime(experiment.schedule_start_time, "%Y-%m-%d %H:%M:%S")
-        end_time = datetime.strftime(experiment.schedule_end_time, "%Y-%m-%d %H:%M:%S")
-
         # r2d2 not allowed for Click Through Conversion or if there are other kpi conditions
         if if_r2d2 and (
                 len(kpi_definition['kpi_conditions']) > 1 or kpi_definition['kpi_type'] == "clickThroughConversion"):
             raise ForbiddenError
 
-        params = {
-            "ghp_hive_dbname": CONFIG.HIVE_DB_NAME if organization_settings.template_type == 'REGULAR' else CONFIG.SEC_HIVE_DB_NAME,
-            "reaction_table": CONFIG.HIVE_REACTION_TABLE,
-            "kpi_name": kpi_definition['kpi_definition_name'],
-            "kpi_conditions": kpi_definition['kpi_conditions'],
-            "experiment_id": experiment_id,
-            "phxbanditpatterns": phxbanditpatterns,
-            "start_datetime": start_time,
-            "end_datetime": end_time,
-            "settings": settings
-            }
-
         if len(kpi_definition['kpi_conditions']) == 1 and if_r2d2:
-            reaction_query += render_template_string(organization_settings.reaction_r2d2_query_template, params=params)
+            template_name = 'reaction_r2d2_query_template'
         elif kpi_definition['kpi_type'] == "clickThroughConversion":
-            kpi_conditions = []
-            kpi_click_conditions = [condition for condition in kpi_definition['kpi_conditions'] if
-                                    (not condition['condition_type'].startswith("conversion"))]
-            # Getting clicks conditions if they exist
-            if kpi_click_conditions:
-                for i in range(len(kpi_click_conditions)):
-                    kpi_conditions.append({"kpi": "click_" + str(i), "conditions": [kpi_click_conditions[i]]})
-
-            # Getting conversion conditions and appending it at the end of the array
-            # in order to left join conversion to the clicks at the end
-            kpi_conversion_conditions = [condition for condition in kpi_definition['kpi_conditions'] if
-                                         (condition['condition_type'].startswith("conversion"))]
-            kpi_conditions.append({"kpi": "conversion", "conditions": kpi_conversion_conditions})
-
-            params["kpi_conditions"] = kpi_conditions
-            reaction_query += render_template_string(organization_settings.reaction_ctc_query_template, params=params)
+            template_name = 'reaction_ctc_query_template'
         else:
-            reaction_query += render_template_string(organization_settings.reaction_query_template, params=params)
+            template_name = 'reaction_query_template'
+
+        # unchanged definitions of an updated experiment are not rendered again
+        fragment_key = context.fingerprint('reaction_fragment', [kpi_definition, settings], (template_name,))
+        fragment = reaction_fragment_cache.get(fragment_key)
+        if fragment is None:
+            fragment = _render_reaction_fragment(experiment_id, context, template_name, kpi_definition, settings)
+            reaction_fragment_cache.set(fragment_key, fragment)
+        reaction_fragments.append(fragment)
         settings = False
-    return unescape_character(unescape_webcode(unescape_webcode(reaction_query)))
+    reaction_query = postprocess_hive_query(reaction_fragments)
+    generated_query_cache.set(fingerprint, reaction_query)
+    return reaction_query
 
 
-def generate_report_query(experiment_id, kpi_settings):
+def _render_reaction_fragment(experiment_id, context, template_name, kpi_definition, settings):
+    """
+    renders the reaction query of one kpi definition, not post-processed yet
+    :param experiment_id:
+    :param context: QueryGenerationContext of the experiment
+    :param template_name: organisation settings attribute of the template
+    :param kpi_definition: kpi definition json
+    :param settings: whether the fragment is the first of the query
+    :return: rendered string
+    """
+    params = {
+        "ghp_hive_dbname": context.hive_dbname,
+        "reaction_table": CONFIG.HIVE_REACTION_TABLE,
+        "kpi_name": kpi_definition['kpi_definition_name'],
+        "kpi_conditions": kpi_definition['kpi_conditions'],
+        "experiment_id": experiment_id,
+        "phxbanditpatterns": context.phxbanditpatterns,
+        "start_datetime": context.start_datetime,
+        "end_datetime": context.end_datetime,
+        "settings": settings
+        }
+
+    if template_name == 'reaction_ctc_query_template':
+        kpi_conditions = []
+        kpi_click_conditions = [condition for condition in kpi_definition['kpi_conditions'] if
+                                (not condition['condition_type'].startswith("conversion"))]
+        # Getting clicks conditions if they exist
+        if kpi_click_conditions:
+            for i in range(len(kpi_click_conditions)):
+                kpi_conditions.append({"kpi": "click_" + str(i), "conditions": [kpi_click_conditions[i]]})
+
+        # Getting conversion conditions and appending it at the end of the array
+        # in order to left join conversion to the clicks at the end
+        kpi_conversion_conditions = [condition for condition in kpi_definition['kpi_conditions'] if
+                                     (condition['condition_type'].startswith("conversion"))]
+        kpi_conditions.append({"kpi": "conversion", "conditions": kpi_conversion_conditions})
+
+        params["kpi_conditions"] = kpi_conditions
+    return render_organisation_template(context.organisation_settings, template_name, params=params)
+
+
+def generate_report_query(experiment_id, kpi_settings, context=None):
     """
     generates report hive query to be used by batch
     :param experiment_id:
     :param kpi_setting: kpi setting json
+    :param context: QueryGenerationContext of the experiment, loaded if not given
     :return:
     """
     from app.validators import check_json
-    from app.models.experiment import Experiment
 
-    check_json(kpi_settings, kpi_setting_schema)
+    check_json(kpi_settings, kpi_setting_schema, fail_fast=True)
 
     # create a list of kpi_definition_names
     kpi_definition_names = list()
     for kpi_definition in kpi_settings["kpi_definitions"]:
         kpi_definition_names.append(kpi_definition['kpi_definition_name'])
 
-    experiment = Experiment.query.filter(Experiment.experiment_id == experiment_id).one_or_none()
-    if not experiment:
-        raise DataNotFoundError("The experiment with given ID {} does not exist.".format(experiment_id))
+    context = context or QueryGenerationContext(experiment_id)
+    organization_settings = context.organisation_settings
 
-    organization_settings = get_org_settings_by_experiment(experiment)
-
-    # create a list of phxbanditpatterns
-    variation_condition_combinations = list()
-    for variation in experiment.variations:
-        if not variation.is_root:
-            continue
-        variation_condition_combinations += get_all_variation_condition_combinations(variation)
-    phxbanditpatterns = list()
-    for combination in variation_condition_combinations:
-        phxbanditpatterns.append('__'.join(combination))
+    fingerprint = context.fingerprint('report', kpi_settings, REPORT_QUERY_TEMPLATES)
+    cached_query = generated_query_cache.get(fingerprint)
+    if cached_query is not None:
+        return cached_query
 
     params = {
-        "ghp_hive_dbname": CONFIG.HIVE_DB_NAME if organization_settings.template_type == 'REGULAR' else CONFIG.SEC_HIVE_DB_NAME,
+        "ghp_hive_dbname": context.hive_dbname,
         "report_table": CONFIG.HIVE_REPORT_TABLE,
         "kpi_names": kpi_definition_names,
         "experiment_id": experiment_id,
-        "phxbanditpatterns": phxbanditpatterns,
+        "phxbanditpatterns": context.phxbanditpatterns,
         "kpi_count": len(kpi_settings["kpi_definitions"])
     }
-    report_query = render_template_string(organization_settings.report_query_template, params=params)
-    return unescape_character(unescape_webcode(unescape_webcode(report_query)))
+    report_query = render_organisation_template(organization_settings, 'report_query_template', params=params)
+    report_query = postprocess_hive_query(report_query)
+    generated_query_cache.set(fingerprint, report_query)
+    return report_query
 
 
 def get_org_settings_by_experiment(experiment):
@@ -381,6 +837,35 @@ def get_org_settings_by_experiment(experiment):
     return organisation.organisation_settings
 
 
+def load_variation_tree(variations):
+    """
+    Make sure the conditions and nested variations of the whole tree under the given variations are loaded,
+    so walking it afterwards (e.g. get_all_variation_condition_combinations) never lazy loads.
+    Variations loaded with subqueryload('conditions').joinedload('nested_variation') cost nothing here,
+    otherwise the missing conditions are loaded by one query per tree level instead of one per variation.
+    :param variations: list of variation models
+    """
+    seen = set()
+    level = list(variations)
+    while level:
+        unloaded = [variation for variation in level if 'conditions' in inspect(variation).unloaded]
+        if unloaded:
+            conditions_property = inspect(type(unloaded[0])).relationships['conditions']
+            condition_cls = conditions_property.mapper.class_
+            query = condition_cls.query.options(joinedload('nested_variation')) \
+                .filter(condition_cls.variation_id.in_([variation.variation_id for variation in unloaded]))
+            if conditions_property.order_by:
+                query = query.order_by(*conditions_property.order_by)
+            conditions_by_variation = defaultdict(list)
+            for condition in query.all():
+                conditions_by_variation[condition.variation_id].append(condition)
+            for variation in unloaded:
+                set_committed_value(variation, 'conditions', conditions_by_variation[variation.variation_id])
+        seen.update(id(variation) for variation in level)
+        level = [condition.nested_variation for variation in level for condition in variation.conditions
+                 if condition.nested_variation is not None and id(condition.nested_variation) not in seen]
+
+
 def get_all_variation_condition_combinations(variation):
     """
     :param variation: experiment variation for which all the combinations are needed
@@ -454,6 +939,22 @@ def cache_key():
     return key
 
 
+def get_request_memo(name):
+    """
+    dict stored on flask.g under the given name, so that it lives as long as the current request.
+    Outside of an application context a throwaway dict is returned, which simply disables the memoization.
+    :param name: attribute name on flask.g
+    :return: dict
+    """
+    if not has_app_context():
+        return {}
+    memo = getattr(g, name, None)
+    if memo is None:
+        memo = {}
+        setattr(g, name, memo)
+    return memo
+
+
 def timeit(method):
     """A decorator for measuring the execution time of a method"""
 
@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Validators unit module"""
+import importlib
+import pkgutil
+from collections import namedtuple
+
+from flask import g, has_app_context
 from jsonschema import Draft4Validator, ValidationError
 from datetime import datetime
+from sqlalchemy import and_, event, literal, null
 from wtforms import validators
 
+from app.configs import CONFIG
+from app.auth import bump_permissions_version_after_commit, get_permissions_version
 from app.customerrors import MultipleValidationError, DataNotFoundError, ForbiddenError
+from app.extensions import db
+from app.helpers import TTLCache
 from app.models.content import Content
 from app.models.element import Element
 from app.models.experiment import Experiment
@@ -17,28 +27,75 @@ from app.models.role import Role
 from app.models.organization import Organization, UserRoleOrganization
 from app.models.service import Service
 from app.models.segment_upload import SegmentUpload ,CDNASegmentUpload
-from app.util import is_integer
+from app.util import is_integer, get_request_memo
 from app.configs import Status, SUPPORTED_STATUS_TRANSFORMATIONS, SegmentStatus
 
 from loggers import CustomLogger
 
 logger = CustomLogger(__name__)
 
-
-def check_json(json, schema):
-    """JSON validator util by using JSON Schema lib (https://github.com/Julian/jsonschema)"""
+# outcome of the user -> organisation -> role -> permissions chain for a (user_id, organisation_id, project_id)
+ResolvedPermissions = namedtuple('ResolvedPermissions', ['system_admin', 'organisation_id', 'project_found',
+                                                         'organisation_found', 'user_role_found', 'role_found',
+                                                         'permissions'])
+# (user ID, organisation ID, project ID) => (ResolvedPermissions, version stamp of the permissions), cross-request
+# cache disabled unless PERMISSION_CACHE_TTL is set, see resolve_permissions()
+permission_cache = TTLCache(maxsize=getattr(CONFIG, 'PERMISSION_CACHE_SIZE', 1024),
+                            ttl=getattr(CONFIG, 'PERMISSION_CACHE_TTL', 0))
+# version stamp of every cached ResolvedPermissions, bumped by any change of the chain once it's committed
+_PERMISSIONS_VERSION = ('permissions', 'all')
+# project ID => (organisation ID, version stamp of the project), lets permission claims of auth tokens be checked
+# for a project without a query, see get_project_organisation_id()
+project_organisation_cache = TTLCache(maxsize=getattr(CONFIG, 'PROJECT_ORGANISATION_CACHE_SIZE', 4096),
+                                      ttl=getattr(CONFIG, 'PROJECT_ORGANISATION_CACHE_TTL', 300))
+
+
+# id(schema) => (schema, compiled validator), the schema is kept referenced so that its id can not be reused
+_schema_validators = {}
+
+
+def get_schema_validator(schema):
+    """compiled Draft4Validator of the schema, built once per schema object"""
+    entry = _schema_validators.get(id(schema))
+    if entry is None:
+        entry = (schema, Draft4Validator(schema))
+        _schema_validators[id(schema)] = entry
+    return entry[1]
+
+
+def compile_request_schemas():
+    """compile the validators of every `*_schema` dict defined in the app.requestschema modules, called at startup"""
+    import app.requestschema
+    for _, module_name, _ in pkgutil.iter_modules(app.requestschema.__path__):
+        module = importlib.import_module('app.requestschema.{}'.format(module_name))
+        for name, schema in vars(module).items():
+            if name.endswith('_schema') and isinstance(schema, dict):
+                get_schema_validator(schema)
+    logger.info("compiled {} request schema validators".format(len(_schema_validators)))
+
+
+def check_json(json, schema, fail_fast=False):
+    """JSON validator util by using JSON Schema lib (https://github.com/Julian/jsonschema)
+    :param fail_fast: raise on the first error found instead of collecting and sorting all of them
+    """
     # check if json is empty
     if not json:
         msg = "JSON body may not be empty."
         logger.error(msg)
         raise ValidationError(msg)
     # validate by its schema
-    validator = Draft4Validator(schema)
+    validator = get_schema_validator(schema)
     e = None
-    for error in sorted(validator.iter_errors(json), key=str):
-        if not e:
+    if fail_fast:
+        error = next(validator.iter_errors(json), None)
+        if error:
             e = MultipleValidationError()
-        e.messages.append(error.message)
+            e.messages.append(error.message)
+    else:
+        for error in sorted(validator.iter_errors(json), key=str):
+            if not e:
+                e = MultipleValidationError()
+            e.messages.append(error.message)
     if e:
         logger.error(str(e))
         raise e
@@ -53,35 +110,127 @@ def check_id_format(*s):
             raise ValidationError(msg)
 
 
+class IntegrityBatch(object):
+    """
+    Collect the entity ID checks of a request and resolve them with one query per entity type.
+    The loaded rows are kept for the rest of the request, so the resource gets them back by get()
+    instead of fetching them again, e.g.
+        batch = get_integrity_batch()
+        batch.require(Experiment, experiment_id).require(Content, content_ids, project_id=project_id).resolve()
+        experiment = batch.get(Experiment, experiment_id)
+    """
+
+    # model => (entity name used in messages, primary key attribute, soft delete flag attribute)
+    ENTITIES = {
+        Project: ('project', 'project_id', 'delete_flg'),
+        Experiment: ('experiment', 'experiment_id', 'delete_flg'),
+        Kpi: ('kpi', 'kpi_id', 'delete_flg'),
+        Element: ('element', 'element_id', None),
+        Content: ('content', 'content_id', None),
+    }
+
+    def __init__(self):
+        self._requirements = []  # (model, ids, project_id, scalar), checked in the order they were registered
+        self._pending = {}  # model => IDs not loaded yet
+        self._rows = {}  # model => {ID: row}, only the rows found, a missing ID is looked up again when required
+
+    @staticmethod
+    def _is_id(i):
+        return is_integer(i) and not isinstance(i, float)
+
+    def require(self, model, ids, project_id=None):
+        """
+        register the ID(s) of the model which must exist, and belong to the project if it's given.
+        An ID which isn't an integer, e.g. null in a request JSON, matches no row.
+        """
+        scalar = not isinstance(ids, (set, list, tuple))
+        ids = [ids] if scalar else ids
+        invalid = [i for i in ids if not self._is_id(i)]
+        if invalid:
+            self._raise_not_found(model, invalid, scalar)
+        ids = tuple(int(i) for i in ids)
+        loaded = self._rows.setdefault(model, {})
+        self._pending.setdefault(model, set()).update(i for i in ids if i not in loaded)
+        self._requirements.append((model, ids, project_id, scalar))
+        return self
+
+    def resolve(self):
+        """load the pending IDs, then raise on the first failed requirement"""
+        self.load()
+        requirements, self._requirements = self._requirements, []
+        for model, ids, project_id, scalar in requirements:
+            self._check(model, ids, project_id, scalar)
+        return self
+
+    def load(self):
+        """load the pending IDs by one query per model without checking the requirements yet"""
+        for model, ids in self._pending.items():
+            if not ids:
+                continue
+            _, pk, delete_flag = self.ENTITIES[model]
+            query = model.query.filter(getattr(model, pk).in_(ids))
+            if delete_flag:
+                query = query.filter(getattr(model, delete_flag) == False)
+            self._rows[model].update((getattr(row, pk), row) for row in query.all())
+        self._pending = {}
+        return self
+
+    def _check(self, model, ids, project_id, scalar):
+        name = self.ENTITIES[model][0]
+        loaded = self._rows[model]
+        missing = [i for i in ids if i not in loaded]
+        if missing:
+            self._raise_not_found(model, missing, scalar)
+        if project_id:
+            wrong_ids = [i for i in ids if loaded[i].project_id != project_id]
+            if wrong_ids:
+                msg = "The {}(ID={}) does not belong to project(ID={}).".format(
+                    name, ids[0] if scalar else wrong_ids, project_id)
+                logger.error(msg)
+                raise ValidationError(msg)
+
+    def _raise_not_found(self, model, missing, scalar):
+        name = self.ENTITIES[model][0]
+        if scalar:
+            msg = "The {} with given ID {} does not exist.".format(name, missing[0])
+        else:
+            msg = "The {}(ID={}) does not exist.".format(name, missing)
+        logger.error(msg)
+        raise DataNotFoundError(msg)
+
+    def get(self, model, id_):
+        """the row loaded by resolve(), None if it doesn't exist or hasn't been required"""
+        return self._rows.get(model, {}).get(int(id_)) if self._is_id(id_) else None
+
+    def get_all(self, model, ids):
+        return [self.get(model, i) for i in ids]
+
+
+def get_integrity_batch():
+    """IntegrityBatch of the current request"""
+    memo = get_request_memo('_integrity_batch')
+    batch = memo.get('batch')
+    if batch is None:
+        batch = memo['batch'] = IntegrityBatch()
+    return batch
+
+
 def check_project_id_integrity(project_id):
     """Check if projectId exists"""
-    project = Project.query.filter(Project.project_id == project_id, Project.delete_flg == False).one_or_none()
-    if not project:
-        raise DataNotFoundError("The project with given ID {} does not exist.".format(project_id))
+    batch = get_integrity_batch().require(Project, project_id).resolve()
+    return batch.get(Project, project_id)
 
 
 def check_experiment_id_integrity(experiment_id):
     """Check if experimentId exists"""
-    experiment = Experiment.query.filter(Experiment.experiment_id == experiment_id,
-                                         Experiment.delete_flg == False).one_or_none()
-    if not experiment:
-        msg = "The experiment with given ID {} does not exist.".format(experiment_id)
-        logger.error(msg)
-        raise DataNotFoundError(msg)
+    batch = get_integrity_batch().require(Experiment, experiment_id).resolve()
+    return batch.get(Experiment, experiment_id)
 
 
 def check_kpi_id_integrity(kpi_id, project_id=None):
     """check if kpiId exists, and if it belongs to the project_id."""
-    kpi = Kpi.query.filter(Kpi.kpi_id == kpi_id, Kpi.delete_flg == False).one_or_none()
-    if not kpi:
-        msg = "The kpi with given ID {} does not exist.".format(kpi_id)
-        logger.error(msg)
-        raise DataNotFoundError(msg)
-    if project_id:
-        if not kpi.project_id == project_id:
-            msg = "The kpi(ID={}) does not belong to project(ID={}).".format(kpi_id, project_id)
-            logger.error(msg)
-            raise ValidationError(msg)
+    batch = get_integrity_batch().require(Kpi, kpi_id, project_id=project_id).resolve()
+    return batch.get(Kpi, kpi_id)
 
 
 def check_user_id_integrity(user_id):
@@ -132,40 +281,17 @@ def check_elements_have_same_type(element_types):
 
 def check_element_id_integrity(element_ids, project_id=None):
     """check if elementId exists, and if it belongs to the project_id."""
+    batch = get_integrity_batch()
     if isinstance(element_ids, int):
         # for v1, only has 1 element in top level or the json
-        element = Element.query.filter(Element.element_id == element_ids).one_or_none()
-        if not element:
-            msg = "The element with given ID {} does not exist.".format(element_ids)
-            logger.error(msg)
-            raise DataNotFoundError(msg)
-        if project_id:
-            if not element.project_id == project_id:
-                msg = "The element(ID={}) does not belong to project(ID={}).".format(element_ids, project_id)
-                logger.error(msg)
-                raise ValidationError(msg)
+        batch.require(Element, element_ids, project_id=project_id).resolve()
     elif isinstance(element_ids, set) or isinstance(element_ids, list) or isinstance(element_ids, tuple):
         element_ids = set([i for i in element_ids])
         # for v2, json may contain multiple element_id
-        res = Element.query.with_entities(Element.element_id, Element.project_id, Element.action_type).filter(
-            Element.element_id.in_(element_ids)).all()
+        batch.require(Element, element_ids, project_id=project_id).load()
         # check element type REPLACE/REDIRECT
-        check_elements_have_same_type(set([i[2] for i in res]))
-        element_ids_in_db = set([i[0] for i in res])
-        element_id_diff = element_ids_in_db.symmetric_difference(element_ids)
-        if element_id_diff:
-            msg = "The element(ID={}) does not exist.".format(list(element_id_diff))
-            logger.error(msg)
-            raise DataNotFoundError(msg)
-        if project_id:
-            for i in res:
-                wrong_ids = list()
-                if i[1] != project_id:
-                    wrong_ids.append(i[0])
-                if wrong_ids:
-                    msg = "The element(ID={}) does not belong to project(ID={}).".format(wrong_ids, project_id)
-                    logger.error(msg)
-                    raise ValidationError(msg)
+        check_elements_have_same_type(set([e.action_type for e in batch.get_all(Element, element_ids) if e]))
+        batch.resolve()
 
 
 def check_content_id_integrity(content_ids, project_id=None):
@@ -182,23 +308,7 @@ def check_content_id_integrity(content_ids, project_id=None):
         msg = "check_content_id_integrity() does not accept the give parameter type: {}".format(type(content_ids))
         logger.error(msg)
         raise ValueError(msg)
-    res = Content.query.with_entities(Content.content_id, Content.project_id).filter(
-        Content.content_id.in_(content_ids)).all()
-    content_ids_in_db = set([i[0] for i in res])
-    content_id_diff = content_ids_in_db.symmetric_difference(content_ids)
-    if content_id_diff:
-        msg = "The content(ID={}) does not exist.".format(list(content_id_diff))
-        logger.error(msg)
-        raise DataNotFoundError(msg)
-    if project_id:
-        for i in res:
-            wrong_ids = list()
-            if i[1] != project_id:
-                wrong_ids.append(i[0])
-            if wrong_ids:
-                msg = "The content(ID={}) does not belong to project(ID={}).".format(wrong_ids, project_id)
-                logger.error(msg)
-                raise ValidationError(msg)
+    get_integrity_batch().require(Content, content_ids, project_id=project_id).resolve()
 
 
 def check_status_integrity(requested_status):
@@ -225,34 +335,145 @@ def check_status_transformation_integrity(current_status, requested_status):
         raise ValidationError(msg)
 
 
+def resolve_permissions(user_id, organisation_id=None, project_id=None):
+    """
+    resolve the user -> organisation -> role -> permissions chain by one joined query.
+    The result is memoized for the current request, and across requests for PERMISSION_CACHE_TTL seconds as long
+    as the shared version stamp of the permissions is unchanged, which any committed change of the chain bumps.
+    :return: ResolvedPermissions
+    """
+    key = (user_id, organisation_id, project_id)
+    memo = get_request_memo('_resolved_permissions')
+    resolved = memo.get(key)
+    if resolved is None and permission_cache.enabled:
+        # read before the rows, so a change committed in between leaves the cached entry stale
+        version = get_permissions_version(*_PERMISSIONS_VERSION)
+        cached = permission_cache.get(key)
+        if cached is not None and version is not None and cached[1] == version:
+            resolved = cached[0]
+        if resolved is None:
+            resolved = _query_permissions(user_id, organisation_id, project_id)
+            if version is not None:
+                permission_cache.set(key, (resolved, version))
+    if resolved is None:
+        resolved = _query_permissions(user_id, organisation_id, project_id)
+    memo[key] = resolved
+    return resolved
+
+
+def _query_permissions(user_id, organisation_id=None, project_id=None):
+    if organisation_id:
+        project_columns = [null(), literal(organisation_id)]
+        organisation_id_expr = literal(organisation_id)
+    else:
+        project_columns = [Project.project_id, Project.organisation_id]
+        organisation_id_expr = Project.organisation_id
+    query = db.session.query(User.system_admin, *(project_columns + [Organization.organisation_id,
+                                                                      UserRoleOrganization.role_id,
+                                                                      Role.role_id, Role.permissions])) \
+        .select_from(User)
+    if not organisation_id:
+        query = query.outerjoin(Project, and_(Project.project_id == project_id, Project.delete_flg == False))
+    query = query \
+        .outerjoin(Organization, and_(Organization.organisation_id == organisation_id_expr,
+                                      Organization.delete_flag == False)) \
+        .outerjoin(UserRoleOrganization, and_(UserRoleOrganization.user_id == User.user_id,
+                                              UserRoleOrganization.organisation_id == Organization.organisation_id,
+                                              UserRoleOrganization.delete_flag == 0)) \
+        .outerjoin(Role, and_(Role.role_id == UserRoleOrganization.role_id, Role.delete_flag == False)) \
+        .filter(User.user_id == user_id, User.delete_flg == False)
+    system_admin, found_project_id, project_organisation_id, found_organisation_id, user_role_id, role_id, \
+        permissions = query.one()
+    return ResolvedPermissions(system_admin=system_admin,
+                               organisation_id=organisation_id or project_organisation_id,
+                               project_found=bool(organisation_id) or found_project_id is not None,
+                               organisation_found=found_organisation_id is not None,
+                               user_role_found=user_role_id is not None,
+                               role_found=role_id is not None,
+                               permissions=permissions)
+
+
+def get_project_organisation_id(project_id):
+    """
+    organisation ID of a not deleted project, cached for PROJECT_ORGANISATION_CACHE_TTL seconds as long as the
+    version stamp of the project in the shared cache is unchanged, so a move or delete committed by any worker is
+    seen at once
+    """
+    # read before the project, so a change committed in between leaves the cached entry stale
+    version = get_permissions_version('project', project_id)
+    cached = project_organisation_cache.get(project_id)
+    if cached is not None and version is not None and cached[1] == version:
+        return cached[0]
+    row = Project.query.with_entities(Project.organisation_id) \
+        .filter(Project.project_id == project_id, Project.delete_flg == False).one_or_none()
+    if not row:
+        raise DataNotFoundError("The project with given ID {} does not exist.".format(project_id))
+    organisation_id = row[0]
+    if version is not None:
+        project_organisation_cache.set(project_id, (organisation_id, version))
+    return organisation_id
+
+
+@event.listens_for(Project.organisation_id, 'set')
+@event.listens_for(Project.delete_flg, 'set')
+def _bump_project_version(target, value, oldvalue, initiator):
+    if value != oldvalue and target.project_id is not None:
+        bump_permissions_version_after_commit(target, 'project', target.project_id)
+
+
+@event.listens_for(Project, 'after_delete')
+def _bump_deleted_project_version(mapper, connection, target):
+    bump_permissions_version_after_commit(target, 'project', target.project_id)
+
+
+def _bump_permission_cache_version(target, value, oldvalue, initiator):
+    if value != oldvalue:
+        bump_permissions_version_after_commit(target, *_PERMISSIONS_VERSION)
+
+
+def _bump_permission_cache_version_on_write(mapper, connection, target):
+    bump_permissions_version_after_commit(target, *_PERMISSIONS_VERSION)
+
+
+for _attribute in (User.system_admin, User.delete_flg, Project.organisation_id, Project.delete_flg,
+                   Organization.delete_flag, UserRoleOrganization.role_id, UserRoleOrganization.delete_flag,
+                   Role.permissions, Role.delete_flag):
+    event.listen(_attribute, 'set', _bump_permission_cache_version)
+# a role granted by a new row, or rows removed by session.delete()
+for _model in (User, Project, Organization, UserRoleOrganization, Role):
+    event.listen(_model, 'after_insert', _bump_permission_cache_version_on_write)
+    event.listen(_model, 'after_delete', _bump_permission_cache_version_on_write)
+
+
 def check_permission(user_id, module, function, organisation_id=None, project_id=None):
     """
     validate if user have permission to perform task related to api with module , funtion
-
+    When the auth token of the logged in user carries permission claims they are used instead of the DB.
     """
-    user = User.query.filter(User.user_id == user_id, User.delete_flg == False).one()
+    claims = getattr(g, 'permission_claims', None) if has_app_context() else None
+    if claims and getattr(g.user, 'user_id', None) == user_id:
+        _check_permission_claims(claims, module, function, organisation_id=organisation_id, project_id=project_id)
+        return
 
-    if not user.system_admin:
+    resolved = resolve_permissions(user_id, organisation_id=organisation_id, project_id=project_id)
 
-        if not organisation_id:
-            check_project_id_integrity(project_id)
-            project = Project.query.filter(Project.project_id == project_id).one()
-            organisation_id = project.organisation_id
+    if not resolved.system_admin:
 
-        check_organization_id_integrity(organisation_id)
-        user_role_org = UserRoleOrganization.query.filter(UserRoleOrganization.user_id == user_id,
-                                                          UserRoleOrganization.organisation_id == organisation_id,
-                                                          UserRoleOrganization.delete_flag == 0).one_or_none()
-        if not user_role_org:
+        if not resolved.project_found:
+            raise DataNotFoundError("The project with given ID {} does not exist.".format(project_id))
+        if not resolved.organisation_found:
+            msg = "The organization with given ID {} does not exist.".format(resolved.organisation_id)
+            logger.error(msg)
+            raise DataNotFoundError(msg)
+        if not resolved.user_role_found:
             msg = "Logged in user don't have required permissions to perform this action. Contact your Organisation Admin."
             logger.error(msg)
             raise ForbiddenError(msg)
-        role = Role.query.filter(Role.role_id == user_role_org.role_id, Role.delete_flag == False).one_or_none()
-        if not role:
+        if not resolved.role_found:
             msg = "Logged in user don't have required permissions to perform this action .Contact your Organisation Admin."
             logger.error(msg)
             raise ForbiddenError(msg)
-        permissions = role.permissions
+        permissions = resolved.permissions
         try:
             if not permissions[module][function]:
                 msg = "Logged in user don't have required permissions to perform this action .Contact your Organisation Admin."
@@ -265,6 +486,28 @@ def check_permission(user_id, module, function, organisation_id=None, project_id
                 "Contact your Organisation Admin.")
 
 
+def _check_permission_claims(claims, module, function, organisation_id=None, project_id=None):
+    """same decision as check_permission(), made from the signed claims of the auth token"""
+    if claims['sa']:
+        return
+    organisation_id = organisation_id or get_project_organisation_id(project_id)
+    permissions = claims['orgs'].get(str(organisation_id))
+    if permissions is None:
+        msg = "Logged in user don't have required permissions to perform this action. Contact your Organisation Admin."
+        logger.error(msg)
+        raise ForbiddenError(msg)
+    try:
+        if not permissions[module][function]:
+            msg = "Logged in user don't have required permissions to perform this action .Contact your Organisation Admin."
+            logger.error(msg)
+            raise ForbiddenError(msg)
+    except Exception as e:
+        logger.warning(e.message)
+        raise ForbiddenError(
+            "Logged in user don't have required permissions to perform this action ."
+            "Contact your Organisation Admin.")
+
+
 def check_form(form):
     try:
         if not form.validate():
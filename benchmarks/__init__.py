@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark scripts, run them from the root directory, e.g. `python benchmarks/ldap_pool_bench.py`"""
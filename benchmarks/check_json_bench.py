@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmark of validators.check_json on KPI payloads.
+
+Compares the former behaviour (a new Draft4Validator and a sorted error list per call, three calls per KPI POST)
+with the compiled validator registry.
+
+The kpi request schemas of app.requestschema.kpi are empty, which would measure nothing, so the KPI payloads are
+validated against the schema below written after the payloads the UI sends, and the bulk payloads against
+kpi_bulk_request_schema with these settings as items.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from jsonschema import Draft4Validator
+
+from app import validators
+from app.requestschema.kpi import kpi_bulk_request_schema
+
+kpi_condition_schema = {
+    "type": "object",
+    "properties": {
+        "condition_type": {"type": "string", "enum": ["click", "conversion_page", "page_view"]},
+        "element_id": {"type": "integer", "minimum": 1},
+        "url": {"type": "string", "minLength": 1, "maxLength": 2048, "pattern": "^https?://"},
+        "operator": {"type": "string", "enum": ["equals", "contains", "starts_with", "regex"]}
+    },
+    "required": ["condition_type", "url", "operator"],
+    "additionalProperties": False
+}
+
+kpi_settings_schema = {
+    "type": "object",
+    "properties": {
+        "based_on": {"type": "string", "enum": ["session", "reaction", "user"]},
+        "kpi_definitions": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "kpi_definition_name": {"type": "string", "minLength": 1, "maxLength": 255},
+                    "main_kpi": {"type": "boolean"},
+                    "kpi_type": {"type": "string", "enum": ["click", "clickThroughConversion", "pageView"]},
+                    "pattern_name": {"type": "string", "minLength": 1},
+                    "kpi_conditions": {"type": "array", "items": kpi_condition_schema}
+                },
+                "required": ["kpi_definition_name", "main_kpi", "kpi_type", "kpi_conditions"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["based_on", "kpi_definitions"]
+}
+
+
+def build_kpi_payload(definitions, conditions):
+    """KPI POST body shaped like the ones sent by the UI"""
+    return {
+        'based_on': 'session',
+        'kpi_definitions': [{
+            'kpi_definition_name': 'kpi_{}'.format(i),
+            'main_kpi': i == 0,
+            'kpi_type': 'clickThroughConversion' if i % 3 == 0 else 'click',
+            'pattern_name': 'pattern_{}'.format(i % 4),
+            'kpi_conditions': [{
+                'condition_type': 'conversion_page' if j == conditions - 1 else 'click',
+                'element_id': 1000 + j,
+                'url': 'https://www.example.com/item/{}/{}?scid=ghp_{}'.format(i, j, j),
+                'operator': 'contains'
+            } for j in range(conditions)]
+        } for i in range(definitions)]
+    }
+
+
+def build_bulk_payload(items, definitions, conditions):
+    return {'items': [{'experiment_id': i, 'kpi_settings': build_kpi_payload(definitions, conditions)}
+                      for i in range(items)]}
+
+
+def check_json_before(json, schema):
+    validator = Draft4Validator(schema)
+    errors = sorted(validator.iter_errors(json), key=str)
+    if errors:
+        raise ValueError(errors)
+
+
+def kpi_post_before(payload):
+    check_json_before(payload, kpi_settings_schema)
+    check_json_before(payload, kpi_settings_schema)  # generate_reaction_query
+    check_json_before(payload, kpi_settings_schema)  # generate_report_query
+
+
+def kpi_post_registry(payload):
+    validators.check_json(payload, kpi_settings_schema)
+    validators.check_json(payload, kpi_settings_schema, fail_fast=True)
+    validators.check_json(payload, kpi_settings_schema, fail_fast=True)
+
+
+def kpi_bulk_before(payload):
+    check_json_before(payload, kpi_bulk_request_schema)
+    for item in payload['items']:
+        kpi_post_before(item['kpi_settings'])
+
+
+def kpi_bulk_registry(payload):
+    validators.check_json(payload, kpi_bulk_request_schema)
+    for item in payload['items']:
+        kpi_post_registry(item['kpi_settings'])
+
+
+def run(name, cases, before, registry, number):
+    print('{:>8} {:>12} {:>12} {:>14} {:>14}'.format(name, 'definitions', 'conditions', 'before ms', 'registry ms'))
+    for items, definitions, conditions, payload in cases:
+        # the payloads must be valid, an error would cut the validation short
+        before(payload)
+        registry(payload)
+        timings = [timeit.timeit(lambda: f(payload), number=number) * 1000.0 / number for f in (before, registry)]
+        print('{:>8} {:>12} {:>12} {:>14.3f} {:>14.3f}'.format(items, definitions, conditions, *timings))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark check_json on KPI payloads.")
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    validators.compile_request_schemas()
+    validators.get_schema_validator(kpi_settings_schema)
+    sizes = [(1, 2), (5, 3), (20, 5), (50, 8)]
+    run('post', [(1, d, c, build_kpi_payload(d, c)) for d, c in sizes], kpi_post_before, kpi_post_registry,
+        args.number)
+    run('bulk', [(n, d, c, build_bulk_payload(n, d, c)) for n in (10, 50) for d, c in sizes[:2]], kpi_bulk_before,
+        kpi_bulk_registry, max(args.number // 10, 1))
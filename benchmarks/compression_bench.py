@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Bytes on the wire and CPU time of compressing typical kpi responses by gzip levels and brotli qualities,
+as done by app.compression for clients sending Accept-Encoding.
+
+Payloads: a v2 kpi with its reaction/report queries, a kpi list page of 20 and of 200 records with queries,
+and a small error body.
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+import simplejson
+
+from app.compression import brotli, compress, iter_compressed
+
+
+def build_query(experiment_id, kpis):
+    lines = ['SELECT', '    r.variation_id,']
+    for i in range(kpis):
+        lines.append('    SUM(CASE WHEN r.event_name = "cv_{0}" AND r.dt >= "2020-01-{1:02d}" THEN 1 ELSE 0 END) '
+                     'AS kpi_{0},'.format(i, i % 28 + 1))
+    lines.extend(['    COUNT(DISTINCT r.user_id) AS users',
+                  'FROM hive_db.reaction r',
+                  'JOIN hive_db.assignment a ON a.user_id = r.user_id AND a.experiment_id = {}'.format(experiment_id),
+                  'WHERE r.experiment_id = {} AND r.dt BETWEEN "2020-01-01" AND "2020-03-31"'.format(experiment_id),
+                  'GROUP BY r.variation_id'])
+    return '\n'.join(lines)
+
+
+def build_kpi(experiment_id, kpis):
+    return {
+        'based_on': 'reaction',
+        'kpi_definitions': [{'name': 'cv_{}'.format(i), 'event': 'cv_{}'.format(i), 'type': 'count'}
+                            for i in range(kpis)],
+        'experimentId': experiment_id,
+        'if_reactionQuery_customized': False,
+        'if_reportQuery_customized': False,
+        'kpiId': experiment_id * 3,
+        'reactionQuery': build_query(experiment_id, kpis),
+        'reportQuery': build_query(experiment_id, kpis).replace('reaction', 'report')
+    }
+
+
+def build_payloads():
+    def page(records):
+        return {'pagination': {'page': 1, 'perPage': records, 'pages': 1, 'total': records},
+                'records': [build_kpi(1000 + i, 5 + i % 20) for i in range(records)]}
+
+    return [
+        ('kpi v2', build_kpi(1000, 20)),
+        ('list of 20', page(20)),
+        ('list of 200', page(200)),
+        ('error', {'code': 404, 'message': 'KPI for the experiment ID 1000 does not exist'})
+    ]
+
+
+def measure(f, number):
+    best = None
+    for _ in range(number):
+        start = time.time()
+        result = f()
+        elapsed = (time.time() - start) * 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def decompress(data, encoding):
+    if encoding == 'br':
+        return brotli.decompress(data)
+    return gzip.GzipFile(fileobj=BytesIO(data)).read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark response compression.")
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args()
+
+    settings = [('gzip', level) for level in (1, 6, 9)]
+    if brotli is not None:
+        settings += [('br', quality) for quality in (1, 4, 6, 11)]
+    else:
+        print('brotli is not installed, only gzip is measured')
+
+    print('{:>12} {:>10} {:>8} {:>6} {:>10} {:>7} {:>9} {:>13}'.format(
+        'payload', 'bytes', 'encoding', 'level', 'wire', 'ratio', 'ms', 'streamed wire'))
+    for name, payload in build_payloads():
+        body = simplejson.dumps(payload) + '\n'
+        for encoding, level in settings:
+            compressed, elapsed = measure(lambda: compress(body, encoding, level), args.number)
+            assert decompress(compressed, encoding) == body
+            # the streamed body in chunks of 64 KB, each flushed
+            chunks = [body[i:i + 64 * 1024] for i in range(0, len(body), 64 * 1024)]
+            streamed = ''.join(iter_compressed(chunks, encoding, level))
+            assert decompress(streamed, encoding) == body
+            print('{:>12} {:>10} {:>8} {:>6} {:>10} {:>6.1f}x {:>9.2f} {:>13}'.format(
+                name, len(body), encoding, level, len(compressed), len(body) / float(len(compressed)), elapsed,
+                len(streamed)))
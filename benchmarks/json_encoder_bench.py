@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Latency of encoding kpi collection responses of growing size by the per response simplejson.dumps() of the
+former output_json (before) versus each available backend of app.jsonencoders (after).
+
+The records carry reaction/report queries, kpi definitions and Decimal values like the kpi responses do.
+rapidjson is Python 3 only, on Python 2.7 'auto' chooses simplejson and the after timings are the ones of the shared
+encoder instead of a per response dumps().
+"""
+import argparse
+import os
+import sys
+import time
+from decimal import Decimal
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+import simplejson
+
+from app.jsonencoders import JSON_ENCODERS, build_json_encoder
+
+
+def build_payload(records, query_size):
+    query = u'SELECT experiment_id, count(*) FROM reaction WHERE dt >= "2020-01-01" -- ' + u'x' * query_size
+    return {
+        'pagination': {'page': 1, 'perPage': records, 'pages': 1, 'total': records, 'totalApproximate': False,
+                       'links': {'first': '/kpis?page=1', 'last': '/kpis?page=1'}},
+        'records': [{
+            'kpiId': i,
+            'experimentId': i // 10,
+            'based_on': 'reaction',
+            'kpi_definitions': [{'name': u'cv_{}'.format(j), 'weight': Decimal('0.125'), 'index': j} for j in range(5)],
+            'if_reactionQuery_customized': False,
+            'if_reportQuery_customized': bool(i % 2),
+            'reactionQuery': query,
+            'reportQuery': query,
+            'updateTime': '2020-01-01T00:00:00+09:00'
+        } for i in range(records)]
+    }
+
+
+def measure(encode, data, number):
+    best = None
+    for _ in range(number):
+        start = time.time()
+        result = encode(data)
+        elapsed = (time.time() - start) * 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the JSON encoder backends.")
+    parser.add_argument('--query-size', type=int, default=2000, help='size of each hive query in bytes')
+    parser.add_argument('--number', type=int, default=5)
+    parser.add_argument('--sort-keys', action='store_true')
+    args = parser.parse_args()
+
+    settings = {'sort_keys': True} if args.sort_keys else {}
+    encoders = [('dumps', lambda data: simplejson.dumps(data, **settings))]
+    for name, _ in JSON_ENCODERS:
+        try:
+            encoders.append(build_json_encoder(name, settings))
+        except (ImportError, ValueError) as e:
+            print('{} is not available: {}'.format(name, e))
+    chosen, _ = build_json_encoder('auto', settings)
+    print('auto chooses {}'.format(chosen))
+
+    print('{:>8} {:>12} '.format('records', 'bytes') + ' '.join('{:>12}'.format(name + ' ms') for name, _ in encoders))
+    for records in [10, 100, 1000, 10000]:
+        data = build_payload(records, args.query_size)
+        expected = simplejson.loads(simplejson.dumps(data, **settings), use_decimal=True)
+        timings = []
+        for name, encode in encoders:
+            dumped, elapsed = measure(encode, data, args.number)
+            loaded = simplejson.loads(dumped, use_decimal=True)
+            assert loaded == expected, name
+            timings.append(elapsed)
+        print('{:>8} {:>12} '.format(records, len(dumped)) + ' '.join('{:>12.2f}'.format(t) for t in timings))
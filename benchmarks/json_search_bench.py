@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Key lookup in large kpi_settings documents: the former XML-RPC/minidom round-trip of find_json_values_by_key
+versus the iterative walker and the compiled key path of app.jsonsearch."""
+import argparse
+import os
+import sys
+import timeit
+import xmlrpclib
+from xml.dom.minidom import parseString
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from app.jsonsearch import compile_key_path, iter_values_by_key
+
+
+def find_json_values_by_key_xmlrpc(somejson, key):
+    """the implementation replaced by app.jsonsearch, kept here as the baseline"""
+
+    def val(node):
+        e = node.nextSibling
+        while e and e.nodeType != e.ELEMENT_NODE:
+            e = e.nextSibling
+        if e:
+            if e.getElementsByTagName('string'):
+                return e.getElementsByTagName('string')[0].firstChild.nodeValue
+            elif e.getElementsByTagName('int'):
+                return int(e.getElementsByTagName('int')[0].firstChild.nodeValue)
+        return None
+
+    foo_dom = parseString(xmlrpclib.dumps((somejson,)))
+    return [val(node) for node in foo_dom.getElementsByTagName('name') if node.firstChild.nodeValue in key]
+
+
+def build_kpi_settings(definitions, conditions):
+    return {
+        'based_on': 'session',
+        'kpi_definitions': [{
+            'kpi_definition_name': 'kpi_{}'.format(i),
+            'main_kpi': i == 0,
+            'kpi_type': 'click',
+            'pattern_name': 'pattern_{}'.format(i),
+            'kpi_conditions': [{
+                'condition_type': 'click',
+                'element_id': j,
+                'url': 'https://www.example.com/item/{}/{}'.format(i, j),
+                'operator': 'contains'
+            } for j in range(conditions)]
+        } for i in range(definitions)]
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark JSON key search.")
+    parser.add_argument('--number', type=int, default=50)
+    args = parser.parse_args()
+
+    key_path = compile_key_path('kpi_definitions[*].pattern_name')
+    print('{:>12} {:>12} {:>12} {:>12} {:>14}'.format('definitions', 'conditions', 'xmlrpc ms', 'walker ms',
+                                                      'key path ms'))
+    for definitions, conditions in [(5, 3), (20, 10), (100, 10), (500, 20)]:
+        settings = build_kpi_settings(definitions, conditions)
+        definition = settings['kpi_definitions'][-1]
+        assert find_json_values_by_key_xmlrpc(definition, 'pattern_name') == \
+            list(iter_values_by_key(definition, 'pattern_name'))
+        timings = [timeit.timeit(f, number=args.number) * 1000.0 / args.number for f in (
+            lambda: find_json_values_by_key_xmlrpc(settings, 'pattern_name'),
+            lambda: list(iter_values_by_key(settings, 'pattern_name')),
+            lambda: list(key_path.find(settings)))]
+        print('{:>12} {:>12} {:>12.3f} {:>12.3f} {:>14.3f}'.format(definitions, conditions, *timings))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Query count and time to marshal one project's kpi list, loading whole rows with lazy loaded editors (before)
+versus the columns and eager loads derived from the marshal schema by schema_load_options() (after).
+
+The kpis live in a sqlite DB file, mapped by stand-in models shaped like Kpi and User, with reaction/report
+queries and kpi settings of realistic size.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from flask import Flask
+from flask_restful import fields, marshal
+from sqlalchemy import event
+
+from app.extensions import db
+from app.util import schema_load_options
+
+
+class BenchUser(db.Model):
+    __tablename__ = 'bench_user'
+    user_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    email = db.Column(db.String)
+    profile = db.Column(db.Text)
+
+
+class BenchKpi(db.Model):
+    __tablename__ = 'bench_kpi'
+    kpi_id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, index=True)
+    name = db.Column(db.String)
+    description = db.Column(db.String)
+    solution_type = db.Column(db.String)
+    detail = db.Column(db.String)
+    updated_by = db.Column(db.Integer, db.ForeignKey('bench_user.user_id'))
+    update_time = db.Column(db.DateTime)
+    delete_flg = db.Column(db.Boolean, default=False)
+    kpi_settings = db.Column(db.Text)
+    reaction_query = db.Column(db.Text)
+    report_query = db.Column(db.Text)
+    editor = db.relationship('BenchUser', foreign_keys=updated_by, uselist=False)
+
+
+bench_user_response = {
+    'userId': fields.Integer(attribute='user_id'),
+    'name': fields.String,
+    'email': fields.String
+}
+
+bench_kpi_response = {
+    'kpiId': fields.Integer(attribute='kpi_id'),
+    'name': fields.String,
+    'description': fields.String,
+    'solutionType': fields.String(attribute='solution_type'),
+    'detail': fields.String,
+    'updatedBy': fields.Nested(bench_user_response, attribute='editor', allow_null=True),
+    'updateTime': fields.DateTime(attribute='update_time', dt_format='iso8601'),
+    'outdated': fields.Boolean(attribute='delete_flg')
+}
+
+
+def build_project(project_id, kpis, users, query_size):
+    from datetime import datetime, timedelta
+    query = 'SELECT 1 -- ' + 'x' * query_size
+    for i in range(users):
+        db.session.add(BenchUser(user_id=project_id * 1000 + i, name='user_{}'.format(i),
+                                 email='user_{}@example.com'.format(i), profile='p' * 1000))
+    start = datetime(2020, 1, 1)
+    for i in range(kpis):
+        db.session.add(BenchKpi(project_id=project_id, name='kpi_{}'.format(i), description='kpi {}'.format(i),
+                                solution_type='AB', detail='', updated_by=project_id * 1000 + i % users,
+                                update_time=start + timedelta(minutes=i), delete_flg=False,
+                                kpi_settings='{"kpi_definitions": []}' + ' ' * (query_size // 10),
+                                reaction_query=query, report_query=query))
+    db.session.commit()
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def list_whole_rows(project_id):
+    rows = BenchKpi.query.filter(BenchKpi.project_id == project_id, BenchKpi.delete_flg == False).all()
+    return marshal(rows, bench_kpi_response)
+
+
+def list_schema_columns(project_id):
+    rows = BenchKpi.query.options(*schema_load_options(BenchKpi, bench_kpi_response)) \
+        .filter(BenchKpi.project_id == project_id, BenchKpi.delete_flg == False).all()
+    return marshal(rows, bench_kpi_response)
+
+
+def measure(counter, f, project_id, number):
+    best = None
+    for _ in range(number):
+        db.session.remove()
+        counter.count = 0
+        start = time.time()
+        result = f(project_id)
+        elapsed = (time.time() - start) * 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return result, counter.count, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark kpi list loading.")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--query-size', type=int, default=20000, help='size of each stored hive query in bytes')
+    parser.add_argument('--number', type=int, default=3)
+    args = parser.parse_args()
+
+    path = tempfile.mktemp(suffix='.sqlite')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    try:
+        with app.app_context():
+            BenchUser.__table__.create(db.engine)
+            BenchKpi.__table__.create(db.engine)
+            counter = QueryCounter(db.engine)
+            print('{:>6} {:>14} {:>12} {:>14} {:>12}'.format('kpis', 'whole queries', 'whole ms', 'schema queries',
+                                                             'schema ms'))
+            for project_id, kpis in enumerate([100, 1000, 5000], 1):
+                build_project(project_id, kpis, args.users, args.query_size)
+                whole, whole_queries, whole_ms = measure(counter, list_whole_rows, project_id, args.number)
+                schema, schema_queries, schema_ms = measure(counter, list_schema_columns, project_id, args.number)
+                assert whole == schema
+                print('{:>6} {:>14} {:>12.1f} {:>14} {:>12.1f}'.format(kpis, whole_queries, whole_ms, schema_queries,
+                                                                       schema_ms))
+    finally:
+        os.remove(path)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Logins per second of LDAPClient with and without connection pooling.
+
+The directory is a local stand-in: ldap.initialize() is replaced by an in-process fake server which charges
+a handshake latency on the first operation of every connection (TCP + TLS) and a bind latency on every bind,
+so the numbers show the handshake cost saved by the pool without needing a real directory.
+
+Both sides log in through LDAPClient.search_one_person() and authenticate(). The baseline is the LDAPClient of
+before pooling, one connection opened by the constructor, and a client made per login.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+import ldap
+
+from app import auth
+from app.customerrors import AuthenticationFailedError
+
+
+class StandInLDAPServer(object):
+    def __init__(self, handshake_latency, bind_latency):
+        self.handshake_latency = handshake_latency
+        self.bind_latency = bind_latency
+        self.handshakes = 0
+        self.lock = threading.Lock()
+
+    def initialize(self, url):
+        return StandInConnection(self)
+
+
+class StandInConnection(object):
+    def __init__(self, server):
+        self.server = server
+        self.connected = False
+        self.protocol_version = None
+
+    def _ensure_connected(self):
+        if not self.connected:
+            with self.server.lock:
+                self.server.handshakes += 1
+            time.sleep(self.server.handshake_latency)
+            self.connected = True
+
+    def simple_bind_s(self, dn, password):
+        self._ensure_connected()
+        time.sleep(self.server.bind_latency)
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        self._ensure_connected()
+        return [('uid=bench,{}'.format(base), {'uid': ['bench']})]
+
+    def whoami_s(self):
+        self._ensure_connected()
+        return ''
+
+    def unbind_s(self):
+        self.connected = False
+
+
+def login(client):
+    dn, uid = client.search_one_person('bench')
+    client.authenticate(dn, 'password')
+
+
+class UnpooledLDAPClient(auth.LDAPClient):
+    """LDAPClient before pooling, its own connection opened by the constructor"""
+
+    def __init__(self, url, base_dn):
+        self.url = url
+        self.base_dn = base_dn
+        self.client = ldap.initialize(url)
+        self.client.protocol_version = ldap.VERSION3
+
+    def _search(self, search_dn, search_cn):
+        return self.client.search_s(search_dn, ldap.SCOPE_SUBTREE, search_cn, None)
+
+    def authenticate(self, dn, password):
+        try:
+            self.client.simple_bind_s(dn, password)
+        except Exception:
+            raise AuthenticationFailedError("LDAP authentication failed.")
+        return True
+
+
+def run(name, target, logins, concurrency, server):
+    server.handshakes = 0
+    per_thread = logins // concurrency
+    threads = [threading.Thread(target=lambda: [target() for _ in range(per_thread)]) for _ in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    print('{:<12} {:>6} logins {:>8.1f} logins/s {:>6} handshakes'.format(
+        name, per_thread * concurrency, per_thread * concurrency / elapsed, server.handshakes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark LDAP logins with and without pooling.")
+    parser.add_argument('--logins', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--handshake-ms', type=float, default=20.0)
+    parser.add_argument('--bind-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    url, base_dn = 'ldaps://stand-in.local', 'ou=people,dc=example,dc=com'
+    server = StandInLDAPServer(args.handshake_ms / 1000.0, args.bind_ms / 1000.0)
+    ldap.initialize = server.initialize
+    auth.ldap.initialize = server.initialize
+
+    # a connection can't be shared by the threads without the pool, so each login makes its client
+    run('no pool', lambda: login(UnpooledLDAPClient(url, base_dn)), args.logins, args.concurrency, server)
+    client = auth.LDAPClient(url, base_dn)
+    run('pooled', lambda: login(client), args.logins, args.concurrency, server)
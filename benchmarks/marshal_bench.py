@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time to marshal a list of kpi rows by flask-restful marshal() (before) versus the serializer compiled by
+compile_schema() (after), for the kpi list response (model objects with a nested editor), the collection response
+with its pagination and the v2 kpi response (dicts). The outputs are asserted to be identical.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from flask_restful import marshal
+
+from app.responseschema import compile_schema
+from app.responseschema.kpi import kpi_get_response, kpi_collection_get_response, kpi_v2_get_response
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def build_rows(count):
+    start = datetime(2020, 1, 1)
+    editors = [Row(user_id=i, name=u'user_{}'.format(i), email=u'user_{}@example.com'.format(i), role='admin')
+               for i in range(50)]
+    kpis, kpi_dicts = [], []
+    for i in range(count):
+        kpis.append(Row(kpi_id=i, name=u'kpi_{}'.format(i), description=u'kpi {}'.format(i) if i % 3 else None,
+                        solution_type='AB', detail=u'', editor=editors[i % 50] if i % 7 else None,
+                        update_time=start + timedelta(minutes=i), version=i % 4, source=None if i % 2 else 1,
+                        delete_flg=False))
+        kpi_dicts.append({'based_on': 'reaction', 'kpi_definitions': [{'name': 'cv', 'index': i}],
+                          'experiment_id': i // 10, 'if_custom_reaction_query': bool(i % 2),
+                          'if_custom_report_query': None, 'kpi_id': i, 'reaction_query': 'SELECT {}'.format(i),
+                          'report_query': u'SELECT {}'.format(i)})
+    collection = {
+        'pagination': {'page': 1, 'perPage': count, 'pages': 1, 'total': count, 'totalApproximate': False,
+                       'links': {'first': '/kpis?page=1', 'last': '/kpis?page=1'}},
+        'records': kpis
+    }
+    return kpis, collection, kpi_dicts
+
+
+def measure(f, data, number):
+    best = None
+    for _ in range(number):
+        start = time.time()
+        result = f(data)
+        elapsed = (time.time() - start) * 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark marshalling of kpi rows.")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=5)
+    args = parser.parse_args()
+
+    kpis, collection, kpi_dicts = build_rows(args.rows)
+    print('{:>22} {:>12} {:>12} {:>8}'.format('schema', 'marshal ms', 'compiled ms', 'speedup'))
+    for name, schema, data in [('kpi_get_response', kpi_get_response, kpis),
+                               ('kpi_collection_get', kpi_collection_get_response, collection),
+                               ('kpi_v2_get_response', kpi_v2_get_response, kpi_dicts)]:
+        serialize = compile_schema(schema)
+        expected, marshal_ms = measure(lambda rows: marshal(rows, schema), data, args.number)
+        result, compiled_ms = measure(serialize, data, args.number)
+        assert result == expected
+        print('{:>22} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(name, marshal_ms, compiled_ms, marshal_ms / compiled_ms))
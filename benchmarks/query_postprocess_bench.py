@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Post-processing of rendered hive queries: the chained unescape_webcode/unescape_character calls versus the
+single pass of postprocess_hive_query. Their equivalence is tested by tests/hive_query_postprocess_test.py."""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from app.util import postprocess_hive_query
+from tests.hive_query_postprocess_test import FRAGMENT, legacy_postprocess
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark hive query post-processing.")
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>12} {:>14}'.format('fragments', 'bytes', 'legacy ms', 'single pass ms'))
+    for count in (1, 10, 100, 1000):
+        fragments = [FRAGMENT.format(i=i) for i in range(count)]
+        query = ''.join(fragments)
+        timings = [timeit.timeit(f, number=args.number) * 1000.0 / args.number for f in (
+            lambda: legacy_postprocess(''.join(fragments)),
+            lambda: postprocess_hive_query(fragments))]
+        print('{:>10} {:>10} {:>12.3f} {:>14.3f}'.format(count, len(query), *timings))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Render time per KPI definition of an organisation query template,
+re-parsed by render_template_string() (before) versus compiled once by render_cached_template() (after)."""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from flask import Flask, render_template_string
+
+from app.util import render_cached_template
+
+# shaped like organisation_settings.reaction_query_template
+REACTION_QUERY_TEMPLATE = u"""
+{% if params.settings %}SET hive.exec.dynamic.partition.mode=nonstrict;
+SET hive.exec.compress.output=true;
+{% endif %}
+INSERT OVERWRITE TABLE {{ params.ghp_hive_dbname }}.{{ params.reaction_table }}
+PARTITION (experiment_id='{{ params.experiment_id }}', kpi_name='{{ params.kpi_name }}')
+SELECT r.easy_id, r.phxbanditpattern, count(1) AS reactions
+FROM {{ params.ghp_hive_dbname }}.ghp_reaction r
+WHERE r.dt BETWEEN '{{ params.start_datetime }}' AND '{{ params.end_datetime }}'
+  AND r.phxbanditpattern IN ({% for p in params.phxbanditpatterns %}'{{ p }}'{% if not loop.last %}, {% endif %}{% endfor %})
+  AND ({% for c in params.kpi_conditions %}
+    {% if not loop.first %}OR {% endif %}(r.reaction_type = '{{ c.condition_type }}'
+    {% if c.url %}AND r.url LIKE '%{{ c.url }}%'{% endif %}
+    {% if c.element_id %}AND r.element_id = {{ c.element_id }}{% endif %})
+  {% endfor %})
+GROUP BY r.easy_id, r.phxbanditpattern;
+"""
+
+
+def build_params(conditions, patterns, settings):
+    return {
+        'ghp_hive_dbname': 'ghp', 'reaction_table': 'ghp_kpi_reaction', 'kpi_name': 'kpi_0', 'experiment_id': 1234,
+        'start_datetime': '2026-01-01 00:00:00', 'end_datetime': '2026-02-01 00:00:00', 'settings': settings,
+        'phxbanditpatterns': ['ab__{}__{}'.format(100 + i, 1000 + i) for i in range(patterns)],
+        'kpi_conditions': [{'condition_type': 'click', 'element_id': 500 + i,
+                            'url': 'https://www.example.com/item/{}?a=1&b=2'.format(i)} for i in range(conditions)]
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark query template rendering per KPI definition.")
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    with app.app_context():
+        print('{:>10} {:>10} {:>12} {:>12} {:>8}'.format('conditions', 'patterns', 'before us', 'after us', 'speedup'))
+        for conditions, patterns in [(1, 2), (3, 4), (5, 10), (10, 40)]:
+            params = build_params(conditions, patterns, settings=False)
+            before = timeit.timeit(lambda: render_template_string(REACTION_QUERY_TEMPLATE, params=params),
+                                   number=args.number) * 1e6 / args.number
+            after = timeit.timeit(lambda: render_cached_template(REACTION_QUERY_TEMPLATE, owner=(1, 'bench'),
+                                                                 params=params),
+                                  number=args.number) * 1e6 / args.number
+            print('{:>10} {:>10} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(conditions, patterns, before, after,
+                                                                        before / after))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time to first byte, total time and peak memory of a kpi list page marshalled and dumped at once (before)
+versus streamed from yield_per() by marshal_with_fields (after), for growing page sizes.
+
+The kpis live in a sqlite DB file, mapped by a stand-in model shaped like Kpi with queries of realistic size.
+Every request runs in a forked process, whose peak RSS growth is reported.
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from flask import Flask, request
+from flask_restful import Api, Resource, fields
+
+from app.extensions import db
+from app.jsonencoders import init_json_encoder
+from app.responseschema import marshal_with_fields, pagination_meta_data
+from app.util import build_pagination_response
+
+
+class BenchKpi(db.Model):
+    __tablename__ = 'bench_kpi'
+    kpi_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    reaction_query = db.Column(db.Text)
+    report_query = db.Column(db.Text)
+
+
+bench_kpi_response = {
+    'kpiId': fields.Integer(attribute='kpi_id'),
+    'name': fields.String,
+    'reactionQuery': fields.String(attribute='reaction_query'),
+    'reportQuery': fields.String(attribute='report_query')
+}
+
+bench_collection_response = {
+    'pagination': fields.Nested(pagination_meta_data),
+    'records': fields.Nested(bench_kpi_response)
+}
+
+
+class BenchKpiCollection(Resource):
+    @marshal_with_fields(bench_collection_response, records='records')
+    def get(self):
+        return build_pagination_response(request, BenchKpi.query.order_by(BenchKpi.kpi_id), max_per_page=100000), 200
+
+
+def build_kpis(kpis, query_size):
+    query = 'SELECT 1 -- ' + 'x' * query_size
+    db.session.bulk_insert_mappings(BenchKpi, [{'kpi_id': i, 'name': 'kpi_{}'.format(i), 'reaction_query': query,
+                                                'report_query': query} for i in range(kpis)])
+    db.session.commit()
+
+
+def run_request(app, url):
+    """(ms to the first chunk, ms to the last chunk, bytes, peak RSS growth in KB) of a request in a forked process"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            with app.app_context():
+                db.engine.dispose()
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            first, size = None, 0
+            resp = app.test_client().get(url, buffered=False)
+            for chunk in resp.response:
+                if first is None:
+                    first = time.time()
+                size += len(chunk)
+            end = time.time()
+            growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            os.write(write_fd, '{} {} {} {}'.format((first - start) * 1000.0, (end - start) * 1000.0, size, growth))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 1024)
+    os.waitpid(pid, 0)
+    first_ms, total_ms, size, growth = result.split()
+    return float(first_ms), float(total_ms), int(size), int(growth)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark streamed kpi list responses.")
+    parser.add_argument('--query-size', type=int, default=20000, help='size of each stored hive query in bytes')
+    args = parser.parse_args()
+
+    path = tempfile.mktemp(suffix='.sqlite')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    Api(app).add_resource(BenchKpiCollection, '/kpis')
+    try:
+        with app.app_context():
+            init_json_encoder(app)
+            BenchKpi.__table__.create(db.engine)
+            build_kpis(10000, args.query_size)
+        print('{:>8} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+            'perPage', 'bytes', 'first ms', 'total ms', 'peak KB', 'stream first', 'stream total', 'stream KB'))
+        for per_page in [100, 1000, 10000]:
+            first_ms, total_ms, size, growth = run_request(app, '/kpis?perPage={}&stream=false'.format(per_page))
+            s_first_ms, s_total_ms, s_size, s_growth = run_request(app, '/kpis?perPage={}&stream=true'.format(per_page))
+            print('{:>8} {:>12} {:>12.1f} {:>12.1f} {:>12} {:>12.1f} {:>12.1f} {:>12}'.format(
+                per_page, size, first_ms, total_ms, growth, s_first_ms, s_total_ms, s_growth))
+    finally:
+        os.remove(path)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Query count and time to build the variation/condition combinations of synthetic experiments,
+lazy loading the tree (before) versus eager loading it with load_variation_tree() (after).
+
+The trees live in an in-memory sqlite DB, mapped by stand-in models shaped like Variation and Condition.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.orm import subqueryload
+
+from app.extensions import db
+from app.util import get_all_variation_condition_combinations, load_variation_tree
+
+
+class BenchVariation(db.Model):
+    __tablename__ = 'bench_variation'
+    variation_id = db.Column(db.Integer, primary_key=True)
+    experiment_id = db.Column(db.Integer, index=True)
+    type_ = db.Column('type', db.String)
+    is_root = db.Column(db.Boolean)
+    conditions = db.relationship('BenchCondition', foreign_keys='BenchCondition.variation_id',
+                                 order_by='BenchCondition.condition_id')
+
+
+class BenchCondition(db.Model):
+    __tablename__ = 'bench_condition'
+    condition_id = db.Column(db.Integer, primary_key=True)
+    variation_id = db.Column(db.Integer, db.ForeignKey('bench_variation.variation_id'), index=True)
+    name = db.Column(db.String)
+    nested_variation_id = db.Column(db.Integer, db.ForeignKey('bench_variation.variation_id'))
+    nested_variation = db.relationship('BenchVariation', foreign_keys=[nested_variation_id], uselist=False)
+
+
+def build_tree(experiment_id, depth, fan_out):
+    def build_variation(level, is_root):
+        variation = BenchVariation(experiment_id=experiment_id, type_='AB', is_root=is_root)
+        db.session.add(variation)
+        db.session.flush()
+        for i in range(fan_out):
+            condition = BenchCondition(variation_id=variation.variation_id, name='pattern_{}_{}'.format(level, i))
+            if level < depth:
+                condition.nested_variation_id = build_variation(level + 1, False).variation_id
+            db.session.add(condition)
+        return variation
+
+    build_variation(1, True)
+    db.session.commit()
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def combinations_lazy(experiment_id):
+    roots = BenchVariation.query.filter(BenchVariation.experiment_id == experiment_id,
+                                        BenchVariation.is_root == True).all()
+    return [c for root in roots for c in get_all_variation_condition_combinations(root)]
+
+
+def combinations_eager(experiment_id):
+    variations = BenchVariation.query \
+        .options(subqueryload('conditions').joinedload('nested_variation')) \
+        .filter(BenchVariation.experiment_id == experiment_id).all()
+    roots = [variation for variation in variations if variation.is_root]
+    load_variation_tree(roots)
+    return [c for root in roots for c in get_all_variation_condition_combinations(root)]
+
+
+def measure(counter, f, experiment_id):
+    db.session.expunge_all()
+    counter.count = 0
+    start = time.time()
+    result = f(experiment_id)
+    return result, counter.count, (time.time() - start) * 1000.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark variation tree loading.")
+    parser.add_argument('--max-depth', type=int, default=4)
+    parser.add_argument('--max-fan-out', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        BenchVariation.__table__.create(db.engine)
+        BenchCondition.__table__.create(db.engine)
+        counter = QueryCounter(db.engine)
+        print('{:>6} {:>8} {:>8} {:>12} {:>10} {:>12} {:>10}'.format(
+            'depth', 'fan-out', 'leaves', 'lazy queries', 'lazy ms', 'eager queries', 'eager ms'))
+        experiment_id = 0
+        for depth in range(1, args.max_depth + 1):
+            for fan_out in range(2, args.max_fan_out + 1):
+                experiment_id += 1
+                build_tree(experiment_id, depth, fan_out)
+                lazy, lazy_queries, lazy_ms = measure(counter, combinations_lazy, experiment_id)
+                eager, eager_queries, eager_ms = measure(counter, combinations_eager, experiment_id)
+                assert lazy == eager
+                print('{:>6} {:>8} {:>8} {:>12} {:>10.1f} {:>12} {:>10.1f}'.format(
+                    depth, fan_out, len(eager), lazy_queries, lazy_ms, eager_queries, eager_ms))
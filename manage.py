@@ -41,6 +41,38 @@ def routes():
         print line
 
 
+@manager.option('-b', '--burst', dest='burst', action='store_true', default=False,
+                help='exit as soon as the job queue is empty')
+def job_worker(burst=False):
+    """Run the queued background jobs (e.g. query regeneration) in this process"""
+    from app.jobs import get_job_queue
+    get_job_queue().work(app, burst=burst)
+
+
+@manager.option('-o', '--organization', dest='organization_id', type=int, default=None)
+@manager.option('-p', '--project', dest='project_id', type=int, default=None)
+@manager.option('-n', '--processes', dest='processes', type=int, default=None,
+                help='size of the process pool, the number of CPUs by default, 0 renders in this process')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=100, help='kpis updated per commit')
+def rerender_kpi_queries(organization_id=None, project_id=None, processes=None, batch_size=100):
+    """Regenerate the reaction/report queries of every kpi of an organization or project which are not customized"""
+    from app.rerender import rerender_kpi_queries as rerender
+
+    if organization_id is None and project_id is None:
+        print 'either --organization or --project is required'
+        return
+
+    def progress(summary):
+        print '{done}/{total} kpis, {updated} updated, {skipped} skipped, {failed} failed, {elapsed:.1f}s, ' \
+            '{throughput:.1f} kpis/s' \
+            .format(**summary)
+
+    summary = rerender(organisation_id=organization_id, project_id=project_id, processes=processes,
+                       batch_size=batch_size, progress=progress)
+    for error in summary['errors']:
+        print 'kpi {kpiId} (experiment {experimentId}): {error}'.format(**error)
+
+
 def _make_context():
     return dict(app=app, db=db, models=models)
 
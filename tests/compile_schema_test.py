@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Unit tests of compile_schema(), whose serializers must give the same output as flask-restful marshal()."""
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from flask_restful import fields, marshal
+
+from app.responseschema import compile_schema, marshal_compiled, trim_schema, FieldsISODateTime, \
+    FieldsStringToUpperCase, NestedWithEmpty
+from app.responseschema.kpi import kpi_collection_get_response, kpi_get_response, kpi_v2_get_response
+
+
+class Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Doubled(fields.Raw):
+    """a field overriding output(), left to the field by the serializer"""
+
+    def output(self, key, obj):
+        value = fields.get_value(self.attribute or key, obj)
+        return None if value is None else value * 2
+
+
+nested_schema = {
+    'id': fields.Integer,
+    'label': fields.String(default=u'none')
+}
+
+schema = {
+    'integer': fields.Integer,
+    'integerFromString': fields.Integer(attribute='integer_string'),
+    'string': fields.String,
+    'stringFromNumber': fields.String(attribute='number'),
+    'boolean': fields.Boolean(attribute='flag'),
+    'raw': fields.Raw(default=u'missing'),
+    'float': fields.Float(attribute='number'),
+    'upper': FieldsStringToUpperCase(attribute='string'),
+    'time': FieldsISODateTime(attribute='time'),
+    'dotted': fields.String(attribute='child.label'),
+    'callable': fields.Integer(attribute=lambda obj: 7),
+    'nested': fields.Nested(nested_schema, attribute='child'),
+    'nestedOrNull': fields.Nested(nested_schema, attribute='missing', allow_null=True),
+    'nestedOrEmpty': NestedWithEmpty(nested_schema, attribute='missing', allow_empty=True),
+    'nestedOfNone': fields.Nested(nested_schema, attribute='missing'),
+    'list': fields.List(fields.Nested(nested_schema), attribute='children'),
+    'doubled': Doubled(attribute='integer'),
+    'dict': {'integer': fields.Integer, 'string': fields.String}
+}
+
+
+def build_data():
+    child = {'id': 1, 'label': u'child'}
+    values = {'integer': 3, 'integer_string': '4', 'string': u'text', 'number': 1.5, 'flag': 0, 'raw': None,
+              'time': datetime(2020, 1, 2, 3, 4, 5), 'child': child, 'missing': None,
+              'children': [child, {'id': 2, 'label': None}]}
+    changed = dict(values, string='bytes', flag='yes', integer=None, time=None, child=Row(**child))
+    return [values, Row(**values), changed, {}]
+
+
+class CompileSchemaTest(unittest.TestCase):
+
+    def assertSameAsMarshal(self, data, fields_dict):
+        self.assertEqual(compile_schema(fields_dict)(data), marshal(data, fields_dict))
+
+    def test_fields_of_dicts_and_objects(self):
+        for data in build_data():
+            self.assertSameAsMarshal(data, schema)
+
+    def test_list_of_records(self):
+        data = build_data()
+        self.assertSameAsMarshal(data, schema)
+        self.assertSameAsMarshal(tuple(data), schema)
+        self.assertSameAsMarshal([], schema)
+
+    def test_key_order_is_kept(self):
+        self.assertEqual(list(compile_schema(schema)(build_data()[0]).keys()), list(marshal(build_data()[0], schema)))
+
+    def test_serializer_is_cached_by_schema(self):
+        self.assertIs(compile_schema(schema), compile_schema(schema))
+        self.assertIsNot(compile_schema(nested_schema), compile_schema(dict(nested_schema)))
+
+    def test_envelope(self):
+        data = build_data()[0]
+        self.assertEqual(marshal_compiled(data, schema, envelope='data'), marshal(data, schema, envelope='data'))
+
+    def test_kpi_schemas(self):
+        editor = Row(user_id=1, name=u'user_1', email=u'user_1@example.com', role='admin')
+        kpis = [Row(kpi_id=i, name=u'kpi_{}'.format(i), description=None if i % 2 else u'kpi', solution_type='AB',
+                    detail=u'', editor=editor if i % 2 else None, update_time=datetime(2020, 1, 1, i), version=i,
+                    source=None if i % 2 else 1, delete_flg=bool(i % 2))
+                for i in range(4)]
+        self.assertSameAsMarshal(kpis, kpi_get_response)
+        collection = {'pagination': {'page': 1, 'perPage': 4, 'pages': 1, 'total': 4, 'totalApproximate': False,
+                                     'links': {'first': '/kpis?page=1'}},
+                      'records': kpis}
+        self.assertSameAsMarshal(collection, kpi_collection_get_response)
+        cursor_collection = {'pagination': {'perPage': 4, 'total': None, 'totalApproximate': False, 'cursor': None,
+                                            'nextCursor': 'WzFd', 'links': {'first': '/kpis?cursor='}},
+                             'records': kpis}
+        self.assertSameAsMarshal(cursor_collection, kpi_collection_get_response)
+        kpi_dicts = [{'based_on': 'reaction', 'kpi_definitions': [{'name': 'cv'}], 'experiment_id': 1,
+                      'if_custom_reaction_query': 1, 'if_custom_report_query': None, 'kpi_id': 2,
+                      'reaction_query': 'SELECT 1', 'report_query': u'SELECT 2'}, {}]
+        self.assertSameAsMarshal(kpi_dicts, kpi_v2_get_response)
+
+    def test_pagination_keys_of_the_mode(self):
+        serialize = compile_schema(kpi_collection_get_response)
+        page = serialize({'pagination': {'page': 1, 'total': 0}, 'records': []})['pagination']
+        self.assertEqual(sorted(page), ['links', 'page', 'pages', 'perPage', 'total', 'totalApproximate'])
+        cursor = serialize({'pagination': {'cursor': None, 'nextCursor': None}, 'records': []})['pagination']
+        self.assertEqual(sorted(cursor), ['cursor', 'links', 'nextCursor', 'perPage', 'total', 'totalApproximate'])
+        trimmed = trim_schema(kpi_collection_get_response, ['pagination.total', 'pagination.nextCursor'])
+        self.assertEqual(dict(compile_schema(trimmed)({'pagination': {'cursor': '', 'total': 3}})['pagination']),
+                         {'total': 3, 'nextCursor': None})
+        self.assertEqual(dict(compile_schema(trimmed)({'pagination': {'page': 2, 'total': 3}})['pagination']),
+                         {'total': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Unit tests of postprocess_hive_query(), which must give the same output as the chained
+unescape_webcode/unescape_character calls it replaced."""
+import os
+import random
+import sys
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from app.util import postprocess_hive_query, unescape_character, unescape_webcode
+
+TOKENS = ["&", "&amp;", "&amp;amp;", "&lt;", "&gt;", "&quot;", "&apos;", "amp;", "lt;", "quot;", "'", "]", ";",
+          "--", "-", "\\", "\;", "RCFILE\n", "RCFILE\n\;", "RCFILE\n;", "\n", " ", "a", "x_1"]
+
+FRAGMENT = (u"INSERT OVERWRITE TABLE reaction_{i} STORED AS RCFILE\n\;\n"
+            u"SELECT session_id, count(*) FROM pageview WHERE url LIKE '%item&amp;id={i};%' "
+            u"AND referrer &lt;&gt; '' -- comment\n"
+            u"AND label = '&amp;quot;a--b&amp;quot;' GROUP BY session_id;\n")
+
+
+def legacy_postprocess(query):
+    return unescape_character(unescape_webcode(unescape_webcode(query)))
+
+
+class PostprocessHiveQueryTest(unittest.TestCase):
+
+    def test_rendered_query(self):
+        query = FRAGMENT.format(i=1)
+        self.assertEqual(postprocess_hive_query(query), legacy_postprocess(query))
+        self.assertIn(u"url LIKE '%item&id=1\\;%'", postprocess_hive_query(query))
+        self.assertIn(u"label = '\"a\\--b\"'", postprocess_hive_query(query))
+        self.assertIn(u"RCFILE\n;\n", postprocess_hive_query(query))
+
+    def test_query_without_quotes_or_entities_is_unchanged(self):
+        query = u"SELECT session_id FROM pageview -- comment\nWHERE a < b;\n"
+        self.assertEqual(postprocess_hive_query(query), query)
+
+    def test_fragments_are_joined(self):
+        fragments = [FRAGMENT.format(i=i) for i in range(100)]
+        self.assertEqual(postprocess_hive_query(fragments), legacy_postprocess(''.join(fragments)))
+        self.assertEqual(postprocess_hive_query(iter(fragments)), legacy_postprocess(''.join(fragments)))
+        self.assertEqual(postprocess_hive_query([]), u'')
+
+    def test_quoted_part_split_across_fragments(self):
+        query = FRAGMENT.format(i=1)
+        expected = legacy_postprocess(query)
+        for split in (query.index("'%item") + 1, query.index("&amp;id"), query.index("&amp;id") + 2,
+                      query.index("a--b") + 2, query.index("RCFILE\n") + 7):
+            self.assertEqual(postprocess_hive_query([query[:split], query[split:]]), expected, split)
+
+    def test_random_queries(self):
+        rnd = random.Random(0)
+        for _ in range(5000):
+            query = ''.join(rnd.choice(TOKENS) for _ in range(rnd.randint(0, 60)))
+            expected = legacy_postprocess(query)
+            self.assertEqual(postprocess_hive_query(query), expected, repr(query))
+            split = rnd.randint(0, len(query))
+            self.assertEqual(postprocess_hive_query([query[:split], query[split:]]), expected, repr(query))
+
+
+if __name__ == '__main__':
+    unittest.main()
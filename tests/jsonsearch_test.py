@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Unit tests of app.jsonsearch and find_json_values_by_key()."""
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from app.jsonsearch import compile_key_path, find_by_key_path, iter_values_by_key
+from app.util import find_json_values_by_key
+
+KPI_SETTINGS = {
+    'based_on': 'reaction',
+    'kpi_definitions': [
+        {'name': 'cv', 'pattern_name': 'pattern_a', 'conditions': [{'pattern_name': 'pattern_b'}]},
+        {'name': 'ctr', 'pattern_name': 'pattern_c', 'conditions': []},
+        {'name': 'pv', 'main': True}
+    ]
+}
+
+
+class IterValuesByKeyTest(unittest.TestCase):
+
+    def test_values_depth_first_in_document_order(self):
+        # the order of the members of an object is the one of the dict
+        self.assertEqual(sorted(iter_values_by_key(KPI_SETTINGS, 'pattern_name')),
+                         ['pattern_a', 'pattern_b', 'pattern_c'])
+        document = [{'key': 1}, [{'key': 2}, {'child': {'key': 3}}], {'key': 4}]
+        self.assertEqual(list(iter_values_by_key(document, 'key')), [1, 2, 3, 4])
+
+    def test_several_keys(self):
+        document = [{'a': 1, 'b': {'a': 2}}, ({'b': 3},)]
+        self.assertEqual(sorted(iter_values_by_key(document, ['a', 'b']), key=repr), [1, 2, 3, {'a': 2}])
+
+    def test_values_of_any_type(self):
+        document = {'key': None, 'other': {'key': [1, {'key': False}]}}
+        self.assertEqual(sorted(iter_values_by_key(document, 'key'), key=repr), [False, None, [1, {'key': False}]])
+
+    def test_missing_key_and_scalar_document(self):
+        self.assertEqual(list(iter_values_by_key(KPI_SETTINGS, 'missing')), [])
+        self.assertEqual(list(iter_values_by_key('pattern_name', 'pattern_name')), [])
+        self.assertEqual(list(iter_values_by_key(None, 'pattern_name')), [])
+
+    def test_deep_document_does_not_hit_the_recursion_limit(self):
+        document = {'key': 'bottom'}
+        for _ in range(sys.getrecursionlimit() * 2):
+            document = {'child': [document]}
+        self.assertEqual(list(iter_values_by_key(document, 'key')), ['bottom'])
+
+    def test_find_json_values_by_key(self):
+        self.assertEqual(sorted(find_json_values_by_key(KPI_SETTINGS['kpi_definitions'][0], 'pattern_name')),
+                         ['pattern_a', 'pattern_b'])
+        self.assertEqual(find_json_values_by_key(KPI_SETTINGS, ('name',)), ['cv', 'ctr', 'pv'])
+
+
+class KeyPathTest(unittest.TestCase):
+
+    def find(self, expression, document=KPI_SETTINGS):
+        return list(find_by_key_path(document, expression))
+
+    def test_member(self):
+        self.assertEqual(self.find('based_on'), ['reaction'])
+        self.assertEqual(self.find('missing'), [])
+        self.assertEqual(self.find('based_on.missing'), [])
+
+    def test_items(self):
+        self.assertEqual(self.find('kpi_definitions[*].pattern_name'), ['pattern_a', 'pattern_c'])
+        self.assertEqual(self.find('kpi_definitions[0].conditions[0].pattern_name'), ['pattern_b'])
+        self.assertEqual(self.find('kpi_definitions[-1].name'), ['pv'])
+        self.assertEqual(self.find('kpi_definitions[3].name'), [])
+        self.assertEqual(self.find('kpi_definitions[-4].name'), [])
+
+    def test_wildcard(self):
+        self.assertEqual(sorted(self.find('*', {'a': 1, 'b': 2})), [1, 2])
+        self.assertEqual(self.find('kpi_definitions.*.name'), ['cv', 'ctr', 'pv'])
+        self.assertEqual(self.find('[*]', [1, 2]), [1, 2])
+
+    def test_first(self):
+        key_path = compile_key_path('kpi_definitions[*].pattern_name')
+        self.assertEqual(key_path.first(KPI_SETTINGS), 'pattern_a')
+        self.assertEqual(key_path.first({}, default='none'), 'none')
+
+    def test_compiled_once(self):
+        self.assertIs(compile_key_path('a.b[0]'), compile_key_path('a.b[0]'))
+
+    def test_invalid_expressions(self):
+        for expression in ('', '.a', 'a[', 'a[x]', 'a..b'):
+            with self.assertRaises(ValueError):
+                compile_key_path(expression)
+
+
+if __name__ == '__main__':
+    unittest.main()
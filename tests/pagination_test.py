@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Unit tests of the pagination of app.util, on a sqlite DB with a stand-in model."""
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from flask import Flask, request
+from jsonschema import ValidationError
+
+from app.extensions import db
+from app.util import _estimate_mysql_rows, build_pagination_response, count_total, pagination_count_cache
+
+
+class PaginatedItem(db.Model):
+    __tablename__ = 'test_paginated_item'
+    item_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    update_time = db.Column(db.DateTime)
+
+
+class PaginatedItemTag(db.Model):
+    __tablename__ = 'test_paginated_item_tag'
+    tag_id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, db.ForeignKey('test_paginated_item.item_id'))
+    tag = db.Column(db.String)
+
+
+class PaginationTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        self.app.add_url_rule('/items', 'items', lambda: '')
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.Model.metadata.create_all(db.engine, tables=[PaginatedItem.__table__, PaginatedItemTag.__table__])
+        start = datetime(2020, 1, 1)
+        # 25 items, two share each update time, the last one has none
+        db.session.add_all([PaginatedItem(item_id=i, name='item_{}'.format(i),
+                                          update_time=start + timedelta(minutes=i // 2) if i < 25 else None)
+                            for i in range(1, 26)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.Model.metadata.drop_all(db.engine, tables=[PaginatedItem.__table__, PaginatedItemTag.__table__])
+        pagination_count_cache.clear()
+        self.context.pop()
+
+    def paginate(self, query_string, **kwargs):
+        with self.app.test_request_context('/items?' + query_string):
+            return build_pagination_response(request, PaginatedItem.query, **kwargs)
+
+
+class CursorPaginationTest(PaginationTestBase):
+
+    def test_traverses_every_item_once_newest_first(self):
+        ids, cursor, pages = [], '', 0
+        while cursor is not None:
+            res = self.paginate('cursor={}&perPage=4'.format(cursor))
+            ids.extend(item.item_id for item in res['records'])
+            cursor = res['pagination']['nextCursor']
+            pages += 1
+        expected = [item.item_id for item in PaginatedItem.query.filter(PaginatedItem.update_time.isnot(None))
+                    .order_by(PaginatedItem.update_time.desc(), PaginatedItem.item_id.desc())]
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 6)
+
+    def test_items_without_update_time_are_not_listed(self):
+        res = self.paginate('cursor=&perPage=100&total=true')
+        self.assertNotIn(25, [item.item_id for item in res['records']])
+        self.assertEqual(res['pagination']['total'], 24)
+        self.assertIsNone(res['pagination']['nextCursor'])
+
+    def test_rejects_per_page_below_one(self):
+        for per_page in (0, -1):
+            with self.assertRaises(ValidationError):
+                self.paginate('cursor=&perPage={}'.format(per_page))
+
+    def test_rejects_invalid_cursor(self):
+        with self.assertRaises(ValidationError):
+            self.paginate('cursor=not-a-cursor')
+
+
+class CountTotalTest(PaginationTestBase):
+
+    def test_exact_count(self):
+        self.assertEqual(count_total(PaginatedItem.query, 'exact'), (25, False))
+
+    def test_estimate_falls_back_to_exact_count_off_postgresql(self):
+        self.assertEqual(count_total(PaginatedItem.query, 'estimate'), (25, False))
+
+    def test_mysql_estimate_of_a_plan(self):
+        single = [{'id': 1, 'select_type': 'SIMPLE', 'table': 'kpi', 'rows': 120000, 'filtered': 10.0}]
+        self.assertEqual(_estimate_mysql_rows(single), 12000)
+        joined = [{'id': 1, 'table': 'kpi', 'rows': 1000, 'filtered': 50.0},
+                  {'id': 1, 'table': 'project', 'rows': 1, 'filtered': 100.0},
+                  {'id': 2, 'select_type': 'SUBQUERY', 'table': 'experiment', 'rows': 99999, 'filtered': 100.0}]
+        self.assertEqual(_estimate_mysql_rows(joined), 500)
+        # MySQL 5.6 has no filtered column
+        self.assertEqual(_estimate_mysql_rows([{'id': 1, 'rows': 42}]), 42)
+
+    def test_mysql_plan_without_estimate(self):
+        self.assertIsNone(_estimate_mysql_rows([{'id': 1, 'table': None, 'rows': None, 'filtered': None,
+                                                 'Extra': 'Impossible WHERE'}]))
+        self.assertIsNone(_estimate_mysql_rows([]))
+
+    def test_cached_count_is_reused_until_its_table_is_written(self):
+        self.assertEqual(count_total(PaginatedItem.query, 'cached'), (25, False))
+        db.session.execute(PaginatedItem.__table__.delete().where(PaginatedItem.item_id == 1))
+        # written without the ORM, the cache doesn't know
+        self.assertEqual(count_total(PaginatedItem.query, 'cached'), (25, False))
+        db.session.add_all([PaginatedItem(item_id=26, name='item_26'), PaginatedItem(item_id=27, name='item_27')])
+        db.session.commit()
+        self.assertEqual(count_total(PaginatedItem.query, 'cached'), (26, False))
+
+    def test_cached_count_of_a_joined_query_is_invalidated_by_the_joined_table(self):
+        db.session.add_all([PaginatedItemTag(item_id=i, tag='even') for i in range(2, 26, 2)])
+        db.session.commit()
+        query = PaginatedItem.query.join(PaginatedItemTag, PaginatedItemTag.item_id == PaginatedItem.item_id) \
+            .filter(PaginatedItemTag.tag == 'even')
+        self.assertEqual(count_total(query, 'cached'), (12, False))
+        db.session.add(PaginatedItemTag(item_id=1, tag='even'))
+        db.session.commit()
+        self.assertEqual(count_total(query, 'cached'), (13, False))
+
+    def test_cached_count_is_kept_on_rollback(self):
+        self.assertEqual(count_total(PaginatedItem.query, 'cached'), (25, False))
+        db.session.execute(PaginatedItem.__table__.delete().where(PaginatedItem.item_id == 1))
+        db.session.commit()
+        db.session.add(PaginatedItem(item_id=26, name='item_26'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(count_total(PaginatedItem.query, 'cached'), (25, False))
+
+    def test_rejects_unknown_count_strategy(self):
+        with self.assertRaises(ValidationError):
+            self.paginate('page=1&count=guess')
+
+
+if __name__ == '__main__':
+    unittest.main()
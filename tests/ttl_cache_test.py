@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Unit tests of app.helpers.TTLCache."""
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+
+from app.helpers import TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_expired_entry_is_a_miss(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1, ttl=-1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled_cache(self):
+        cache = TTLCache(maxsize=0, ttl=60)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_bounded_by_bytes(self):
+        cache = TTLCache(maxsize=10, ttl=60, maxbytes=10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        cache.get('a')
+        cache.set('c', 'xxxx')
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ('xxxx', None, 'xxxx'))
+        self.assertEqual(cache.stats()['bytes'], 8)
+        cache.set('a', 'xx')
+        self.assertEqual(cache.stats()['bytes'], 6)
+
+    def test_value_bigger_than_maxbytes_is_not_stored(self):
+        cache = TTLCache(maxsize=10, ttl=60, maxbytes=10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('a', 'x' * 11)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_bytes_follow_removals(self):
+        cache = TTLCache(maxsize=10, ttl=60, maxbytes=100, sizeof=len)
+        for key in 'abcd':
+            cache.set(key, key * 5)
+        cache.pop('a')
+        self.assertEqual(cache.discard_if(lambda key, value: key in 'bc'), 2)
+        self.assertEqual(cache.stats()['bytes'], 5)
+        cache.clear()
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()